@@ -0,0 +1,87 @@
+"""
+Compares the cost of tracking a page view on the request path when hits are sent
+with requests.get to a local HTTP server and when they are written into a shared
+memory ring drained by a dispatcher process.
+
+    python examples/benchmarks/ring_benchmark.py --hits 2000 --workers 4
+"""
+
+import argparse
+import multiprocessing
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import matomo
+from matomo.request import Request
+from matomo.ring import HitRing, RingDispatcher, RingTransport
+from matomo.transport import RequestsTransport
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+def worker(api_url, transport, hits, results):
+    request = Request({"HTTP_USER_AGENT": "Benchmark", "HTTP_HOST": "example.org"})
+    tracker = matomo.Matomo(request, 1, api_url).set_transport(transport)
+    start = time.perf_counter()
+    for number in range(hits):
+        tracker.do_track_page_view(f"Page {number}")
+    results.put(time.perf_counter() - start)
+
+
+def run(name, api_url, transport, hits, workers):
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=worker, args=(api_url, transport, hits, results))
+        for _ in range(workers)
+    ]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - start
+    per_hit = sum(results.get() for _ in processes) / (hits * workers) * 1e6
+    print(f"{name:>14}: {per_hit:8.1f} us per hit in worker, {elapsed:6.2f} s total")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hits", type=int, default=2000, help="Hits per worker")
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api_url = f"http://127.0.0.1:{server.server_address[1]}/"
+
+    run("requests.get", api_url, RequestsTransport(), args.hits, args.workers)
+
+    ring = HitRing(size=8 * 1024 * 1024)
+    dispatcher = RingDispatcher(ring, api_url, flush_interval=0.05).start()
+    try:
+        run("shared ring", api_url, RingTransport(ring), args.hits, args.workers)
+    finally:
+        dispatcher.stop()
+        print(f"{'ring overflow':>14}: {ring.overflow} hits")
+        ring.close()
+        ring.unlink()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
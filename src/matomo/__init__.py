@@ -1,8 +1,15 @@
+import functools
 import json
-from urllib.parse import urlencode, parse_qs
-import requests
+import logging
+import time
+from urllib.parse import parse_qs, urlencode
 
-from .tracker import MatomoTracker, urlencode_plus
+from .ids import default_id_source
+from .tracker import DeferredUrl, MatomoTracker, urlencode_plus
+from .transport import HitFuture, default_transport, resolve_bulk
+
+
+logger = logging.getLogger(__name__)
 
 
 """
@@ -37,31 +44,120 @@ request data:
 
 class Matomo(MatomoTracker):
     PATH_TO_CERTIFICATES_FILE = None  # Same purpose and limitations as CURLOPT_CAINFO
+    transport = default_transport  # Shared by trackers unless set with set_transport()
 
     def send_request(self, url, method="GET", data=None, force=False):
         # parameter data, when present, is a JSON string
         if self.doBulkRequests and not force:
             # Store request and send it with other's with do_bulk_track
-            self.storedTrackingActions.append(
-                "{}{}{}".format(
-                    url,
-                    ("&ua=" + urlencode(self.user_agent) if self.user_agent else ""),
-                    (
-                        "&lang=" + urlencode(self.accept_language)
-                        if self.accept_language
-                        else ""
-                    ),
-                )
-            )
-            self.clear_custom_variables()
-            self.clear_custom_dimensions()
-            self.clear_custom_tracking_parameters()
-            self.user_agent = ""
-            self.clientHints = {}
-            self.accept_language = ""
-
-            return True
+            self.storedTrackingActions.append(self.get_bulk_tracking_action(url))
+            future = HitFuture()
+            self.storedFutures.append(future)
+            return future
+
+        if getattr(self.transport, "QUEUED", False) and not self.doBulkRequests:
+            url = self.add_capture_time(url)
+
+        if isinstance(url, DeferredUrl) and hasattr(self.transport, "send_deferred"):
+            # Built by the transport, e.g. in a Dispatcher's worker thread
+            if self.user_agent:
+                url += "&ua=" + urlencode_plus(self.user_agent)
+            if self.accept_language:
+                url += "&lang=" + urlencode_plus(self.accept_language)
+            return self.transport.send_deferred(url)
+
+        method, url, data, headers, proxies, cookies = self.prepare_request(
+            url, method, data
+        )
+        options = {
+            "headers": headers,
+            "cookies": cookies,
+            "proxies": proxies,
+            "timeout": self.requestTimeout,
+            "cert": self.PATH_TO_CERTIFICATES_FILE,
+        }
+        if self.doBulkRequests:
+            return self.transport.send_bulk(url, data, **options)
+        return self.transport.send(method, url, data, **options)
+
+    def do_bulk_track(self):
+        """
+        Sends all stored tracking actions at once and resolves the HitFutures
+        returned when they were stored.
+
+        * @throws Exception
+        * @return Response
+        """
+        futures = self.storedFutures
+        response = super().do_bulk_track()
+        self.storedFutures = []
+        resolve_bulk(futures, response)
+        return response
+
+    def set_transport(self, transport):
+        """
+        Sets transport used to send tracking requests.
+
+        * @param matomo.transport.Transport transport
+        * @return self
+        """
+        self.transport = transport
+        return self
+
+    def add_capture_time(self, url):
+        """
+        Adds the current time as cdt to the URL of a tracking request sent later,
+        so Matomo records it at the time it was tracked. URLs are returned as
+        they are when a datetime was forced with set_force_visit_date_time().
+
+        Matomo accepts cdt older than a day only with token_auth, so sending
+        hits later than that requires token_auth of bulk requests, see
+        check_capture_time_window().
+
+        * @param str url
+        * @return str
+        """
+        if self.forcedDatetime:
+            return url
+        return url + "&cdt=" + str(int(time.time()))
+
+    def get_bulk_tracking_action(self, url):
+        """
+        Returns tracking request URL as stored for a bulk request with the time
+        it was tracked and resets custom variables, dimensions, tracking
+        parameters, user agent and browser language, like sending the request
+        would. DeferredUrls stay deferred until the bulk request is sent.
 
+        * @param str|DeferredUrl url
+        * @return str|DeferredUrl
+        """
+        action = self.add_capture_time(url)
+        if self.user_agent:
+            action += "&ua=" + urlencode_plus(self.user_agent)
+        if self.accept_language:
+            action += "&lang=" + urlencode_plus(self.accept_language)
+        self.clear_custom_variables()
+        self.clear_custom_dimensions()
+        self.clear_custom_tracking_parameters()
+        self.user_agent = ""
+        self.clientHints = {}
+        self.clientHintsKey = None
+        self.accept_language = ""
+        return action
+
+    def prepare_request(self, url, method="GET", data=None):
+        """
+        Prepares a tracking request for sending.
+
+        Moves parameters into POST data when needed and adds token_auth, headers,
+        proxies and cookies.
+
+        * @param str url
+        * @param str method
+        * @param str data JSON string
+        * @return tuple (method, url, data, headers, proxies, cookies)
+        """
+        url = str(url)
         force_post_url_encoded = False
         if not self.doBulkRequests:
             if self.request_method and self.request_method.upper() == "POST":
@@ -114,28 +210,10 @@ class Matomo(MatomoTracker):
             # Send tokenAuth only over POST
             if self.token_auth:
                 data["token_auth"] = self.token_auth
-
-            response = requests.post(
-                url,
-                data=data,
-                headers=headers,
-                proxies=proxies,
-                timeout=self.requestTimeout,
-                cookies=cookies,
-                cert=self.PATH_TO_CERTIFICATES_FILE,
-            )
-        elif method == "GET":
-            response = requests.get(
-                url,
-                headers=headers,
-                proxies=proxies,
-                timeout=self.requestTimeout,
-                cookies=cookies,
-                cert=self.PATH_TO_CERTIFICATES_FILE,
-            )
-        else:
+            method = "POST"
+        elif method != "GET":
             raise Exception(f"Unsupported HTTP method: {method}")
-        return response
+        return method, url, data, headers, proxies, cookies
 
 
 def matomo_get_url_track_page_view(request, id_site, document_title=""):
@@ -161,3 +239,107 @@ def matomo_get_url_track_goal(request, id_site, id_goal, revenue=0.0):
     """
     tracker = Matomo(request, id_site)
     return tracker.get_url_track_goal(id_goal, revenue)
+
+
+def matomo_tracking_endpoint(api_url):
+    """
+    Returns URL of Matomo's tracking endpoint, e.g. "http://example.org/matomo.php"
+
+    * @param str api_url "http://example.org/matomo/" or "http://matomo.example.org/"
+    * @return str
+    """
+    if "/matomo.php" not in api_url and "/proxy-matomo.php" not in api_url:
+        api_url = api_url.rstrip("/") + "/matomo.php"
+    return api_url
+
+
+# Age in seconds of the oldest cdt Matomo accepts without token_auth by default, its
+# tracking_requests_require_authentication_when_custom_timestamp_newer_than setting
+CAPTURE_TIME_WINDOW = 86400
+
+
+def check_capture_time_window(holder, token_auth):
+    """
+    Warns when hits held by holder may be sent more than CAPTURE_TIME_WINDOW
+    seconds after they were tracked without token_auth, because Matomo rejects
+    their cdt then.
+
+    * @param str holder Description of what holds the hits, e.g. "Agent spool"
+    * @param str token_auth Token sent with the hits
+    * @return bool False when a warning was logged
+    """
+    if token_auth:
+        return True
+    logger.warning(
+        "%s may send hits more than %d seconds after they were tracked, which Matomo"
+        " only accepts with token_auth. Set token_auth to keep them.",
+        holder,
+        CAPTURE_TIME_WINDOW,
+    )
+    return False
+
+
+@functools.lru_cache(maxsize=128)
+def matomo_tracking_url_prefix(api_url, id_site):
+    """
+    Returns the part of tracking URLs shared by all requests for a site, e.g.
+    "http://example.org/matomo.php?idsite=1&rec=1&apiv=1"
+
+    * @param str api_url "http://example.org/matomo/" or "http://matomo.example.org/"
+    * @param int id_site
+    * @return str
+    """
+    api_url = matomo_tracking_endpoint(api_url)
+    start = "&" if "?" in api_url else "?"
+    return f"{api_url}{start}idsite={id_site}&rec=1&apiv={MatomoTracker.VERSION}"
+
+
+def matomo_pixel_url(api_url, id_site, **params):
+    """
+    Builds a tracking URL for an image pixel (e.g. in a <noscript> tag) without
+    creating a tracker. The visitor's browser requests the pixel, so Matomo reads
+    IP address, user agent and cookies from its request.
+
+    * @param str api_url
+    * @param int id_site
+    * @param params Tracking API parameters, e.g. url, action_name or idgoal
+    * @return str
+    """
+    url = matomo_tracking_url_prefix(api_url, id_site) + "&r=" + default_id_source.cache_buster()
+    params = {name: value for name, value in params.items() if value}
+    if params:
+        url += "&" + urlencode(params)
+    return url
+
+
+def matomo_pixel_url_track_page_view(api_url, id_site, url="", document_title=""):
+    """
+    Helper function to quickly generate the pixel URL to track a page view.
+
+    * @param str api_url
+    * @param int id_site
+    * @param str url Tracked page URL
+    * @param str document_title
+    * @return str
+    """
+    return matomo_pixel_url(api_url, id_site, url=url, action_name=document_title)
+
+
+def matomo_pixel_url_track_goal(api_url, id_site, id_goal, revenue=0.0, url=""):
+    """
+    Helper function to quickly generate the pixel URL to track a goal.
+
+    * @param str api_url
+    * @param int id_site
+    * @param int id_goal
+    * @param float revenue
+    * @param str url Tracked page URL
+    * @return str
+    """
+    return matomo_pixel_url(
+        api_url,
+        id_site,
+        url=url,
+        idgoal=id_goal,
+        revenue=str(revenue).replace(",", ".") if revenue else "",
+    )
@@ -0,0 +1,305 @@
+import argparse
+import logging
+import os
+import signal
+import socket
+import time
+
+import matomo
+from matomo.transport import (
+    Response,
+    Transport,
+    default_transport,
+    hit_query,
+    register_after_fork,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Forwarding agent that collects tracking requests of all worker processes on a
+host and sends them to Matomo in large bulk requests.
+
+Run it next to the web workers:
+
+    python -m matomo.agent --socket /run/matomo-agent.sock \\
+        --api-url https://matomo.example.org/ --spool /var/spool/matomo-agent
+
+and let workers' trackers hand their hits to it:
+
+    matomo.Matomo.transport = AgentTransport("/run/matomo-agent.sock")
+
+Each hit is sent to the agent as one Unix datagram containing the query string
+of the tracking request, so workers only pay for a single non-blocking sendto().
+The agent retries failed bulk requests and appends hits it can't keep in memory
+to the spool file, from which they are sent when the agent starts again.
+"""
+
+
+# Largest accepted hit record
+MAX_HIT_SIZE = 65536
+
+
+class AgentTransport(Transport):
+    """
+    Hands tracking requests to a matomo.agent listening on a Unix datagram socket.
+
+    Sends never block. Hits that can't be delivered to the agent (it isn't
+    running or its socket buffer is full) are counted in dropped and a 503
+    response is returned. token_auth is added by the agent.
+
+    * @param str socket_path Path of agent's socket
+    """
+
+    QUEUED = True
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.dropped = 0
+        self._socket = None
+        register_after_fork(self)
+
+    def reset_after_fork(self):
+        self._socket = None
+
+    def get_socket(self):
+        if self._socket is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            self._socket = sock
+        return self._socket
+
+    def send_hit(self, hit):
+        """
+        Sends one hit record to the agent.
+
+        * @param str hit Query string of a tracking request, starting with '?'
+        * @return bool Whether the agent received it
+        """
+        try:
+            self.get_socket().sendto(hit.encode("utf-8"), self.socket_path)
+        except OSError:
+            self.dropped += 1
+            return False
+        return True
+
+    def send(self, method, url, data=None, headers=None, **options):
+        hit = hit_query(url, data, headers)
+        return Response(202 if self.send_hit(hit) else 503, {}, b"")
+
+    def send_bulk(self, url, data, **options):
+        received = 0
+        for action in data["requests"]:
+            received += self.send_hit(hit_query(action))
+        return Response(202 if received == len(data["requests"]) else 503, {}, b"")
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+
+class Agent:
+    """
+    Receives hit records on a Unix datagram socket and sends them in bulk.
+
+    * @param str socket_path Path of the socket to listen on
+    * @param str api_url "http://example.org/matomo/" or "http://matomo.example.org/"
+    * @param str token_auth (optional) Sent with bulk requests
+    * @param int batch_size (optional) Maximum number of hits in a bulk request
+    * @param float flush_interval (optional) Seconds between bulk requests of partial batches
+    * @param str spool_path (optional) File for hits that can't be kept in memory
+    * @param int max_pending (optional) Hits kept in memory while Matomo is unavailable
+    * @param matomo.transport.Transport transport (optional) Transport of bulk requests
+    * @param int timeout (optional) Timeout of bulk requests in seconds
+    """
+
+    def __init__(
+        self,
+        socket_path,
+        api_url,
+        token_auth="",
+        batch_size=500,
+        flush_interval=1.0,
+        spool_path=None,
+        max_pending=100000,
+        transport=default_transport,
+        timeout=10,
+    ):
+        self.socket_path = socket_path
+        self.url = matomo.matomo_tracking_endpoint(api_url)
+        self.token_auth = token_auth
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool_path = spool_path
+        self.max_pending = max_pending
+        self.transport = transport
+        self.timeout = timeout
+        if spool_path:
+            # Spooled hits are sent when the agent starts again, possibly days later
+            matomo.check_capture_time_window("Agent spool", token_auth)
+
+        self.pending = []
+        self.sent = 0
+        self.spilled = 0
+        self.dropped = 0
+        self.failures = 0
+        self.running = True
+        self.socket = None
+        self.next_flush = 0
+
+    def bind(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(self.socket_path)
+
+    def serve_forever(self):
+        """
+        Receives and sends hits until stop() is called.
+        """
+        if self.socket is None:
+            self.bind()
+        self.load_spool()
+        self.next_flush = time.monotonic() + self.flush_interval
+        try:
+            while self.running:
+                self.socket.settimeout(max(self.next_flush - time.monotonic(), 0.001))
+                try:
+                    hit = self.socket.recv(MAX_HIT_SIZE)
+                except socket.timeout:
+                    hit = None
+                if hit:
+                    self.pending.append(hit.decode("utf-8"))
+                    # Hits keep arriving while retries are backing off
+                    self.spill_overflow()
+                # Full batches are sent early unless retries are backing off
+                full = len(self.pending) >= self.batch_size and not self.failures
+                if full or time.monotonic() >= self.next_flush:
+                    self.flush()
+        finally:
+            self.receive_remaining()
+            self.socket.close()
+            os.unlink(self.socket_path)
+            self.flush()
+            self.spill(self.pending)
+            self.pending = []
+
+    def receive_remaining(self):
+        # Hits already in the socket buffer when stopping
+        self.socket.setblocking(False)
+        while True:
+            try:
+                hit = self.socket.recv(MAX_HIT_SIZE)
+            except OSError:
+                return
+            if hit:
+                self.pending.append(hit.decode("utf-8"))
+
+    def stop(self):
+        """
+        Stops serve_forever(), which then sends or spills pending hits.
+        """
+        self.running = False
+        # Wake up the receiving loop with an empty datagram
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as wakeup:
+                wakeup.sendto(b"", self.socket_path)
+        except OSError:
+            pass
+
+    def flush(self):
+        """
+        Sends pending hits in bulk requests. After a failure sending is retried with
+        an increasing delay and hits over max_pending are spilled to the spool file.
+        """
+        while self.pending:
+            batch = self.pending[: self.batch_size]
+            data = {"requests": batch}
+            if self.token_auth:
+                data["token_auth"] = self.token_auth
+            try:
+                ok = self.transport.send_bulk(self.url, data, timeout=self.timeout).ok
+            except Exception:
+                logger.exception("Sending Matomo bulk request failed.")
+                ok = False
+
+            if not ok:
+                self.failures += 1
+                delay = min(self.flush_interval * 2**self.failures, 60)
+                self.next_flush = time.monotonic() + delay
+                self.spill_overflow()
+                return
+            del self.pending[: len(batch)]
+            self.sent += len(batch)
+        self.failures = 0
+        self.next_flush = time.monotonic() + self.flush_interval
+
+    def spill_overflow(self):
+        """
+        Spills the oldest pending hits over max_pending.
+        """
+        if len(self.pending) > self.max_pending:
+            overflow = len(self.pending) - self.max_pending
+            self.spill(self.pending[:overflow])
+            del self.pending[:overflow]
+
+    def spill(self, hits):
+        """
+        Appends hits to the spool file or drops them if there is none.
+        """
+        if not hits:
+            return
+        if not self.spool_path:
+            self.dropped += len(hits)
+            return
+        with open(self.spool_path, "a", encoding="utf-8") as spool:
+            spool.writelines(hit + "\n" for hit in hits)
+        self.spilled += len(hits)
+
+    def load_spool(self):
+        """
+        Queues hits spilled by a previous run.
+        """
+        if not self.spool_path or not os.path.exists(self.spool_path):
+            return
+        with open(self.spool_path, encoding="utf-8") as spool:
+            hits = [line.rstrip("\n") for line in spool if line.strip()]
+        os.unlink(self.spool_path)
+        self.pending[:0] = hits
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m matomo.agent",
+        description="Collects tracking requests of local workers and sends them to Matomo in bulk.",
+    )
+    parser.add_argument("--socket", required=True, help="Path of the Unix datagram socket")
+    parser.add_argument("--api-url", required=True, help="Matomo URL")
+    parser.add_argument("--token-auth", default=os.environ.get("MATOMO_TOKEN_AUTH", ""))
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--flush-interval", type=float, default=1.0)
+    parser.add_argument("--spool", help="File for hits that couldn't be sent")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    agent = Agent(
+        args.socket,
+        args.api_url,
+        token_auth=args.token_auth,
+        batch_size=args.batch_size,
+        flush_interval=args.flush_interval,
+        spool_path=args.spool,
+    )
+    signal.signal(signal.SIGTERM, lambda signum, frame: agent.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: agent.stop())
+    agent.serve_forever()
+    logger.info(
+        "Sent %d, spilled %d and dropped %d hits.", agent.sent, agent.spilled, agent.dropped
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+import asyncio
+import json
+import logging
+import ssl
+from urllib.parse import urlencode, urlsplit
+
+import matomo
+from matomo.transport import Response, Transport, default_transport
+
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Support for sending tracking requests from asyncio event loops.
+
+Requests are sent with a minimal HTTP/1.1 client built on asyncio streams so
+sending never blocks the event loop and doesn't need a thread pool.
+Proxies set with set_proxy() are not supported.
+
+Trackers with a transport set with set_transport() or matomo.Matomo.transport
+use it instead. Transports without send_async(), like dispatchers, are called
+directly, so they should only queue hits.
+"""
+
+
+# Keeps references to scheduled sends so they are not garbage collected early
+_background_tasks = set()
+
+
+async def _read_body(reader, headers):
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b";")[0].strip(), 16)
+            if not size:
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        return b"".join(chunks)
+    if "content-length" in headers:
+        return await reader.readexactly(int(headers["content-length"]))
+    return await reader.read()
+
+
+async def _http_request(method, url, data, json_data, headers, cookies, cert):
+    parts = urlsplit(url)
+    https = parts.scheme == "https"
+    ssl_context = None
+    if https:
+        ssl_context = ssl.create_default_context()
+        if cert:
+            ssl_context.load_cert_chain(cert)
+    port = parts.port or (443 if https else 80)
+
+    reader, writer = await asyncio.open_connection(parts.hostname, port, ssl=ssl_context)
+    try:
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        if json_data is not None:
+            body = json.dumps(json_data).encode("utf-8")
+            content_type = "application/json"
+        else:
+            body = urlencode(data, doseq=True).encode("utf-8") if data else b""
+            content_type = "application/x-www-form-urlencoded"
+
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {parts.netloc}", "Connection: close"]
+        for name, value in (headers or {}).items():
+            if value:
+                lines.append(f"{name}: {value}")
+        if cookies:
+            cookie = "; ".join(f"{name}={value}" for name, value in cookies.items())
+            if cookie:
+                lines.append(f"Cookie: {cookie}")
+        if method == "POST":
+            lines.append(f"Content-Type: {content_type}")
+            lines.append(f"Content-Length: {len(body)}")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        status_code = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+        content = await _read_body(reader, response_headers)
+        return Response(status_code, response_headers, content)
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except (OSError, ssl.SSLError):
+            # The response was read, errors of closing the connection don't matter
+            pass
+
+
+async def http_request(
+    method, url, data=None, headers=None, cookies=None, timeout=None, cert=None, json_data=None
+):
+    """
+    Sends a HTTP request without blocking the event loop.
+
+    * @param str method 'GET' or 'POST'
+    * @param str url
+    * @param dict data (optional) POST data, sent URL encoded
+    * @param dict headers (optional)
+    * @param dict cookies (optional)
+    * @param int timeout (optional) Timeout in seconds for the whole request
+    * @param str cert (optional) Path to client certificate file
+    * @param dict json_data (optional) POST data, sent as JSON instead of data
+    * @return Response
+    """
+    return await asyncio.wait_for(
+        _http_request(method, url, data, json_data, headers, cookies, cert), timeout
+    )
+
+
+def _log_failure(task):
+    _background_tasks.discard(task)
+    if task.cancelled():
+        # E.g. the event loop of an async view run by async_to_sync was closed
+        logger.error("Sending Matomo tracking request was cancelled.")
+    elif task.exception() is not None:
+        logger.error("Sending Matomo tracking request failed.", exc_info=task.exception())
+
+
+def run_in_background(awaitable):
+    """
+    Schedules an awaitable on the running event loop without waiting for it.
+
+    Failures are logged.
+
+    * @param awaitable awaitable
+    * @return asyncio.Task
+    """
+    task = asyncio.ensure_future(awaitable)
+    _background_tasks.add(task)
+    task.add_done_callback(_log_failure)
+    return task
+
+
+class AsyncioTransport(Transport):
+    """
+    Sends tracking requests with the asyncio HTTP client, used by AsyncMatomo
+    trackers unless they have another transport. It only supports sending from
+    an event loop.
+    """
+
+    async def send_async(
+        self, method, url, data=None, headers=None, cookies=None, timeout=None, cert=None, **options
+    ):
+        return await http_request(
+            method, url, data=data, headers=headers, cookies=cookies, timeout=timeout, cert=cert
+        )
+
+    async def send_bulk_async(
+        self, url, data, headers=None, cookies=None, timeout=None, cert=None, **options
+    ):
+        return await http_request(
+            "POST",
+            url,
+            json_data=data,
+            headers=headers,
+            cookies=cookies,
+            timeout=timeout,
+            cert=cert,
+        )
+
+
+asyncio_transport = AsyncioTransport()
+
+
+class AsyncMatomo(matomo.Matomo):
+    """
+    Matomo tracker for asyncio applications.
+
+    Instead of sending requests synchronously, tracking methods schedule sends on
+    the running event loop and return the scheduled asyncio.Task, which can be
+    awaited to get the Response. Failed sends that are not awaited are logged.
+    Bulk tracking stores requests as usual.
+
+    Without a transport of its own, or one set on matomo.Matomo, the tracker
+    sends with AsyncioTransport. Transports without send_async() are called
+    synchronously and return their response instead of a task.
+
+    Scheduled sends are cancelled when their event loop is closed, so code that
+    closes it after a request, like Django's async_to_sync, waits for them with
+    wait_pending() first.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.pendingTasks = set()
+        super().__init__(*args, **kwargs)
+
+    def get_async_transport(self):
+        """
+        Returns the transport used for sending, AsyncioTransport instead of the
+        default blocking one.
+
+        * @return matomo.transport.Transport
+        """
+        if self.transport is default_transport:
+            return asyncio_transport
+        return self.transport
+
+    def send_request(self, url, method="GET", data=None, force=False):
+        if self.doBulkRequests and not force:
+            return super().send_request(url, method, data, force)
+        if not hasattr(self.get_async_transport(), "send_async"):
+            # E.g. a dispatcher, which queues hits and adds their cdt
+            return super().send_request(url, method, data, force)
+        task = run_in_background(self.send_request_async(url, method, data))
+        self.pendingTasks.add(task)
+        task.add_done_callback(self.pendingTasks.discard)
+        return task
+
+    async def wait_pending(self, timeout=None):
+        """
+        Waits for scheduled sends to finish. Their failures are logged.
+
+        * @param float timeout (optional) Maximum number of seconds to wait
+        """
+        if self.pendingTasks:
+            await asyncio.wait(list(self.pendingTasks), timeout=timeout)
+
+    async def send_request_async(self, url, method="GET", data=None):
+        """
+        Sends tracking request through the tracker's transport without blocking
+        the event loop, unless the transport doesn't support it.
+
+        * @return Response
+        """
+        transport = self.get_async_transport()
+        if not hasattr(transport, "send_async"):
+            return super().send_request(url, method, data, force=True)
+        if getattr(transport, "QUEUED", False) and not self.doBulkRequests:
+            url = self.add_capture_time(url)
+        method, url, data, headers, proxies, cookies = self.prepare_request(
+            url, method, data
+        )
+        options = {
+            "headers": headers,
+            "cookies": cookies,
+            "proxies": proxies,
+            "timeout": self.requestTimeout,
+            "cert": self.PATH_TO_CERTIFICATES_FILE,
+        }
+        if self.doBulkRequests:
+            return await transport.send_bulk_async(url, data, **options)
+        return await transport.send_async(method, url, data, **options)
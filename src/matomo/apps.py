@@ -0,0 +1,17 @@
+from django.apps import AppConfig
+
+
+class MatomoConfig(AppConfig):
+    """
+    Optional Django app. Add "matomo" to INSTALLED_APPS to read Matomo settings
+    and report missing configuration at startup and to use the outbox.
+    """
+
+    default_auto_field = "django.db.models.AutoField"
+    name = "matomo"
+    verbose_name = "Matomo"
+
+    def ready(self):
+        from matomo.django import load_settings
+
+        load_settings()
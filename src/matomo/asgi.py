@@ -0,0 +1,168 @@
+import functools
+import logging
+import re
+
+from matomo.aio import AsyncMatomo
+from matomo.lazy import LazyTracker, get_tracker
+from matomo.request import Request, format_set_cookie, parse_cookies
+
+
+logger = logging.getLogger(__name__)
+
+
+"""
+ASGI middleware for Starlette, FastAPI, async Django and other ASGI applications.
+
+Request data is read directly from the ASGI scope and tracking requests are sent
+from the event loop after the response body was sent.
+"""
+
+
+# Request headers read by the tracker
+TRACKED_HEADERS = {
+    b"accept-language": "HTTP_ACCEPT_LANGUAGE",
+    b"host": "HTTP_HOST",
+    b"referer": "HTTP_REFERER",
+    b"user-agent": "HTTP_USER_AGENT",
+    b"sec-ch-ua-model": "HTTP_SEC_CH_UA_MODEL",
+    b"sec-ch-ua-platform": "HTTP_SEC_CH_UA_PLATFORM",
+    b"sec-ch-ua-platform-version": "HTTP_SEC_CH_UA_PLATFORM_VERSION",
+    b"sec-ch-ua-full-version-list": "HTTP_SEC_CH_UA_FULL_VERSION_LIST",
+    b"sec-ch-ua-full-version": "HTTP_SEC_CH_UA_FULL_VERSION",
+}
+
+
+class ScopeRequest(Request):
+    """
+    Request data derived from an ASGI HTTP scope.
+    """
+
+    def __init__(self, scope):
+        data = {}
+        cookie_header = ""
+        for name, value in scope.get("headers", ()):
+            if name == b"cookie":
+                cookie_header = value.decode("latin-1")
+            elif name in TRACKED_HEADERS:
+                data[TRACKED_HEADERS[name]] = value.decode("latin-1")
+
+        data["HTTPS"] = scope.get("scheme") == "https"
+        data["QUERY_STRING"] = scope.get("query_string", b"").decode("latin-1")
+        data["PATH_INFO"] = scope.get("path", "")
+        data["REQUEST_URI"] = scope.get("path", "")
+        data["SCRIPT_NAME"] = scope.get("root_path", "")
+        if scope.get("client"):
+            data["REMOTE_ADDR"] = scope["client"][0]
+
+        super().__init__(data)
+        self.cookie = parse_cookies(cookie_header) if cookie_header else {}
+
+
+class Matomo(AsyncMatomo):
+    """
+    Asynchronous tracker for ASGI applications.
+
+    Its response is the ASGI 'http.response.start' message and cookies are
+    added to its headers.
+    """
+
+    def set_response(self, response):
+        self.response = response
+        self.set_first_party_cookies()
+
+    def set_cookie_response(
+        self,
+        cookie_name,
+        cookie_value,
+        max_age=None,
+        path="/",
+        domain=None,
+        secure=False,
+        httponly=False,
+        samesite=None,
+    ):
+        if self.response is None:
+            logger.warning("No response instance set to set cookies on.")
+            return
+        cookie = format_set_cookie(
+            cookie_name,
+            cookie_value,
+            max_age=max_age,
+            path=path,
+            domain=domain,
+            secure=secure,
+            httponly=httponly,
+            samesite=samesite,
+        )
+        self.response["headers"].append((b"set-cookie", cookie.encode("latin-1")))
+
+
+class MatomoMiddleware:
+    """
+    Matomo ASGI middleware
+
+    It stores a lazily created tracker in scope["matomo"] (request.scope["matomo"]
+    in Starlette and FastAPI). The tracker is built only when the application
+    uses it and records tracking requests in bulk mode. First party cookies are
+    added to the response headers and recorded requests are sent in bulk from the
+    event loop after the response body was sent.
+
+    Page views of paths matching any of track_paths regular expressions are
+    tracked automatically for responses with status codes below 400.
+
+    * @param app ASGI application
+    * @param int id_site
+    * @param str api_url
+    * @param list track_paths (optional) Regular expressions of automatically tracked paths
+    * @param type tracker_class (optional) Tracker class
+    """
+
+    def __init__(self, app, id_site, api_url, track_paths=(), tracker_class=Matomo):
+        self.app = app
+        self.id_site = id_site
+        self.api_url = api_url
+        self.track_paths = [re.compile(pattern) for pattern in track_paths]
+        self.tracker_class = tracker_class
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        lazy_tracker = LazyTracker(functools.partial(self.create_tracker, scope))
+        scope = dict(scope, matomo=lazy_tracker)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message = self.finalize_tracker(scope, lazy_tracker, message)
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+        tracker = get_tracker(lazy_tracker)
+        if tracker is not None and tracker.storedTrackingActions:
+            # Scheduled on the event loop, or queued by the tracker's transport
+            try:
+                tracker.do_bulk_track()
+            except Exception:
+                logger.exception("Sending Matomo tracking requests failed.")
+
+    def create_tracker(self, scope):
+        tracker = self.tracker_class(ScopeRequest(scope), self.id_site, self.api_url)
+        tracker.enable_bulk_tracking()
+        return tracker
+
+    def is_tracked_path(self, path):
+        return any(pattern.search(path) for pattern in self.track_paths)
+
+    def finalize_tracker(self, scope, lazy_tracker, message):
+        if message["status"] < 400 and self.is_tracked_path(scope.get("path", "")):
+            lazy_tracker.do_track_page_view("")
+
+        tracker = get_tracker(lazy_tracker)
+        if tracker is None:
+            return message
+
+        message = dict(message, headers=list(message.get("headers", ())))
+        tracker.set_response(message)
+        return message
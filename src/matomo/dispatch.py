@@ -0,0 +1,638 @@
+import logging
+import queue
+import threading
+import time
+
+from matomo.transport import (
+    HitFuture,
+    Transport,
+    default_transport,
+    hit_query,
+    register_after_fork,
+    resolve_bulk,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Queued sending of tracking requests from a background thread.
+
+Dispatcher is a transport that puts hits into a queue and returns immediately.
+A worker thread takes them from the queue and sends them with another transport
+in bulk requests:
+
+    import matomo
+    from matomo.dispatch import Dispatcher
+
+    matomo.Matomo.transport = Dispatcher(batch_size=100, flush_interval=1)
+
+With deferred serialization enabled on trackers, see
+MatomoTracker.enable_deferred_serialization(), dispatchers queue snapshots of
+trackers' state and the worker thread builds the hits' URLs.
+
+Dispatchers are fork safe: a forked child starts with an empty queue and its own
+worker thread, while hits queued before the fork are sent by the parent. This
+makes them usable with servers that preload the application, like Gunicorn with
+--preload.
+"""
+
+
+# Tells the worker thread to stop
+_STOP = object()
+
+
+def serialize(hit):
+    """
+    Returns hit record of a queued hit.
+
+    * @param str|matomo.tracker.DeferredUrl hit
+    * @return str
+    """
+    if isinstance(hit, str):
+        return hit
+    return hit_query(str(hit))
+
+
+class Dispatcher(Transport):
+    """
+    Queues tracking requests and sends them in bulk requests from a worker thread.
+
+    Tracking methods return a matomo.transport.HitFuture, a 202 response for
+    queued hits resolved when their bulk request is acknowledged and 503 for hits
+    dropped because the queue is full. token_auth is added to bulk requests.
+
+    Failed bulk requests are retried with a doubling delay, starting at
+    flush_interval. Hits of requests that failed after all retries are appended to
+    the spill file, from which `python -m matomo.agent --spool` sends them later.
+
+    * @param matomo.transport.Transport transport (optional) Transport of bulk requests
+    * @param int batch_size (optional) Maximum number of hits in a bulk request
+    * @param float flush_interval (optional) Seconds to wait for a batch to fill up
+    * @param int max_queue_size (optional) Maximum number of queued hits
+    * @param str token_auth (optional) Sent with bulk requests
+    * @param int timeout (optional) Timeout of bulk requests in seconds
+    * @param str shed (optional) Hits shed when the queue is full: 'newest' drops
+        the new hit, 'oldest' the oldest queued one and 'never' waits for room
+    * @param float put_timeout (optional) Seconds 'never' waits for room before
+        dropping the hit, None waits as long as it takes
+    * @param int retries (optional) Number of times a failed bulk request is retried
+    * @param str spill_path (optional) File for hits whose bulk request failed
+    """
+
+    QUEUED = True
+
+    SHED_POLICIES = ("newest", "oldest", "never")
+
+    def __init__(
+        self,
+        transport=default_transport,
+        batch_size=100,
+        flush_interval=1.0,
+        max_queue_size=10000,
+        token_auth="",
+        timeout=10,
+        shed="newest",
+        put_timeout=None,
+        retries=0,
+        spill_path=None,
+    ):
+        if shed not in self.SHED_POLICIES:
+            raise Exception(f"Unknown shedding policy: {shed}")
+        self.transport = transport
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self.token_auth = token_auth
+        self.timeout = timeout
+        self.shed = shed
+        self.put_timeout = put_timeout
+        self.retries = retries
+        self.spill_path = spill_path
+        self.reset_after_fork()
+        register_after_fork(self)
+
+    def reset_after_fork(self):
+        # Queued hits belong to the parent, which sends them
+        self.queue = queue.Queue(self.max_queue_size)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.accepting = True
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.spilled = 0
+        # Hits taken from the queue and not sent yet
+        self.in_flight = 0
+
+    def start(self):
+        """
+        Starts the worker thread if it isn't running.
+        """
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(
+                    target=self.run, name="matomo-dispatcher", daemon=True
+                )
+                self.thread.start()
+
+    def put(self, url, hit):
+        """
+        Queues a hit.
+
+        * @param str url Tracking endpoint
+        * @param str|matomo.tracker.DeferredUrl hit Hit record, see
+            matomo.transport.hit_query(), or URL built when it is sent
+        * @return matomo.transport.HitFuture With status code 503 when the queue is
+            full or the dispatcher doesn't accept hits anymore and the hit was dropped
+        """
+        if not self.accepting:
+            self.dropped += 1
+            return HitFuture(503)
+        if self.thread is None:
+            self.start()
+        future = HitFuture()
+        item = (url, hit, future)
+        if self.shed == "never":
+            try:
+                self.queue.put(item, timeout=self.put_timeout)
+                return future
+            except queue.Full:
+                self.dropped += 1
+                return HitFuture(503)
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return future
+            except queue.Full:
+                if self.shed == "newest" or not self.evict_oldest():
+                    self.dropped += 1
+                    return HitFuture(503)
+
+    def evict_oldest(self):
+        """
+        Drops the oldest queued hit.
+
+        * @return bool False when there was none to drop
+        """
+        with self.queue.mutex:
+            items = self.queue.queue
+            # Hits queued after closing can't make room
+            if not items or items[0] is _STOP:
+                return False
+            _, _, future = items.popleft()
+            self.queue.unfinished_tasks -= 1
+            self.queue.not_full.notify()
+        self.dropped += 1
+        future.set_result(False)
+        return True
+
+    def send(self, method, url, data=None, headers=None, **options):
+        return self.put(url.split("?", 1)[0], hit_query(url, data, headers))
+
+    def send_deferred(self, url):
+        """
+        Queues a hit whose URL is built by the worker thread.
+
+        * @param matomo.tracker.DeferredUrl url With user agent and browser language
+        * @return matomo.transport.HitFuture
+        """
+        return self.put(url.snapshot.base_url.split("?", 1)[0], url)
+
+    def send_bulk(self, url, data, **options):
+        futures = [self.put(url, hit_query(action)) for action in data["requests"]]
+        return HitFuture.combine(futures)
+
+    def next_batch(self):
+        """
+        Waits for the next batch of hits.
+
+        * @return tuple (batch, stop) List of (url, hit, future) tuples and whether the
+            worker thread should stop after sending it
+        """
+        batch = []
+        deadline = None
+        while len(batch) < self.batch_size:
+            try:
+                if deadline is None:
+                    item = self.queue.get()
+                    deadline = time.monotonic() + self.flush_interval
+                else:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if item is _STOP:
+                self.queue.task_done()
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def send_batch(self, batch):
+        """
+        Sends a batch of hits in one bulk request per tracking endpoint and
+        resolves their futures.
+
+        * @param list batch List of (url, hit, future) tuples
+        """
+        endpoints = {}
+        for url, hit, future in batch:
+            try:
+                hit = serialize(hit)
+            except Exception:
+                logger.exception("Building Matomo tracking request failed.")
+                with self.lock:
+                    self.failed += 1
+                    self.in_flight -= 1
+                future.set_result(False)
+                continue
+            hits, futures = endpoints.setdefault(url, ([], []))
+            hits.append(hit)
+            futures.append(future)
+        for url, (hits, futures) in endpoints.items():
+            data = {"requests": hits}
+            if self.token_auth:
+                data["token_auth"] = self.token_auth
+            response = self.post(url, data)
+            resolve_bulk(futures, response)
+            spilled = 0
+            if response is None or not response.ok:
+                spilled = self.spill(hits)
+            with self.lock:
+                if response is not None and response.ok:
+                    self.sent += len(hits)
+                else:
+                    self.failed += len(hits) - spilled
+                    self.spilled += spilled
+                self.in_flight -= len(hits)
+
+    def post(self, url, data):
+        """
+        Sends a bulk request, retrying it when it fails.
+
+        * @param str url Tracking endpoint
+        * @param dict data
+        * @return matomo.transport.Response|None Last response, None if sending raised
+        """
+        response = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(min(self.flush_interval * 2 ** (attempt - 1), 30))
+            try:
+                response = self.transport.send_bulk(url, data, timeout=self.timeout)
+            except Exception:
+                logger.exception("Sending Matomo bulk request failed.")
+                response = None
+            if response is not None and response.ok:
+                break
+        return response
+
+    def spill(self, hits):
+        """
+        Appends hit records to the spill file.
+
+        * @param list hits
+        * @return int Number of written hits, 0 without spill file
+        """
+        if not self.spill_path:
+            return 0
+        try:
+            with open(self.spill_path, "a", encoding="utf-8") as spill:
+                spill.writelines(hit + "\n" for hit in hits)
+        except OSError:
+            logger.exception("Writing Matomo spill file failed.")
+            return 0
+        return len(hits)
+
+    def run(self):
+        """
+        Worker thread's loop.
+        """
+        stop = False
+        while not stop:
+            batch, stop = self.next_batch()
+            with self.lock:
+                self.in_flight = len(batch)
+            try:
+                if batch:
+                    self.send_batch(batch)
+            finally:
+                with self.lock:
+                    self.in_flight = 0
+                for _ in batch:
+                    self.queue.task_done()
+
+    def counts(self):
+        """
+        Returns numbers of sent, failed, spilled and in flight hits taken together,
+        so a hit whose bulk request just finished is counted once.
+
+        * @return tuple (sent, failed, spilled, in_flight)
+        """
+        with self.lock:
+            return self.sent, self.failed, self.spilled, self.in_flight
+
+    def flush(self, timeout=None):
+        """
+        Waits until queued hits were sent.
+
+        * @param float timeout (optional) Maximum number of seconds to wait
+        * @return bool Whether all hits were sent
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.queue.unfinished_tasks:
+            if self.thread is None or not self.thread.is_alive():
+                return False
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.005)
+        return True
+
+    def drain(self):
+        """
+        Removes hits that are still queued. Their futures are resolved as not
+        delivered. A worker thread told to stop still stops after the hit it is
+        sending.
+
+        * @return list List of (url, hit) tuples
+        """
+        hits = []
+        stopping = False
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            self.queue.task_done()
+            if item is _STOP:
+                stopping = True
+                continue
+            url, hit, future = item
+            future.set_result(False)
+            hits.append((url, serialize(hit)))
+        if stopping:
+            self.queue.put_nowait(_STOP)
+        return hits
+
+    def stop(self, timeout=None):
+        """
+        Tells the worker thread to stop after sending queued hits.
+
+        * @param float timeout (optional) Maximum number of seconds to wait for room
+            in a full queue
+        * @return bool False when the queue stayed full
+        """
+        thread = self.thread
+        if thread is not None and thread.is_alive():
+            try:
+                self.queue.put(_STOP, timeout=timeout)
+            except queue.Full:
+                return False
+        return True
+
+    def join(self, timeout=None):
+        """
+        Waits for the worker thread to stop.
+
+        * @param float timeout (optional) Maximum number of seconds to wait
+        * @return bool Whether the worker thread stopped
+        """
+        thread = self.thread
+        if thread is not None:
+            thread.join(timeout)
+            if thread.is_alive():
+                return False
+        self.thread = None
+        return True
+
+    def close(self, timeout=None):
+        """
+        Sends queued hits and stops the worker thread. The transport is closed
+        only if the worker thread stopped within timeout, as it may still be
+        sending otherwise.
+
+        * @param float timeout (optional) Maximum number of seconds to wait
+        * @return bool Whether the worker thread stopped
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self.stop(timeout)
+        if not self.join(None if deadline is None else max(deadline - time.monotonic(), 0)):
+            return False
+        self.transport.close()
+        return True
+
+
+# Parameters added by tracker's get_url_track_*() methods and do_ping() and lanes
+# of hits with them. Other hits (page views, content, site searches, downloads and
+# outlinks) go to the "default" lane.
+HIT_LANES = (
+    ("&idgoal=", "revenue"),  # get_url_track_goal() and get_url_track_ecommerce_*()
+    ("&e_c=", "event"),  # get_url_track_event()
+    ("&ping=1", "ping"),  # do_ping()
+)
+
+
+def classify_hit(hit):
+    """
+    Returns name of the lane of a hit.
+
+    * @param str hit Hit record, URL or parameters appended to a DeferredUrl
+    * @return str 'revenue', 'event', 'ping' or 'default'
+    """
+    for parameter, lane in HIT_LANES:
+        if parameter in hit:
+            return lane
+    return "default"
+
+
+def default_lanes(transport=default_transport, token_auth="", timeout=10, spill_path=None):
+    """
+    Returns dispatchers of lanes for PriorityDispatcher: revenue hits are sent
+    within 0.1 seconds, page views and others within a second, events within 2 and
+    pings within 5 seconds, dropping the oldest ones when their queues are full.
+
+    Tracking of revenue hits waits up to a second for room in their full queue and
+    their failed bulk requests are retried three times before their hits are
+    spilled to spill_path.
+
+    * @param matomo.transport.Transport transport (optional) Transport of bulk requests
+    * @param str token_auth (optional) Sent with bulk requests
+    * @param int timeout (optional) Timeout of bulk requests in seconds
+    * @param str spill_path (optional) File for revenue hits that couldn't be sent
+    * @return dict Dispatchers by lane name, in order of priority
+    """
+    options = {"token_auth": token_auth, "timeout": timeout}
+    return {
+        "revenue": Dispatcher(
+            transport,
+            flush_interval=0.1,
+            max_queue_size=10000,
+            shed="never",
+            put_timeout=1.0,
+            retries=3,
+            spill_path=spill_path,
+            **options,
+        ),
+        "default": Dispatcher(transport, flush_interval=1.0, max_queue_size=10000, **options),
+        "event": Dispatcher(
+            transport,
+            batch_size=500,
+            flush_interval=2.0,
+            max_queue_size=10000,
+            shed="oldest",
+            **options,
+        ),
+        "ping": Dispatcher(
+            transport,
+            batch_size=500,
+            flush_interval=5.0,
+            max_queue_size=1000,
+            shed="oldest",
+            **options,
+        ),
+    }
+
+
+class PriorityDispatcher(Transport):
+    """
+    Queues hits in lanes by their type, each a Dispatcher with its own queue size,
+    flush interval and shedding policy, so pings and events can't delay or push
+    out ecommerce and goal hits.
+
+    * @param dict lanes (optional) Dispatchers by lane name in order of priority, see
+        default_lanes(); hits of lanes that are missing go to the "default" lane
+    * @param callable classify (optional) Returns lane name of a hit, see classify_hit()
+    * @param matomo.transport.Transport transport (optional) Transport of default lanes
+    * @param str token_auth (optional) Sent with bulk requests of default lanes
+    * @param int timeout (optional) Timeout of bulk requests of default lanes
+    * @param str spill_path (optional) Spill file of the default revenue lane
+    """
+
+    QUEUED = True
+
+    def __init__(
+        self,
+        lanes=None,
+        classify=classify_hit,
+        transport=default_transport,
+        token_auth="",
+        timeout=10,
+        spill_path=None,
+    ):
+        if lanes is None:
+            lanes = default_lanes(transport, token_auth, timeout, spill_path)
+        if "default" not in lanes:
+            raise Exception('PriorityDispatcher requires a "default" lane')
+        self.lanes = lanes
+        self.classify = classify
+
+    def lane(self, hit):
+        """
+        * @param str hit Hit record, URL or parameters appended to a DeferredUrl
+        * @return Dispatcher Dispatcher of the hit's lane
+        """
+        return self.lanes.get(self.classify(hit)) or self.lanes["default"]
+
+    @property
+    def accepting(self):
+        return all(lane.accepting for lane in self.lanes.values())
+
+    @accepting.setter
+    def accepting(self, accepting):
+        for lane in self.lanes.values():
+            lane.accepting = accepting
+
+    @property
+    def sent(self):
+        return sum(lane.sent for lane in self.lanes.values())
+
+    @property
+    def failed(self):
+        return sum(lane.failed for lane in self.lanes.values())
+
+    @property
+    def dropped(self):
+        return sum(lane.dropped for lane in self.lanes.values())
+
+    @property
+    def spilled(self):
+        return sum(lane.spilled for lane in self.lanes.values())
+
+    @property
+    def in_flight(self):
+        return sum(lane.in_flight for lane in self.lanes.values())
+
+    def counts(self):
+        """
+        Returns numbers of sent, failed, spilled and in flight hits of all lanes,
+        see Dispatcher.counts().
+
+        * @return tuple (sent, failed, spilled, in_flight)
+        """
+        counts = [lane.counts() for lane in self.lanes.values()]
+        return tuple(sum(values) for values in zip(*counts))
+
+    def send(self, method, url, data=None, headers=None, **options):
+        hit = hit_query(url, data, headers)
+        return self.lane(hit).put(url.split("?", 1)[0], hit)
+
+    def send_deferred(self, url):
+        return self.lane(url.suffix).send_deferred(url)
+
+    def send_bulk(self, url, data, **options):
+        futures = []
+        for action in data["requests"]:
+            hit = hit_query(action)
+            futures.append(self.lane(hit).put(url, hit))
+        return HitFuture.combine(futures)
+
+    def flush(self, timeout=None):
+        """
+        Waits until queued hits of all lanes were sent.
+
+        * @param float timeout (optional) Maximum number of seconds to wait
+        * @return bool Whether all hits were sent
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        flushed = True
+        for lane in self.lanes.values():
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            flushed = lane.flush(remaining) and flushed
+        return flushed
+
+    def drain(self):
+        """
+        Removes hits that are still queued in all lanes.
+
+        * @return list List of (url, hit) tuples
+        """
+        return [hit for lane in self.lanes.values() for hit in lane.drain()]
+
+    def close(self, timeout=None):
+        """
+        Sends queued hits and stops worker threads of all lanes. Lanes send their
+        hits concurrently and are waited for in order of priority. A transport is
+        closed only if all lanes using it stopped within timeout.
+
+        * @param float timeout (optional) Maximum number of seconds to wait
+        * @return bool Whether worker threads of all lanes stopped
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def remaining():
+            return None if deadline is None else max(deadline - time.monotonic(), 0)
+
+        for lane in self.lanes.values():
+            lane.stop(remaining())
+        stopped = [lane.join(remaining()) for lane in self.lanes.values()]
+        transports = []
+        busy = [lane.transport for lane, done in zip(self.lanes.values(), stopped) if not done]
+        for lane in self.lanes.values():
+            # Lanes usually share their transport
+            transport = lane.transport
+            if any(transport is other for other in transports + busy):
+                continue
+            transports.append(transport)
+        for transport in transports:
+            transport.close()
+        return all(stopped)
@@ -1,24 +1,122 @@
-import collections
+import collections.abc
+import contextvars
+import functools
 import logging
+import re
+
+from django.core.signals import setting_changed
 
 import matomo
+import matomo.aio
+from matomo.lazy import LazyTracker, get_tracker
+from matomo.transport import HitFuture
 
 
 logger = logging.getLogger(__name__)
 
 
-class Request(collections.UserDict):
-    def __init__(self, request):
-        data = request.META.copy()
-        data["HTTPS"] = request.scheme == "https"
-        data["REQUEST_URI"] = request.path
-        data["PATH_INFO"] = request.path_info
+MatomoSettings = collections.namedtuple(
+    "MatomoSettings", ["site_id", "tracking_api_url", "track_paths", "outbox"]
+)
+
+_settings = None
+_misconfiguration_reported = False
+# Tracker of the request handled by MatomoMiddleware
+_request_tracker = contextvars.ContextVar("matomo_request_tracker", default=None)
+
+
+def load_settings():
+    """
+    Reads Matomo configuration from Django's settings and caches it.
+
+    Called once when the matomo app is ready (or on first use if it is not in
+    INSTALLED_APPS) and again whenever a MATOMO_* setting changes.
+    Missing configuration is reported only once per process.
+
+    * @return MatomoSettings
+    """
+    global _settings, _misconfiguration_reported
+    # Somewhat indirect way of fetching params because of pdoc
+    from django.conf import settings
+
+    _settings = MatomoSettings(
+        getattr(settings, "MATOMO_SITE_ID", 0),
+        getattr(settings, "MATOMO_TRACKING_API_URL", ""),
+        [re.compile(pattern) for pattern in getattr(settings, "MATOMO_TRACK_PATHS", [])],
+        getattr(settings, "MATOMO_OUTBOX", False),
+    )
+    if not (_settings.site_id and _settings.tracking_api_url):
+        if not _misconfiguration_reported:
+            logger.warning("MATOMO_SITE_ID or MATOMO_TRACKING_API_URL not set.")
+            _misconfiguration_reported = True
+    else:
+        _misconfiguration_reported = False
+    if _settings.outbox:
+        # Stored hits wait for the matomo_send_outbox command
+        matomo.check_capture_time_window(
+            "MATOMO_OUTBOX", getattr(settings, "MATOMO_TOKEN_AUTH", "")
+        )
+    return _settings
+
+
+def get_settings():
+    """
+    Returns cached Matomo configuration.
+
+    * @return MatomoSettings
+    """
+    if _settings is None:
+        return load_settings()
+    return _settings
+
+
+def _reload_settings(setting, **kwargs):
+    if setting.startswith("MATOMO_"):
+        load_settings()
+
+
+setting_changed.connect(_reload_settings)
+
+
+class Request(collections.abc.Mapping):
+    """
+    Read-only view of Django's request usable as tracker's request.
+
+    Values are read from request.META and cookies from request.COOKIES without
+    copying them. HTTPS, REQUEST_URI, PATH_INFO and SCRIPT_NAME are computed on
+    demand from the request.
+    """
+
+    COMPUTED = {
+        "HTTPS": lambda request: request.scheme == "https",
+        "REQUEST_URI": lambda request: request.path,
+        "PATH_INFO": lambda request: request.path_info,
         # Doesn't exist in Django and will be set to path info
-        data["SCRIPT_NAME"] = ""
+        "SCRIPT_NAME": lambda request: "",
+    }
+
+    def __init__(self, request):
+        self.request = request
+        self.cookie = request.COOKIES
+
+    def __getitem__(self, key):
+        if key in self.COMPUTED:
+            return self.COMPUTED[key](self.request)
+        return self.request.META[key]
+
+    def __contains__(self, key):
+        return key in self.COMPUTED or key in self.request.META
 
-        self.cookie = request.COOKIES.copy()
+    def __iter__(self):
+        yield from self.COMPUTED
+        for key in self.request.META:
+            if key not in self.COMPUTED:
+                yield key
 
-        super().__init__(data)
+    def __len__(self):
+        return len(self.COMPUTED) + sum(
+            1 for key in self.request.META if key not in self.COMPUTED
+        )
 
 
 class Matomo(matomo.Matomo):
@@ -27,24 +125,30 @@ class Matomo(matomo.Matomo):
 
     This class will correctly read configuration values from provided Django's
     request instance including cookies.
+
+    When the MATOMO_OUTBOX setting is enabled, tracking requests are stored as
+    OutboxHit rows in the current database transaction instead of being sent and
+    are later sent in bulk by the matomo_send_outbox management command. This
+    requires "matomo" in INSTALLED_APPS. Stored hits are returned as accepted
+    HitFuture instances, like hits stored in bulk mode, which stay unresolved
+    because the outbox is sent by another process.
     """
 
+    USE_OUTBOX = True
+
     def __init__(self, request):
         req = Request(request)
-        site_id, tracking_url = self.__get_matomo_params()
-        if site_id and tracking_url:
-            super().__init__(req, site_id, tracking_url)
-        else:
-            logger.warning("MATOMO_SITE_ID or MATOMO_TRACKING_API_URL not set.")
-            print("MATOMO_SITE_ID or MATOMO_TRACKING_API_URL not set.")
+        settings = get_settings()
+        if settings.site_id and settings.tracking_api_url:
+            super().__init__(req, settings.site_id, settings.tracking_api_url)
 
-    def __get_matomo_params(self):
-        # Somewhat indirect way of fetching params because of pdoc
-        from django.conf import settings
+    def send_request(self, url, method="GET", data=None, force=False):
+        if self.USE_OUTBOX and get_settings().outbox and not force:
+            from matomo.models import OutboxHit
 
-        MATOMO_SITE_ID = getattr(settings, "MATOMO_SITE_ID", 0)
-        MATOMO_TRACKING_API_URL = getattr(settings, "MATOMO_TRACKING_API_URL", "")
-        return MATOMO_SITE_ID, MATOMO_TRACKING_API_URL
+            OutboxHit.objects.create(url=str(self.get_bulk_tracking_action(url)))
+            return HitFuture()
+        return super().send_request(url, method, data, force)
 
     def set_response(self, response):
         self.response = response
@@ -92,21 +196,146 @@ class Matomo(matomo.Matomo):
             logger.warning("No response instance set to set cookies on.")
 
 
+class AsyncMatomo(matomo.aio.AsyncMatomo, Matomo):
+    """
+    Asynchronous variant of Django tracker for async views.
+
+    Tracking methods schedule sends on the running event loop and return the
+    scheduled asyncio.Task that can be awaited. The outbox is not used, because
+    database queries can't be made from the event loop.
+    """
+
+    USE_OUTBOX = False
+
+
 class MatomoMixin:
     """
     Matomo Django mixin
 
-    It will build a Matomo tracker based on values read from incoming request
-    and store it on self.matomo.
+    It will store a Matomo tracker based on values read from incoming request
+    on self.matomo. The tracker is created on first use and first party cookies
+    are set only on responses of views that used it.
+
+    Views with async handlers get an AsyncMatomo tracker whose sends are
+    scheduled on the running event loop instead of blocking it. They are waited
+    for before the response is returned, because under WSGI the event loop is
+    closed when the view returns.
 
-    WARNING: All calls to Matomo servers are synchronous and can thus noticeably
-        impact the response time of views that make them.
+    WARNING: Unless MatomoMiddleware is used or the view is async, all calls to
+        Matomo servers are synchronous and can thus noticeably impact the
+        response time of views that make them.
     """
 
     matomo = None
 
     def dispatch(self, request, *args, **kwargs):
-        self.matomo = Matomo(request)
+        if getattr(self, "view_is_async", False):
+            return self.dispatch_async(request, *args, **kwargs)
+
+        self.set_tracker(request, Matomo)
         response = super().dispatch(request, *args, **kwargs)
-        self.matomo.set_response(response)
+        self.finalize_tracker(response)
+        return response
+
+    async def dispatch_async(self, request, *args, **kwargs):
+        self.set_tracker(request, AsyncMatomo)
+        response = await super().dispatch(request, *args, **kwargs)
+        self.finalize_tracker(response)
+        tracker = get_tracker(self.matomo)
+        if isinstance(tracker, AsyncMatomo):
+            # Under WSGI the view's event loop is closed when it returns, which
+            # would cancel sends that are still running
+            await tracker.wait_pending(tracker.requestTimeout)
         return response
+
+    def set_tracker(self, request, tracker_class):
+        # Reuse the tracker created by MatomoMiddleware so hits are sent after the response
+        self.matomo = getattr(request, "matomo", None) or LazyTracker(
+            functools.partial(tracker_class, request)
+        )
+
+    def finalize_tracker(self, response):
+        tracker = get_tracker(self.matomo)
+        if tracker is not None:
+            tracker.set_response(response)
+
+
+def get_request_tracker():
+    """
+    Returns the tracker of the request currently handled by MatomoMiddleware.
+
+    * @return LazyTracker|None
+    """
+    return _request_tracker.get()
+
+
+def send_deferred_requests(tracker):
+    """
+    Sends tracking requests stored by a tracker in bulk mode. Errors are logged
+    and not raised because the response has already been sent.
+    """
+    if not tracker.storedTrackingActions:
+        return
+    try:
+        tracker.do_bulk_track()
+    except Exception:
+        logger.exception("Sending deferred Matomo tracking requests failed.")
+
+
+class MatomoMiddleware:
+    """
+    Matomo Django middleware
+
+    It stores a lazily created Matomo tracker on request.matomo. The tracker is
+    built only if a view uses it and it records tracking requests instead of
+    sending them. Recorded requests are sent in bulk after the response was sent
+    to the client (when Django closes the response), so views don't wait for
+    Matomo servers.
+
+    Page views of paths matching any of regular expressions in the
+    MATOMO_TRACK_PATHS setting are tracked automatically for responses with status
+    codes below 400.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.matomo = LazyTracker(functools.partial(self.create_tracker, request))
+        token = _request_tracker.set(request.matomo)
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_tracker.reset(token)
+
+        settings = get_settings()
+        # Trackers can't be built without configuration, a warning is logged once
+        configured = settings.site_id and settings.tracking_api_url
+        if configured and response.status_code < 400 and self.is_tracked_path(request.path_info):
+            request.matomo.do_track_page_view("")
+
+        tracker = get_tracker(request.matomo)
+        if tracker is not None:
+            tracker.set_response(response)
+            if tracker.storedTrackingActions:
+                self.send_after_response(tracker, response)
+        return response
+
+    def create_tracker(self, request):
+        tracker = Matomo(request)
+        tracker.enable_bulk_tracking()
+        return tracker
+
+    def is_tracked_path(self, path):
+        return any(pattern.search(path) for pattern in get_settings().track_paths)
+
+    def send_after_response(self, tracker, response):
+        close = response.close
+
+        def close_and_send():
+            try:
+                close()
+            finally:
+                send_deferred_requests(tracker)
+
+        response.close = close_and_send
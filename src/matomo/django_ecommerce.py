@@ -0,0 +1,282 @@
+import collections
+import copy
+import decimal
+import functools
+import logging
+import threading
+import weakref
+
+from django.db import connections, transaction
+from django.db.models.signals import post_save
+
+import matomo
+from matomo.django import get_request_tracker, get_settings
+from matomo.request import Request
+
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Ecommerce order tracking from Django model signals.
+
+Order models are registered with a mapping of their fields to order and item
+values. Saved orders are collected per database transaction and tracked with one
+bulk request after the transaction is committed, so orders of rolled back
+transactions are never tracked and views don't need any tracking code. Orders
+saved during requests handled by MatomoMiddleware are tracked with the request's
+visitor, cookies and user agent.
+
+Example:
+
+    register_order_model(
+        Order,
+        {"order_id": "number", "grand_total": "total", "shipping": "shipping_cost"},
+        items="lines",
+        item_fields={"sku": "product.sku", "name": "product.name", "price": "price"},
+        user_id="customer.email",
+    )
+"""
+
+
+ORDER_FIELDS = ("order_id", "grand_total", "sub_total", "tax", "shipping", "discount")
+ITEM_FIELDS = ("sku", "name", "category", "price", "quantity")
+
+OrderRegistration = collections.namedtuple(
+    "OrderRegistration",
+    ["model", "fields", "items", "item_fields", "visitor_id", "user_id", "condition"],
+)
+
+_registry = {}
+# Weak references to orders collected in the current transaction of each
+# database, per thread. Rolled back transactions drop their on_commit callbacks
+# and with them the batch.
+_batches = threading.local()
+
+
+def get_value(instance, path):
+    """
+    Returns value of a mapped field.
+
+    * @param instance Model instance
+    * @param str|callable path Dotted attribute path or callable taking the instance
+    * @return mixed
+    """
+    if callable(path):
+        return path(instance)
+    return functools.reduce(getattr, path.split("."), instance)
+
+
+def _amount(value):
+    # Tracker accepts floats and ints, DecimalField values are converted
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    return value
+
+
+def _dispatch_uid(model):
+    return f"matomo-order-{model._meta.label}"
+
+
+def _created(instance, created):
+    return created
+
+
+def register_order_model(
+    model,
+    fields,
+    items=None,
+    item_fields=None,
+    visitor_id=None,
+    user_id=None,
+    condition=_created,
+):
+    """
+    Tracks saved instances of model as ecommerce orders.
+
+    Values are read when the transaction is committed, so items saved after the
+    order in the same transaction are included.
+
+    * @param type model Order model
+    * @param dict fields Maps do_track_ecommerce_order() arguments (order_id and
+        grand_total are required) to dotted attribute paths or callables
+    * @param str|callable items (optional) Path of order items, e.g. a related manager
+    * @param dict item_fields (optional) Maps add_ecommerce_item() arguments (sku is
+        required) to paths or callables of an item
+    * @param str|callable visitor_id (optional) Path of 16 hex characters visitor ID
+    * @param str|callable user_id (optional) Path of User ID
+    * @param callable condition (optional) Called with instance and created flag,
+        decides whether the save is tracked. By default only created orders are.
+    """
+    missing = {"order_id", "grand_total"} - set(fields)
+    if missing:
+        raise Exception(f"Order fields mapping is missing: {', '.join(sorted(missing))}")
+    unknown = set(fields) - set(ORDER_FIELDS)
+    if unknown:
+        raise Exception(f"Unknown order fields: {', '.join(sorted(unknown))}")
+    if items is not None and "sku" not in (item_fields or {}):
+        raise Exception("Item fields mapping is missing: sku")
+    unknown = set(item_fields or ()) - set(ITEM_FIELDS)
+    if unknown:
+        raise Exception(f"Unknown item fields: {', '.join(sorted(unknown))}")
+
+    _registry[model] = OrderRegistration(
+        model, fields, items, item_fields or {}, visitor_id, user_id, condition
+    )
+    post_save.connect(_order_saved, sender=model, dispatch_uid=_dispatch_uid(model))
+
+
+def unregister_order_model(model):
+    """
+    Stops tracking of model's orders.
+
+    * @param type model
+    """
+    post_save.disconnect(sender=model, dispatch_uid=_dispatch_uid(model))
+    _registry.pop(model, None)
+
+
+def _create_tracker(settings, request_tracker=None):
+    if request_tracker is None:
+        tracker = matomo.Matomo(Request({}), settings.site_id, settings.tracking_api_url)
+    else:
+        # A copy keeps the request's context without leaking order values into
+        # the request's later hits or sending the request's stored hits. The
+        # random visitor ID is generated first so copies share it.
+        request_tracker.get_visitor_id()
+        tracker = copy.copy(request_tracker._setup())
+        tracker.storedTrackingActions = []
+        tracker.storedFutures = []
+    tracker.enable_bulk_tracking()
+    return tracker
+
+
+class OrderBatch:
+    """
+    Orders saved in one transaction. Called on commit to track them.
+
+    * @param str using Database alias
+    * @param LazyTracker request_tracker (optional) Tracker of the request that
+        saved the orders
+    """
+
+    def __init__(self, using, request_tracker=None):
+        self.using = using
+        self.request_tracker = request_tracker
+        self.orders = {}
+        self.pending = False
+
+    def add(self, model, pk):
+        self.orders.setdefault(model, {})[pk] = None
+
+    def register(self):
+        """
+        Tracks the batch when the current transaction is committed.
+        """
+        self.pending = True
+        setattr(_batches, self.using, weakref.ref(self))
+        # Outside of transactions the batch is sent immediately
+        transaction.on_commit(self, using=self.using)
+
+    def is_pending(self, connection):
+        return self.pending and connection.in_atomic_block
+
+    def __call__(self):
+        self.pending = False
+        try:
+            self.send()
+        except Exception:
+            logger.exception("Tracking Matomo ecommerce orders failed.")
+
+    def send(self):
+        settings = get_settings()
+        if not (settings.site_id and settings.tracking_api_url):
+            return
+
+        actions = []
+        futures = []
+        tracker = None
+        for model, pks in self.orders.items():
+            registration = _registry.get(model)
+            if registration is None:
+                continue
+            # Committed rows are tracked; orders deleted in rolled back savepoints are skipped
+            instances = model._default_manager.using(self.using).in_bulk(list(pks))
+            for pk in pks:
+                if pk in instances:
+                    tracker = _create_tracker(settings, self.request_tracker)
+                    track_order(tracker, registration, instances[pk])
+                    actions.extend(tracker.storedTrackingActions)
+                    futures.extend(tracker.storedFutures)
+
+        if actions:
+            tracker.storedTrackingActions = actions
+            tracker.storedFutures = futures
+            tracker.do_bulk_track()
+
+
+def track_order(tracker, registration, instance):
+    """
+    Tracks an order instance with tracker as mapped by registration.
+
+    * @param MatomoTracker tracker
+    * @param OrderRegistration registration
+    * @param instance Order instance
+    * @return mixed Response of do_track_ecommerce_order()
+    """
+    if registration.visitor_id:
+        tracker.set_visitor_id(get_value(instance, registration.visitor_id))
+    if registration.user_id:
+        tracker.set_user_id(get_value(instance, registration.user_id))
+
+    if registration.items:
+        items = get_value(instance, registration.items)
+        if hasattr(items, "all"):
+            items = items.all()
+        # Matomo expects a list of [sku, name, category, price, quantity] lists
+        tracker.ecommerceItems = [
+            item_values(tracker, registration.item_fields, item) for item in items
+        ]
+
+    values = {
+        name: _amount(get_value(instance, path)) for name, path in registration.fields.items()
+    }
+    return tracker.do_track_ecommerce_order(**values)
+
+
+def item_values(tracker, item_fields, item):
+    """
+    Returns [sku, name, category, price, quantity] of a mapped order item.
+
+    * @param MatomoTracker tracker
+    * @param dict item_fields
+    * @param item Item instance
+    * @return list
+    """
+    values = {"name": "", "category": "", "price": 0.0, "quantity": 1}
+    for name, path in item_fields.items():
+        values[name] = get_value(item, path)
+    return [
+        values["sku"],
+        values["name"],
+        values["category"],
+        tracker.force_dot_as_separator_for_decimal_point(values["price"]),
+        int(values["quantity"]),
+    ]
+
+
+def _order_saved(sender, instance, created, using, **kwargs):
+    registration = _registry.get(sender)
+    if registration is None or not registration.condition(instance, created):
+        return
+
+    connection = connections[using]
+    ref = getattr(_batches, using, None)
+    batch = ref() if ref is not None else None
+    if batch is not None and batch.is_pending(connection):
+        batch.add(sender, instance.pk)
+        return
+
+    batch = OrderBatch(using, get_request_tracker())
+    batch.add(sender, instance.pk)
+    batch.register()
@@ -0,0 +1,100 @@
+import logging
+
+from matomo.transport import Transport, default_transport, register_after_fork
+
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Cooperative sending for gevent and eventlet applications.
+
+Blocking transports hold the calling greenlet until Matomo responds. With
+GreenletTransport requests are sent from a bounded pool of greenlets instead, so
+tracking overlaps with handling of the request. Use it after monkey patching,
+so the wrapped transport's sockets are cooperative:
+
+    from gevent import monkey; monkey.patch_all()
+
+    import matomo
+    from matomo.green import GreenletTransport
+
+    matomo.Matomo.transport = GreenletTransport(size=20)
+"""
+
+
+def _default_pool(size):
+    try:
+        import gevent.pool
+    except ImportError:
+        try:
+            import eventlet
+        except ImportError:
+            raise ImportError("GreenletTransport requires gevent or eventlet") from None
+        return eventlet.GreenPool(size)
+    return gevent.pool.Pool(size)
+
+
+class GreenletTransport(Transport):
+    """
+    Sends tracking requests with another transport from a pool of greenlets.
+
+    send() and send_bulk() return the spawned greenlet, whose value is the
+    response or None if sending failed; failures are logged. When all greenlets
+    of the pool are busy, spawning waits cooperatively for a free one, which
+    bounds the number of concurrent requests to Matomo.
+
+    * @param matomo.transport.Transport transport (optional) Transport used by greenlets
+    * @param int size (optional) Maximum number of concurrent requests
+    * @param pool (optional) gevent.pool.Pool or eventlet.GreenPool, by default a
+        gevent pool (or eventlet's if gevent is not installed) created on first use
+    """
+
+    def __init__(self, transport=default_transport, size=10, pool=None):
+        self.transport = transport
+        self.size = size
+        self._pool = pool
+        self._own_pool = pool is None
+        register_after_fork(self)
+
+    def reset_after_fork(self):
+        # Greenlets of the parent don't run in the child
+        if self._own_pool:
+            self._pool = None
+
+    @property
+    def pool(self):
+        # Created lazily so it uses the hub of the monkey patched process
+        if self._pool is None:
+            self._pool = _default_pool(self.size)
+        return self._pool
+
+    def _send(self, method, *args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        except Exception:
+            logger.exception("Sending Matomo tracking request failed.")
+            return None
+
+    def send(self, method, url, data=None, **options):
+        return self.pool.spawn(self._send, self.transport.send, method, url, data, **options)
+
+    def send_bulk(self, url, data, **options):
+        return self.pool.spawn(self._send, self.transport.send_bulk, url, data, **options)
+
+    def join(self, timeout=None):
+        """
+        Waits for requests in progress. eventlet pools ignore timeout.
+
+        * @param float timeout (optional) Seconds to wait
+        """
+        if self._pool is None:
+            return
+        if hasattr(self._pool, "join"):
+            self._pool.join(timeout=timeout)
+        else:
+            self._pool.waitall()
+
+    def close(self):
+        self.join()
+        self.transport.close()
@@ -0,0 +1,147 @@
+import functools
+import hashlib
+import os
+import random
+import threading
+import weakref
+
+
+"""
+Sources of identifiers used by the tracker: random visitor IDs, page view IDs and
+cache busting values, and visitor IDs derived from User IDs.
+
+Instead of calling uuid.uuid4() or random.randint() for every ID, random bytes are
+fetched in bulk and IDs are sliced out of their hex representation.
+"""
+
+
+# All sources, whose locks may be held by threads that don't exist in forked children
+_sources = weakref.WeakSet()
+
+
+def _reset_after_fork():
+    for source in list(_sources):
+        source.reset_after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class IdSource:
+    """
+    Thread safe buffered source of random hex IDs.
+
+    By default entropy comes from os.urandom. When seed is given IDs are generated
+    by a seeded pseudo random generator and are thus reproducible, which is useful
+    for tests and benchmarks, but must not be used in production.
+
+    * @param int pool_size Number of random bytes fetched at once
+    * @param int seed (optional) Seed for deterministic mode
+    """
+
+    def __init__(self, pool_size=4096, seed=None):
+        self.pool_size = pool_size
+        self.seed = seed
+        self._lock = threading.Lock()
+        _sources.add(self)
+        if seed is None:
+            self._random_bytes = os.urandom
+        else:
+            rng = random.Random(seed)
+            self._random_bytes = lambda n: rng.getrandbits(n * 8).to_bytes(n, "big")
+        self.reset()
+
+    def reset(self):
+        """
+        Discards buffered entropy.
+        """
+        self._pool = ""
+        self._pos = 0
+
+    def reset_after_fork(self):
+        """
+        Replaces the lock, which may have been held by another thread while forking,
+        and discards entropy shared with the parent unless the source is seeded.
+        """
+        self._lock = threading.Lock()
+        if self.seed is None:
+            self.reset()
+
+    def hex(self, length):
+        """
+        Returns a random string of hex characters.
+
+        * @param int length Number of hex characters
+        * @return str
+        """
+        with self._lock:
+            start = self._pos
+            end = start + length
+            if end > len(self._pool):
+                self._pool = self._random_bytes(max(self.pool_size, length)).hex()
+                start, end = 0, length
+            self._pos = end
+            return self._pool[start:end]
+
+    def visitor_id(self):
+        """
+        * @return str 16 hex characters visitor ID
+        """
+        return self.hex(16)
+
+    def pageview_id(self):
+        """
+        * @return str 6 hex characters page view ID
+        """
+        return self.hex(6)
+
+    def cache_buster(self):
+        """
+        Returns value for the 'r' tracking parameter that prevents caching of requests.
+
+        * @return str
+        """
+        return self.hex(6)
+
+
+default_id_source = IdSource()
+
+
+def hash_user_id(user_id):
+    """
+    Hash function used by Matomo to hash a User ID into the Visitor ID.
+
+    Note: matches implementation of Tracker Request.get_user_id_hashed()
+
+    * @param str|bytes|int user_id
+    * @return str 16 hex characters visitor ID
+    """
+    if not isinstance(user_id, bytes):
+        user_id = str(user_id).encode("utf-8")
+    return hashlib.sha1(user_id).hexdigest()[:16]
+
+
+class VisitorIdResolver:
+    """
+    Maps User IDs to Visitor IDs the same way Matomo does and remembers results.
+
+    * @param int cache_size Maximum number of remembered User IDs
+    """
+
+    def __init__(self, cache_size=10000):
+        self.cache_size = cache_size
+        self._resolve = functools.lru_cache(maxsize=cache_size)(hash_user_id)
+
+    def resolve(self, user_id):
+        """
+        * @param str user_id
+        * @return str 16 hex characters visitor ID
+        """
+        return self._resolve(user_id)
+
+    def cache_info(self):
+        return self._resolve.cache_info()
+
+    def cache_clear(self):
+        self._resolve.cache_clear()
@@ -0,0 +1,56 @@
+"""
+Lazily constructed trackers.
+
+Building a tracker reads request data and cookies and generates IDs, which is
+wasted work for requests that never track anything. LazyTracker postpones it
+until the tracker is used for the first time.
+"""
+
+
+class LazyTracker:
+    """
+    Proxy that builds a tracker by calling factory on first attribute access.
+
+    Use get_tracker() to check whether the tracker was used without creating it.
+
+    * @param callable factory Callable without arguments returning a tracker
+    """
+
+    __slots__ = ("_factory", "_tracker")
+
+    def __init__(self, factory):
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_tracker", None)
+
+    def _setup(self):
+        if self._tracker is None:
+            object.__setattr__(self, "_tracker", self._factory())
+        return self._tracker
+
+    def __getattr__(self, name):
+        return getattr(self._setup(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._setup(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._setup(), name)
+
+    def __repr__(self):
+        if self._tracker is None:
+            return "<LazyTracker: not created>"
+        return f"<LazyTracker: {self._tracker!r}>"
+
+
+def get_tracker(tracker):
+    """
+    Returns the tracker behind a LazyTracker if it was already created.
+
+    Other trackers are returned as they are.
+
+    * @param LazyTracker|MatomoTracker tracker
+    * @return MatomoTracker|None
+    """
+    if isinstance(tracker, LazyTracker):
+        return tracker._tracker
+    return tracker
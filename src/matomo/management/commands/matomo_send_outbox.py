@@ -0,0 +1,61 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+import matomo
+from matomo.django import get_settings
+from matomo.models import OutboxHit
+from matomo.request import Request
+from matomo.transport import default_transport
+
+
+class Command(BaseCommand):
+    help = (
+        "Sends tracking requests stored in the Matomo outbox in bulk requests. "
+        "Several instances can run in parallel."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Number of tracking requests sent in one bulk request (default 100).",
+        )
+
+    def handle(self, *args, batch_size, **options):
+        matomo_settings = get_settings()
+        if not (matomo_settings.site_id and matomo_settings.tracking_api_url):
+            raise CommandError("MATOMO_SITE_ID or MATOMO_TRACKING_API_URL not set.")
+
+        tracker = matomo.Matomo(
+            Request({}), matomo_settings.site_id, matomo_settings.tracking_api_url
+        )
+        # Rows may only be deleted once Matomo tracked the hits, not when a
+        # dispatcher or agent merely accepted them
+        if getattr(tracker.transport, "QUEUED", False):
+            tracker.set_transport(default_transport)
+        tracker.enable_bulk_tracking()
+        tracker.set_token_auth(getattr(settings, "MATOMO_TOKEN_AUTH", ""))
+
+        sent = 0
+        while True:
+            # Rows stay locked until the bulk request succeeds, other senders skip them
+            with transaction.atomic():
+                hits = list(
+                    OutboxHit.objects.select_for_update(skip_locked=True).order_by("id")[
+                        :batch_size
+                    ]
+                )
+                if not hits:
+                    break
+                tracker.storedTrackingActions = [hit.url for hit in hits]
+                response = tracker.do_bulk_track()
+                if not response.ok:
+                    raise CommandError(
+                        f"Sending tracking requests failed with status {response.status_code}."
+                    )
+                OutboxHit.objects.filter(pk__in=[hit.pk for hit in hits]).delete()
+            sent += len(hits)
+
+        self.stdout.write(f"Sent {sent} tracking requests.")
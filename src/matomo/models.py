@@ -0,0 +1,27 @@
+from django.db import models
+
+
+"""
+Models of the optional matomo Django app.
+"""
+
+
+class OutboxHit(models.Model):
+    """
+    Tracking request stored in the outbox until it is sent in bulk with the
+    matomo_send_outbox management command.
+
+    Hits are written in the same database transaction as the rest of the view's
+    changes, so they are only sent if the transaction is committed.
+    """
+
+    url = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["id"]
+        verbose_name = "outbox hit"
+        verbose_name_plural = "outbox hits"
+
+    def __str__(self):
+        return self.url
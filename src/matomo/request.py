@@ -1,6 +1,59 @@
 import collections
+from http.cookies import SimpleCookie, _unquote
 import requests
 
 
 class Request(collections.UserDict):
     cookie = requests.cookies.RequestsCookieJar()
+
+
+def parse_cookies(header):
+    """
+    Parses value of a Cookie request header into a dict.
+
+    Unlike SimpleCookie, which drops all cookies after a malformed one, each
+    name=value pair is parsed on its own, like browsers send them.
+    """
+    cookies = {}
+    for pair in header.split(";"):
+        name, sep, value = pair.partition("=")
+        if not sep:
+            # Nameless cookie, which browsers send as just its value
+            name, value = "", name
+        name, value = name.strip(), value.strip()
+        if name or value:
+            cookies[name] = _unquote(value)
+    return cookies
+
+
+def format_set_cookie(
+    cookie_name,
+    cookie_value,
+    max_age=None,
+    path="/",
+    domain=None,
+    secure=False,
+    httponly=False,
+    samesite=None,
+):
+    """
+    Returns value of a Set-Cookie response header.
+
+    Used by trackers of frameworks that don't provide their own cookie handling.
+    """
+    cookie = SimpleCookie()
+    cookie[cookie_name] = cookie_value if cookie_value is not None else ""
+    morsel = cookie[cookie_name]
+    if max_age is not None:
+        morsel["max-age"] = int(max_age)
+    if path:
+        morsel["path"] = path
+    if domain:
+        morsel["domain"] = domain
+    if secure:
+        morsel["secure"] = True
+    if httponly:
+        morsel["httponly"] = True
+    if samesite:
+        morsel["samesite"] = samesite
+    return morsel.OutputString()
@@ -0,0 +1,320 @@
+import logging
+import multiprocessing
+import struct
+import time
+from multiprocessing import shared_memory
+
+import matomo
+from matomo.transport import Response, Transport, default_transport, hit_query
+
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Shared memory ring buffer handing hits from pre-forked workers to a single
+dispatcher process.
+
+The ring is created in the master process before workers are forked, e.g. in
+Gunicorn's config file:
+
+    ring = HitRing(size=4 * 1024 * 1024)
+    dispatcher = RingDispatcher(ring, "https://matomo.example.org/").start()
+    matomo.Matomo.transport = RingTransport(ring)
+
+The ring's lock and counters are inherited by child processes, so workers and
+the dispatcher must be started by the process that created it; other processes
+can't attach to the ring.
+
+Workers' trackers write hits into free slots of the ring and the dispatcher
+drains them into bulk requests. Writers only hold a lock while claiming and
+publishing a slot, copying of hit data happens outside of it. Memory use is
+fixed; hits that don't fit (the ring is full, the hit is larger than a slot or
+the lock can't be taken in time) are dropped and counted in overflow. Slots of
+writers that died while copying are skipped by the dispatcher after a while, so
+they don't stop it.
+"""
+
+
+# write index, overflow counter
+HEADER = struct.Struct("QQ")
+# slot state, data length, write index of the hit
+SLOT_HEADER = struct.Struct("BIQ")
+
+EMPTY = 0
+WRITING = 1
+READY = 2
+
+# Write index of slots taken back from writers that didn't finish
+RECLAIMED = 2**64 - 1
+
+
+class HitRing:
+    """
+    Fixed size multi producer, single consumer ring buffer of hits in shared memory.
+
+    * @param int size (optional) Memory budget in bytes
+    * @param int slot_size (optional) Bytes reserved for one hit
+    * @param float lock_timeout (optional) Seconds a writer waits for the lock
+        before dropping the hit
+    * @param float stale_after (optional) Seconds after which the reader skips a
+        slot whose writer didn't finish writing it, dropping the hit
+    """
+
+    def __init__(self, size=1024 * 1024, slot_size=2048, lock_timeout=0.1, stale_after=5.0):
+        self.slot_size = slot_size
+        self.slots = (size - HEADER.size) // slot_size
+        if self.slots < 1:
+            raise Exception("Ring buffer size must fit at least one slot")
+        self.memory = shared_memory.SharedMemory(create=True, size=size)
+        self.memory.buf[: HEADER.size + self.slots * slot_size] = bytes(
+            HEADER.size + self.slots * slot_size
+        )
+        self.lock = multiprocessing.Lock()
+        self.lock_timeout = lock_timeout
+        self.stale_after = stale_after
+        # Hits dropped without holding the lock, i.e. on lock timeouts or
+        # reclaimed slots
+        self.lost = multiprocessing.Value("Q", 0)
+        # Only used by the consumer
+        self.read_index = 0
+        self.stalled = None
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    @property
+    def overflow(self):
+        """
+        Number of dropped hits.
+        """
+        return HEADER.unpack_from(self.memory.buf, 0)[1] + self.lost.value
+
+    def _offset(self, index):
+        return HEADER.size + (index % self.slots) * self.slot_size
+
+    def _count_lost(self):
+        with self.lost.get_lock():
+            self.lost.value += 1
+
+    def put(self, hit):
+        """
+        Writes a hit into the ring.
+
+        * @param bytes hit
+        * @return bool False when the hit was dropped
+        """
+        buf = self.memory.buf
+        # A writer that died holding the lock must not block all others
+        if not self.lock.acquire(timeout=self.lock_timeout):
+            self._count_lost()
+            return False
+        try:
+            write_index, overflow = HEADER.unpack_from(buf, 0)
+            offset = self._offset(write_index)
+            if len(hit) > self.slot_size - SLOT_HEADER.size or buf[offset] != EMPTY:
+                HEADER.pack_into(buf, 0, write_index, overflow + 1)
+                return False
+            SLOT_HEADER.pack_into(buf, offset, WRITING, 0, write_index)
+            HEADER.pack_into(buf, 0, write_index + 1, overflow)
+        finally:
+            self.lock.release()
+
+        start = offset + SLOT_HEADER.size
+        buf[start : start + len(hit)] = hit
+        # The slot is left in writing and reclaimed by the reader
+        if not self.lock.acquire(timeout=self.lock_timeout):
+            return False
+        try:
+            # The reader took the slot back because writing took too long
+            if SLOT_HEADER.unpack_from(buf, offset)[2] != write_index:
+                return False
+            SLOT_HEADER.pack_into(buf, offset, READY, len(hit), write_index)
+        finally:
+            self.lock.release()
+        return True
+
+    def get(self, max_count):
+        """
+        Takes up to max_count hits from the ring in the order they were written.
+
+        A slot that stays in writing for stale_after seconds is skipped and its
+        hit counted in overflow. Only one process may read from the ring.
+
+        * @param int max_count
+        * @return list of bytes
+        """
+        buf = self.memory.buf
+        hits = []
+        while len(hits) < max_count:
+            offset = self._offset(self.read_index)
+            state, length, write_index = SLOT_HEADER.unpack_from(buf, offset)
+            if state == WRITING:
+                if not self.is_stale(write_index) or not self.reclaim(offset):
+                    break
+                continue
+            if state != READY:
+                break
+            start = offset + SLOT_HEADER.size
+            hits.append(bytes(buf[start : start + length]))
+            buf[offset] = EMPTY
+            self.read_index += 1
+        return hits
+
+    def reclaim(self, offset):
+        """
+        Takes a stale slot back from its writer, unless the writer publishes it
+        meanwhile. Publishing and reclaiming both happen under the lock, so a
+        writer never publishes a slot the reader already skipped.
+
+        * @param int offset Offset of the slot
+        * @return bool False when the lock couldn't be taken in time
+        """
+        if not self.lock.acquire(timeout=self.lock_timeout):
+            return False
+        try:
+            state = SLOT_HEADER.unpack_from(self.memory.buf, offset)[0]
+            if state == WRITING:
+                SLOT_HEADER.pack_into(self.memory.buf, offset, EMPTY, 0, RECLAIMED)
+                self._count_lost()
+                self.read_index += 1
+        finally:
+            self.lock.release()
+        return True
+
+    def is_stale(self, write_index):
+        """
+        Whether the reader has been waiting for the writer of a slot for at least
+        stale_after seconds.
+
+        * @param int write_index Write index of the slot being written
+        * @return bool
+        """
+        now = time.monotonic()
+        if self.stalled is None or self.stalled[0] != write_index:
+            self.stalled = (write_index, now)
+        return now - self.stalled[1] >= self.stale_after
+
+    def close(self):
+        self.memory.close()
+
+    def unlink(self):
+        """
+        Frees the shared memory. Called by the process that created the ring.
+        """
+        self.memory.unlink()
+
+
+class RingTransport(Transport):
+    """
+    Writes tracking requests into a HitRing instead of sending them.
+
+    Returns a 202 response for written hits and 503 for dropped ones.
+    token_auth is added by the dispatcher.
+
+    * @param HitRing ring
+    """
+
+    QUEUED = True
+
+    def __init__(self, ring):
+        self.ring = ring
+
+    def send(self, method, url, data=None, headers=None, **options):
+        written = self.ring.put(hit_query(url, data, headers).encode("utf-8"))
+        return Response(202 if written else 503, {}, b"")
+
+    def send_bulk(self, url, data, **options):
+        written = 0
+        for action in data["requests"]:
+            written += self.ring.put(hit_query(action).encode("utf-8"))
+        return Response(202 if written == len(data["requests"]) else 503, {}, b"")
+
+
+class RingDispatcher:
+    """
+    Drains a HitRing into bulk requests.
+
+    * @param HitRing ring
+    * @param str api_url "http://example.org/matomo/" or "http://matomo.example.org/"
+    * @param str token_auth (optional) Sent with bulk requests
+    * @param int batch_size (optional) Maximum number of hits in a bulk request
+    * @param float flush_interval (optional) Seconds to wait for more hits
+    * @param matomo.transport.Transport transport (optional) Transport of bulk requests
+    * @param int timeout (optional) Timeout of bulk requests in seconds
+    """
+
+    def __init__(
+        self,
+        ring,
+        api_url,
+        token_auth="",
+        batch_size=500,
+        flush_interval=0.5,
+        transport=default_transport,
+        timeout=10,
+    ):
+        self.ring = ring
+        self.url = matomo.matomo_tracking_endpoint(api_url)
+        self.token_auth = token_auth
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.transport = transport
+        self.timeout = timeout
+        self.sent = 0
+        self.failed = 0
+        self.stopped = multiprocessing.Event()
+        self.process = None
+
+    def flush(self):
+        """
+        Sends hits currently in the ring.
+
+        * @return int Number of hits taken from the ring
+        """
+        taken = 0
+        while True:
+            hits = self.ring.get(self.batch_size)
+            if not hits:
+                return taken
+            taken += len(hits)
+            data = {"requests": [hit.decode("utf-8") for hit in hits]}
+            if self.token_auth:
+                data["token_auth"] = self.token_auth
+            try:
+                ok = self.transport.send_bulk(self.url, data, timeout=self.timeout).ok
+            except Exception:
+                logger.exception("Sending Matomo bulk request failed.")
+                ok = False
+            if ok:
+                self.sent += len(hits)
+            else:
+                self.failed += len(hits)
+
+    def run(self):
+        """
+        Sends hits until stop() is called.
+        """
+        while not self.stopped.is_set():
+            if self.flush() < self.batch_size:
+                time.sleep(self.flush_interval)
+        self.flush()
+
+    def start(self):
+        """
+        Runs the dispatcher in a child process.
+
+        * @return self
+        """
+        self.process = multiprocessing.Process(target=self.run, daemon=True)
+        self.process.start()
+        return self
+
+    def stop(self, timeout=None):
+        """
+        Stops the dispatcher after it sent remaining hits.
+        """
+        self.stopped.set()
+        if self.process is not None:
+            self.process.join(timeout)
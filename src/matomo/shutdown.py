@@ -0,0 +1,198 @@
+import atexit
+import collections
+import logging
+import os
+import signal
+import threading
+import time
+import weakref
+
+from matomo.dispatch import Dispatcher, PriorityDispatcher
+from matomo.transport import hit_query
+
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Sending of buffered hits when a process exits.
+
+Hits stored by trackers in bulk mode or queued in dispatchers are lost when a
+worker exits before sending them. ShutdownCoordinator sends them on exit or
+SIGTERM within a deadline and writes hits it couldn't send to a spill file:
+
+    from matomo.shutdown import ShutdownCoordinator
+
+    coordinator = ShutdownCoordinator(deadline=5, spill_path="/var/spool/matomo-spill")
+    coordinator.install()
+    coordinator.register(dispatcher)
+
+The spill file has one hit record per line, the spool format of matomo.agent,
+so it can be sent later with `python -m matomo.agent --spool <spill file> ...`.
+"""
+
+
+ShutdownReport = collections.namedtuple("ShutdownReport", ["flushed", "spilled", "dropped"])
+
+
+class ShutdownCoordinator:
+    """
+    Sends hits of registered trackers and dispatchers when the process exits.
+
+    * @param float deadline (optional) Seconds available for sending
+    * @param str spill_path (optional) File for hits that couldn't be sent in time,
+        without it they are dropped
+    """
+
+    def __init__(self, deadline=5.0, spill_path=None):
+        self.deadline = deadline
+        self.spill_path = spill_path
+        self.components = weakref.WeakSet()
+        self.report = None
+        self._lock = threading.Lock()
+        self._previous_handlers = {}
+        self._signal_thread = None
+        # Set by the shutdown thread before it raises the signal again
+        self._signal_handled = False
+
+    def register(self, component):
+        """
+        Registers a tracker in bulk mode or a dispatcher whose hits are sent on exit.
+
+        * @param MatomoTracker|Dispatcher|PriorityDispatcher component
+        * @return component
+        """
+        self.components.add(component)
+        return component
+
+    def install(self, signals=(signal.SIGTERM,)):
+        """
+        Runs shutdown() at exit and when one of signals is received. Must be
+        called from the main thread.
+
+        On a signal, shutdown() runs in a separate thread, because the interrupted
+        code may hold locks it needs. When it is done, the signal is raised again
+        and handled by the previous handler or the default action.
+
+        * @param tuple signals (optional) Signals to handle
+        * @return self
+        """
+        atexit.register(self.shutdown)
+        for signum in signals:
+            self._previous_handlers[signum] = signal.signal(signum, self._handle_signal)
+        return self
+
+    def _handle_signal(self, signum, frame):
+        if self.report is None and not self._signal_handled:
+            if self._signal_thread is None:
+                self._signal_thread = threading.Thread(
+                    target=self._shutdown_and_raise,
+                    args=(signum,),
+                    name="matomo-shutdown",
+                    daemon=True,
+                )
+                self._signal_thread.start()
+            return
+        previous = self._previous_handlers.get(signum)
+        if callable(previous):
+            previous(signum, frame)
+        elif previous != signal.SIG_IGN:
+            # Let the default action terminate the process
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+
+    def _shutdown_and_raise(self, signum):
+        try:
+            self.shutdown()
+        finally:
+            # Handled in the main thread, now by the previous handler, even if
+            # shutdown() failed
+            self._signal_handled = True
+            os.kill(os.getpid(), signum)
+
+    def shutdown(self):
+        """
+        Stops dispatchers from accepting hits and sends buffered hits in bulk until
+        the deadline. Runs only once.
+
+        Hits that were being sent by a dispatcher's worker thread when the deadline
+        passed are counted as dropped, so the numbers add up to the buffered hits.
+        If sending fails with an exception, the report has the numbers up to then.
+
+        * @return ShutdownReport Numbers of flushed, spilled and dropped hits
+        """
+        with self._lock:
+            if self.report is not None:
+                return self.report
+            deadline = time.monotonic() + self.deadline
+            flushed = spilled = dropped = 0
+
+            try:
+                components = list(self.components)
+                dispatchers = [
+                    c for c in components if isinstance(c, (Dispatcher, PriorityDispatcher))
+                ]
+                trackers = [c for c in components if c not in dispatchers]
+                for dispatcher in dispatchers:
+                    dispatcher.accepting = False
+
+                for tracker in trackers:
+                    hits, futures = tracker.storedTrackingActions, tracker.storedFutures
+                    if not hits:
+                        continue
+                    remaining = deadline - time.monotonic()
+                    sent = False
+                    if remaining > 0:
+                        tracker.requestTimeout = remaining
+                        try:
+                            sent = tracker.do_bulk_track().ok
+                        except Exception:
+                            logger.exception(
+                                "Sending Matomo tracking requests on shutdown failed."
+                            )
+                    if sent:
+                        flushed += len(hits)
+                    else:
+                        tracker.storedTrackingActions = []
+                        tracker.storedFutures = []
+                        for future in futures:
+                            future.set_result(False)
+                        count = self.spill(hit_query(str(hit)) for hit in hits)
+                        spilled += count
+                        dropped += len(hits) - count
+
+                for dispatcher in dispatchers:
+                    sent_before, failed_before, spilled_before, _ = dispatcher.counts()
+                    dispatcher.close(timeout=max(deadline - time.monotonic(), 0))
+                    hits = [hit for _, hit in dispatcher.drain()]
+                    sent, failed, dispatcher_spilled, in_flight = dispatcher.counts()
+                    flushed += sent - sent_before
+                    spilled += dispatcher_spilled - spilled_before
+                    dropped += failed - failed_before + in_flight
+                    count = self.spill(hits)
+                    spilled += count
+                    dropped += len(hits) - count
+            finally:
+                self.report = ShutdownReport(flushed, spilled, dropped)
+                logger.info(
+                    "Matomo shutdown: %d hits flushed, %d spilled and %d dropped.", *self.report
+                )
+            return self.report
+
+    def spill(self, hits):
+        """
+        Appends hit records to the spill file.
+
+        * @param iterable hits
+        * @return int Number of written hits, 0 without spill file
+        """
+        hits = list(hits)
+        if not hits or not self.spill_path:
+            return 0
+        try:
+            with open(self.spill_path, "a", encoding="utf-8") as spill:
+                spill.writelines(hit + "\n" for hit in hits)
+        except OSError:
+            logger.exception("Writing Matomo spill file failed.")
+            return 0
+        return len(hits)
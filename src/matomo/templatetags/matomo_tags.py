@@ -0,0 +1,48 @@
+from django import template
+from django.utils.html import format_html
+
+from matomo import matomo_pixel_url_track_goal, matomo_pixel_url_track_page_view
+from matomo.django import get_settings
+
+
+register = template.Library()
+
+
+def _current_url(context):
+    request = context.get("request")
+    return request.build_absolute_uri() if request is not None else ""
+
+
+@register.simple_tag(takes_context=True)
+def matomo_pixel_url(context, document_title=""):
+    """
+    Returns tracking pixel URL tracking a page view of the current page.
+
+    Usage: {% load matomo_tags %}<img src="{% matomo_pixel_url "Page title" %}">
+    """
+    settings = get_settings()
+    return matomo_pixel_url_track_page_view(
+        settings.tracking_api_url, settings.site_id, _current_url(context), document_title
+    )
+
+
+@register.simple_tag(takes_context=True)
+def matomo_goal_pixel_url(context, id_goal, revenue=0.0):
+    """
+    Returns tracking pixel URL tracking a goal conversion on the current page.
+    """
+    settings = get_settings()
+    return matomo_pixel_url_track_goal(
+        settings.tracking_api_url, settings.site_id, id_goal, revenue, _current_url(context)
+    )
+
+
+@register.simple_tag(takes_context=True)
+def matomo_noscript(context, document_title=""):
+    """
+    Renders <noscript> tracking pixel tracking a page view of the current page.
+    """
+    return format_html(
+        '<noscript><img src="{}" style="border:0" alt=""></noscript>',
+        matomo_pixel_url(context, document_title),
+    )
@@ -1,12 +1,14 @@
+import collections
+import functools
 import logging
 from datetime import datetime
 import hashlib
 import json
-import random
 import re
 import time
 from urllib.parse import quote, parse_qs, urlencode
-import uuid
+
+from .ids import default_id_source, hash_user_id
 
 
 def urlencode_plus(s):
@@ -38,6 +40,134 @@ def strspn(str1, str2, start=0, length=None):
     return len(re.search("^[" + str2 + "]*", str1[start : start + length]).group(0))
 
 
+# Number of distinct client hints header values remembered by the parsing and
+# encoding caches. Real traffic only carries a handful of browser builds.
+CLIENT_HINTS_CACHE_SIZE = 512
+
+FULL_VERSION_LIST_REGEX = re.compile("\"([^\"]+?)\"; ?v=\"([^\"]+?)\"(?:, )?")
+
+
+@functools.lru_cache(maxsize=CLIENT_HINTS_CACHE_SIZE)
+def parse_full_version_list(header):
+    """
+    Parses value of the Sec-CH-UA-Full-Version-List header into a list of brands.
+
+    The header is scanned once from left to right and parsing stops at the first
+    entry that doesn't match. Results are cached and shared between trackers so
+    the returned list must not be modified.
+
+    * @param str header Value of the header 'HTTP_SEC_CH_UA_FULL_VERSION_LIST'
+    * @return list [{'brand': 'Chrome', 'version': '10.0.2'}, ...]
+    """
+    brands = []
+    match = FULL_VERSION_LIST_REGEX.match(header)
+    while match:
+        brand, version = match.groups()
+        brands.append({"brand": brand, "version": version})
+        match = FULL_VERSION_LIST_REGEX.match(header, match.end())
+    return brands
+
+
+@functools.lru_cache(maxsize=CLIENT_HINTS_CACHE_SIZE)
+def encode_client_hints(model, platform, platform_version, ua_full_version, full_version_list):
+    """
+    Returns URL encoded JSON for the uadata tracking parameter.
+
+    Arguments are raw header values so the result can be cached.
+
+    * @param str model
+    * @param str platform
+    * @param str platform_version
+    * @param str ua_full_version
+    * @param str full_version_list Raw value of the 'HTTP_SEC_CH_UA_FULL_VERSION_LIST' header
+    * @return str
+    """
+    client_hints = {
+        "model": model,
+        "platform": platform,
+        "platformVersion": platform_version,
+        "uaFullVersion": ua_full_version,
+        "fullVersionList": parse_full_version_list(full_version_list),
+    }
+    return urlencode_plus(json.dumps(client_hints))
+
+
+# Number of distinct forced datetime strings remembered by parsing caches
+FORCED_DATETIME_CACHE_SIZE = 4096
+
+FORCED_DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+@functools.lru_cache(maxsize=FORCED_DATETIME_CACHE_SIZE)
+def parse_datetime_string(value):
+    """
+    Converts a forced datetime string into a UNIX timestamp.
+
+    * @param str value Date with the format '%Y-%m-%d %H:%M:%S' or a UNIX timestamp
+    * @return float
+    """
+    try:
+        return datetime.strptime(value, FORCED_DATETIME_FORMAT).timestamp()
+    except ValueError:
+        return float(value)
+
+
+def get_forced_timestamp(value):
+    """
+    Converts a forced datetime (string, UNIX timestamp or datetime) into a UNIX timestamp.
+
+    * @param str|int|float|datetime value
+    * @return float
+    """
+    if isinstance(value, datetime):
+        return value.timestamp()
+    if is_str(value):
+        return parse_datetime_string(value)
+    return float(value)
+
+
+@functools.lru_cache(maxsize=FORCED_DATETIME_CACHE_SIZE)
+def _format_cdt_string(value):
+    return urlencode_plus(value)
+
+
+def format_cdt(value):
+    """
+    Returns URL encoded value of the cdt tracking parameter for a forced datetime.
+
+    Strings are sent as they are, numbers and datetime objects as UNIX timestamps.
+
+    * @param str|int|float|datetime value
+    * @return str
+    """
+    if is_str(value):
+        return _format_cdt_string(value)
+    if isinstance(value, datetime):
+        value = value.timestamp()
+    return str(int(value))
+
+
+def format_cdt_column(values):
+    """
+    Converts a whole column of forced datetimes into cdt parameter values at once.
+
+    Useful when backfilling historic data where every hit has its own datetime.
+    Repeated values are converted only once.
+
+    * @param iterable values Strings, UNIX timestamps or datetime objects
+    * @return list List of URL encoded cdt values in the same order
+    """
+    converted = {}
+    column = []
+    for value in values:
+        try:
+            cdt = converted[value]
+        except KeyError:
+            cdt = converted[value] = format_cdt(value)
+        column.append(cdt)
+    return column
+
+
 """
  * Matomo - free/libre analytics platform
 
@@ -52,6 +182,163 @@ def strspn(str1, str2, start=0, length=None):
 """
 
 
+# Tracker state needed to build a tracking request URL, see MatomoTracker.capture_request()
+RequestSnapshot = collections.namedtuple(
+    "RequestSnapshot",
+    [
+        "base_url",
+        "id_site",
+        "version",
+        "cache_buster",
+        "ip",
+        "user_id",
+        "forced_datetime",
+        "forced_new_visit",
+        "create_ts",
+        "plugins",
+        "local_time",
+        "resolution",
+        "has_cookies",
+        "custom_data",
+        "visitor_custom_var",
+        "page_custom_var",
+        "event_custom_var",
+        "forced_visitor_id",
+        "visitor_id",
+        "page_url",
+        "url_referrer",
+        "page_charset",
+        "id_pageview",
+        "attribution_info",
+        "country",
+        "region",
+        "city",
+        "lat",
+        "long",
+        "custom_parameters",
+        "custom_dimensions",
+        "send_image",
+        "client_hints",
+        "debug_append",
+        "performance_timings",
+        "ecommerce_view",
+    ],
+)
+
+
+def format_request(snapshot):
+    """
+    Builds tracking request URL from a snapshot of tracker's state.
+
+    * @param RequestSnapshot snapshot
+    * @return str
+    """
+    s = snapshot
+    start = "&" if strpos(s.base_url, "?") else "?"
+    attribution_info = s.attribution_info or ("", "", "", "")
+    client_hints = ""
+    if s.client_hints:
+        key, hints = s.client_hints
+        client_hints = "&uadata=" + (
+            encode_client_hints(*key) if key else urlencode_plus(json.dumps(hints))
+        )
+    url = (
+        f"{s.base_url}{start}idsite={s.id_site}&rec=1&apiv={s.version}"
+        + f"&r={s.cache_buster}"
+        + (f"&cip={s.ip}" if s.ip else "")
+        + (f"&uid={urlencode_plus(s.user_id)}" if s.user_id else "")
+        + ("&cdt=" + format_cdt(s.forced_datetime) if s.forced_datetime else "")
+        + ("&new_visit=1" if s.forced_new_visit else "")
+        + f"&_idts={s.create_ts}{s.plugins}"
+        + ("&h={}&m={}&s={}".format(*s.local_time) if s.local_time else "")
+        + ("&res={}x{}".format(*s.resolution) if s.resolution else "")
+        + (f"&cookie={s.has_cookies}" if s.has_cookies else "")
+        + (f"&data={s.custom_data}" if s.custom_data else "")
+        + (
+            "&_cvar=" + urlencode_plus(json.dumps(s.visitor_custom_var))
+            if s.visitor_custom_var
+            else ""
+        )
+        + (
+            "&cvar=" + urlencode_plus(json.dumps(s.page_custom_var))
+            if s.page_custom_var
+            else ""
+        )
+        + (
+            "&e_cvar=" + urlencode_plus(json.dumps(s.event_custom_var))
+            if s.event_custom_var
+            else ""
+        )
+        + (f"&cid={s.forced_visitor_id}" if s.forced_visitor_id else f"&_id={s.visitor_id}")
+        + "&url="
+        + urlencode_plus(s.page_url or "")
+        + "&urlref="
+        + urlencode_plus(s.url_referrer or "")
+        + (f"&cs={s.page_charset}" if s.page_charset else "")
+        + (f"&pv_id={urlencode_plus(s.id_pageview)}" if s.id_pageview else "")
+        + ("&_rcn=" + urlencode_plus(attribution_info[0]) if attribution_info[0] else "")
+        + ("&_rck=" + urlencode_plus(attribution_info[1]) if attribution_info[1] else "")
+        + ("&_refts=" + str(attribution_info[2]) if attribution_info[2] else "")
+        + ("&_ref=" + urlencode_plus(attribution_info[3]) if attribution_info[3] else "")
+        + (f"&country={urlencode_plus(s.country)}" if s.country else "")
+        + (f"&region={urlencode_plus(s.region)}" if s.region else "")
+        + (f"&city={urlencode_plus(s.city)}" if s.city else "")
+        + (f"&lat={urlencode_plus(str(s.lat))}" if s.lat else "")
+        + (f"&long={urlencode_plus(str(s.long))}" if s.long else "")
+        + ("&" + urlencode_plus(s.custom_parameters) if s.custom_parameters else "")
+        + ("&" + urlencode_plus(s.custom_dimensions) if s.custom_dimensions else "")
+        + ("&send_image=0" if not s.send_image else "")
+        + client_hints
+        + s.debug_append
+    )
+
+    if s.performance_timings:
+        network, server, transfer, dom_processing, dom_completion, on_load = (
+            s.performance_timings
+        )
+        url += (
+            (f"&pf_net={network}" if network else "")
+            + (f"&pf_srv={server}" if server else "")
+            + (f"&pf_tfr={transfer}" if transfer else "")
+            + (f"&pf_dm1={dom_processing}" if dom_processing else "")
+            + (f"&pf_dm2={dom_completion}" if dom_completion else "")
+            + (f"&pf_onl={on_load}" if on_load else "")
+        )
+
+    for key in s.ecommerce_view:
+        url += f"&{key}={urlencode_plus(s.ecommerce_view[key])}"
+
+    return url
+
+
+class DeferredUrl:
+    """
+    Tracking request URL that is built only when needed, e.g. in a worker thread
+    of matomo.dispatch.Dispatcher.
+
+    Holds a RequestSnapshot and parameters appended with +, which keep it
+    deferred. str() returns the URL.
+
+    * @param RequestSnapshot snapshot
+    * @param str suffix (optional) Appended parameters
+    """
+
+    __slots__ = ("snapshot", "suffix")
+
+    def __init__(self, snapshot, suffix=""):
+        self.snapshot = snapshot
+        self.suffix = suffix
+
+    def __add__(self, other):
+        return DeferredUrl(self.snapshot, self.suffix + other)
+
+    def __str__(self):
+        return format_request(self.snapshot) + self.suffix
+
+    def __repr__(self):
+        return f"<DeferredUrl {self.snapshot.base_url}>"
+
+
 class MatomoTracker:
     """
     MatomoTracker implements the Matomo Tracking Web API.
@@ -111,6 +398,20 @@ class MatomoTracker:
 
     DEFAULT_COOKIE_PATH = "/"
 
+    """
+    Source of random visitor IDs, page view IDs and cache busting values.
+    Replace with a seeded matomo.ids.IdSource for reproducible IDs.
+    * @see set_id_source
+    """
+    ID_SOURCE = default_id_source
+
+    """
+    Resolver deriving visitor IDs from User IDs, e.g. matomo.ids.VisitorIdResolver.
+    When set, visitors with a User ID get the same visitor ID Matomo would assign them.
+    * @see set_visitor_id_resolver
+    """
+    USER_ID_RESOLVER = None
+
     def __init__(self, request, id_site, api_url=""):
         """
         Builds a MatomoTracker object, used to track visits, pages and Goal conversions
@@ -154,6 +455,8 @@ class MatomoTracker:
         self.local_minute = ""
         self.local_second = ""
         self.idPageview = ""
+        self.idSource = self.ID_SOURCE
+        self.visitorIdResolver = self.USER_ID_RESOLVER
 
         self.id_site = str(id_site)
         self.urlReferrer = self.request.get("HTTP_REFERER", "")
@@ -163,6 +466,7 @@ class MatomoTracker:
         self.accept_language = self.request.get("HTTP_ACCEPT_LANGUAGE", "")
         self.user_agent = self.request.get("HTTP_USER_AGENT", "")
         self.clientHints = {}
+        self.clientHintsKey = None
         self.set_client_hints(
             self.request.get("HTTP_SEC_CH_UA_MODEL", ""),
             self.request.get("HTTP_SEC_CH_UA_PLATFORM", ""),
@@ -186,6 +490,7 @@ class MatomoTracker:
         # Visitor Ids in order
         self.user_id = ""
         self.forcedVisitorId = ""
+        self.userVisitorId = ""
         self.cookieVisitorId = ""
         self.randomVisitorId = ""
 
@@ -205,6 +510,8 @@ class MatomoTracker:
         self.requestTimeout = 600
         self.doBulkRequests = False
         self.storedTrackingActions = []
+        self.deferSerialization = False
+        self.storedFutures = []
 
         self.sendImageResponse = True
 
@@ -461,16 +768,38 @@ class MatomoTracker:
         """
         self.customParameters = {}
 
+    @property
+    def randomVisitorId(self):
+        # Generated on first use because visitors with cookies or User IDs never need it
+        if not self._randomVisitorId:
+            self._randomVisitorId = self.idSource.hex(self.LENGTH_VISITOR_ID)
+        return self._randomVisitorId
+
+    @randomVisitorId.setter
+    def randomVisitorId(self, visitor_id):
+        self._randomVisitorId = visitor_id
+
     def set_new_visitor_id(self):
         """
         Sets the current visitor ID to a random new one.
         * @return self
         """
-        self.randomVisitorId = uuid.uuid4().hex[: self.LENGTH_VISITOR_ID]
+        self.randomVisitorId = ""
         self.forcedVisitorId = False
+        self.userVisitorId = ""
         self.cookieVisitorId = False
         return self
 
+    def set_id_source(self, id_source):
+        """
+        Sets the source of random IDs used by this tracker.
+
+        * @param matomo.ids.IdSource id_source
+        * @return self
+        """
+        self.idSource = id_source
+        return self
+
     def set_id_site(self, id_site):
         """
         Sets the current site ID.
@@ -518,23 +847,13 @@ class MatomoTracker:
         * @param str uaFullVersion  Value of the header 'HTTP_SEC_CH_UA_FULL_VERSION'
         * @return self
         """
+        self.clientHintsKey = None
         if is_str(fullVersionList):
-            regex = re.compile("^\"([^\"]+?)\"; ?v=\"([^\"]+?)\"(?:, )?")
-            l = []
-
-            match = re.search(regex, fullVersionList)
-            while match:
-                brand, version = re.findall(regex, fullVersionList)[0]
-                l.append({
-                    "brand": brand,
-                    "version": version
-                })
-
-                start, end = match.span()
-                fullVersionList = fullVersionList[end:]
-                match = re.search(regex, fullVersionList)
-
-            fullVersionList = l
+            # Raw header values can be used as a key for cached uadata encoding
+            key = (model, platform, platformVersion, uaFullVersion, fullVersionList)
+            if all(is_str(value) for value in key):
+                self.clientHintsKey = key
+            fullVersionList = parse_full_version_list(fullVersionList)
         elif not is_list(fullVersionList):
             fullVersionList = []
         self.clientHints = {
@@ -546,6 +865,17 @@ class MatomoTracker:
         }
         return self
 
+    def get_encoded_client_hints(self):
+        """
+        Returns URL encoded JSON of the currently set client hints.
+
+        * @return str
+        * @ignore
+        """
+        if self.clientHintsKey:
+            return encode_client_hints(*self.clientHintsKey)
+        return urlencode_plus(json.dumps(self.clientHints))
+
     def set_country(self, country):
         """
         Sets the country of the visitor. If not used, Matomo will try to find the country
@@ -621,6 +951,15 @@ class MatomoTracker:
         """
         self.doBulkRequests = False
 
+    def enable_deferred_serialization(self):
+        """
+        Enables deferred serialization. get_request() and get_url_track_*() methods then
+        only capture a snapshot of the tracker's state and return a DeferredUrl,
+        which transports with send_deferred(), like matomo.dispatch.Dispatcher,
+        build in their worker thread. Other transports build it when sending.
+        """
+        self.deferSerialization = True
+
     def enable_cookies(
         self, domain="", path="/", secure=False, http_only=False, same_site=""
     ):
@@ -679,14 +1018,14 @@ class MatomoTracker:
         Tracks a page view
 
         * @param str document_title Page title as it will appear in the Actions > Page titles report
-        * @return mixed Response string or True if using bulk requests.
+        * @return mixed Response or matomo.transport.HitFuture if using bulk requests
         """
         self.generate_new_pageview_id()
         url = self.get_url_track_page_view(document_title)
         return self.send_request(url)
 
     def generate_new_pageview_id(self):
-        self.idPageview = uuid.uuid4().hex[:6]
+        self.idPageview = self.idSource.pageview_id()
 
     def do_track_event(self, category, action, name="", value=0):
         """
@@ -696,7 +1035,7 @@ class MatomoTracker:
         * @param str action The Event's Action (Play, Pause, Duration, Add Playlist, Downloaded, Clicked...)
         * @param str name (optional) The Event's object Name (a particular Movie name, or Song name, or File name...)
         * @param float value (optional) The Event's value
-        * @return mixed Response string or True if using bulk requests.
+        * @return mixed Response or matomo.transport.HitFuture if using bulk requests
         """
         url = self.get_url_track_event(category, action, name, value)
         return self.send_request(url)
@@ -710,7 +1049,7 @@ class MatomoTracker:
         * @param str content_name The name of the content. For instance 'Ad Foo Bar'
         * @param str content_piece The actual content. For instance the path to an image, video, audio, any text
         * @param str content_target (optional) The target of the content. For instance the URL of a landing page.
-        * @return mixed Response string or True if using bulk requests.
+        * @return mixed Response or matomo.transport.HitFuture if using bulk requests
         """
         url = self.get_url_track_content_impression(
             content_name, content_piece, content_target
@@ -728,7 +1067,7 @@ class MatomoTracker:
         * @param str content_name The name of the content. For instance 'Ad Foo Bar'
         * @param str content_piece The actual content. For instance the path to an image, video, audio, any text
         * @param str content_target (optional) The target the content leading to when an interaction occurs. For instance the URL of a landing page.
-        * @return mixed Response string or True if using bulk requests.
+        * @return mixed Response or matomo.transport.HitFuture if using bulk requests
         """
         url = self.get_url_track_content_interaction(
             interaction, content_name, content_piece, content_target
@@ -747,7 +1086,7 @@ class MatomoTracker:
         * @param int count_results (optional) results displayed on the search
         result page. Used to track "zero result" keywords.
 
-        * @return mixed Response string or True if using bulk requests.
+        * @return mixed Response or matomo.transport.HitFuture if using bulk requests
         """
         url = self.get_url_track_site_search(keyword, category, count_results)
         return self.send_request(url)
@@ -758,7 +1097,7 @@ class MatomoTracker:
 
         * @param int id_goal Id Goal to record a conversion
         * @param float revenue Revenue for this conversion
-        * @return mixed Response string or True if using bulk request
+        * @return mixed Response or matomo.transport.HitFuture if using bulk requests
         """
         url = self.get_url_track_goal(id_goal, revenue)
         return self.send_request(url)
@@ -769,7 +1108,7 @@ class MatomoTracker:
 
         * @param str action_url URL of the download or outlink
         * @param str action_type Type of the action: 'download' or 'link'
-        * @return mixed Response string or True if using bulk request
+        * @return mixed Response or matomo.transport.HitFuture if using bulk requests
         """
         # Referrer could be updated to be the current URL temporarily (to mimic JS behavior)
         url = self.get_url_track_action(action_url, action_type)
@@ -811,7 +1150,7 @@ class MatomoTracker:
         updates will be deleted from the cart (in the database).
 
         * @param float grand_total Cart grand_total (typically the sum of all items' prices)
-        * @return mixed Response string or True if using bulk request
+        * @return mixed Response or matomo.transport.HitFuture if using bulk requests
         """
         url = self.get_url_track_ecommerce_cart_update(grand_total)
         return self.send_request(url)
@@ -833,7 +1172,8 @@ class MatomoTracker:
                 )
             )
 
-        data = {"requests": self.storedTrackingActions}
+        # Deferred URLs are built only now, e.g. after the response was sent
+        data = {"requests": [str(action) for action in self.storedTrackingActions]}
 
         # token_auth is not required by default, except if bulk_requests_require_authentication=1
         if self.token_auth:
@@ -864,7 +1204,7 @@ class MatomoTracker:
         * @param float tax (optional) Tax amount for this order
         * @param float shipping (optional) Shipping amount for this order
         * @param float discount (optional) Discounted amount in this order
-        * @return mixed Response or True if using bulk request
+        * @return mixed Response or matomo.transport.HitFuture if using bulk requests
         """
         url = self.get_url_track_ecommerce_order(
             order_id, grand_total, sub_total, tax, shipping, discount
@@ -877,7 +1217,7 @@ class MatomoTracker:
 
         Ping requests do track new actions. If they are sent within the standard visit length (see global.ini.php), * they will extend the existing visit and the current last action for the visit. If after the standard visit length, * ping requests will create a new visit using the last action not in the last known visit.
 
-        * @return mixed Response or True if using bulk request
+        * @return mixed Response or matomo.transport.HitFuture if using bulk requests
         """
         url = self.get_request(self.id_site)
         url += "&ping=1"
@@ -1161,7 +1501,8 @@ class MatomoTracker:
 
         Allowed only for Admin/Super User, must be used along with set_token_auth()
         * @see set_token_auth()
-        * @param str date_time Date with the format '%y-%m-%d %H:%M:%S', or a UNIX timestamp.
+        * @param str|int|float|datetime date_time Date with the format '%Y-%m-%d %H:%M:%S',
+                      a UNIX timestamp or a datetime object.
                       If the datetime is older than one day (default value for
                       tracking_requests_require_authentication_when_custom_timestamp_newer_than),
                       then you must call set_token_auth() with a valid Admin/Super user token.
@@ -1206,6 +1547,20 @@ class MatomoTracker:
         if user_id == "":
             raise Exception("User ID cannot be empty.")
         self.user_id = user_id
+        if self.visitorIdResolver and user_id:
+            self.userVisitorId = self.visitorIdResolver.resolve(user_id)
+        else:
+            self.userVisitorId = ""
+        return self
+
+    def set_visitor_id_resolver(self, resolver):
+        """
+        Sets resolver used by set_user_id() to derive the visitor ID from the User ID.
+
+        * @param matomo.ids.VisitorIdResolver resolver Set to None to disable
+        * @return self
+        """
+        self.visitorIdResolver = resolver
         return self
 
     def get_user_id_hashed(self, id):
@@ -1214,10 +1569,10 @@ class MatomoTracker:
 
         Note: matches implementation of Tracker Request.get_user_id_hashed()
 
-        * @param id
+        * @param str id
         * @return str
         """
-        return hashlib.sha1(id).hexdigest()[:16]
+        return hash_user_id(id)
 
     def set_visitor_id(self, visitor_id):
         """
@@ -1226,7 +1581,8 @@ class MatomoTracker:
         Rather than letting Matomo attribute the user with a heuristic based on IP and other user
         fingerprinting attributes, force the action to be recorded for a particular visitor.
 
-        If not set, the visitor ID will be fetched from the 1st party cookie, or will be set to a random UUID.
+        If not set, the visitor ID will be derived from the User ID (when a visitor ID resolver is set),
+        fetched from the 1st party cookie, or will be set to a random UUID.
 
         * @param str visitor_id 16 hexadecimal characters visitor ID, e.g. "33c31e01394bdc63"
         * @return self
@@ -1258,6 +1614,8 @@ class MatomoTracker:
         """
         if self.forcedVisitorId:
             return self.forcedVisitorId
+        if self.userVisitorId:
+            return self.userVisitorId
         if self.load_visitor_id_cookie():
             return self.cookieVisitorId
         return self.randomVisitorId
@@ -1489,12 +1847,10 @@ class MatomoTracker:
     def get_timestamp(self):
         """
         Returns current timestamp, or forced timestamp/datetime if it was set
-        * @return str|int
+        * @return float
         """
         if self.forcedDatetime:
-            return datetime.strptime(
-                self.forcedDatetime, "%Y-%m-%d %H:%M:%S"
-            ).timestamp()
+            return get_forced_timestamp(self.forcedDatetime)
         else:
             return time.time()
 
@@ -1523,128 +1879,91 @@ class MatomoTracker:
     """
 
     def get_request(self, id_site):
+        """
+        Returns URL of a tracking request with the tracker's current state, or a
+        DeferredUrl with a snapshot of it if deferred serialization is enabled.
+
+        * @param int id_site
+        * @return str|DeferredUrl
+        """
+        snapshot = self.capture_request(id_site)
+        if self.deferSerialization:
+            return DeferredUrl(snapshot)
+        return format_request(snapshot)
+
+    def capture_request(self, id_site):
+        """
+        Sets first party cookies and captures tracker state needed by a tracking
+        request, then resets page level state like sending the request would.
+
+        * @param int id_site
+        * @return RequestSnapshot
+        * @ignore
+        """
         self.set_first_party_cookies()
 
-        custom_fields = ""
-        if self.customParameters:
-            custom_fields = "&" + urlencode_plus(self.customParameters)
-
-        custom_dimensions = ""
-        if self.customDimensions:
-            custom_dimensions = "&" + urlencode_plus(self.customDimensions)
-
-        base_url = self.get_base_url()
-        start = "?"
-        if strpos(base_url, "?"):
-            start = "&"
-
-        url = (
-            f"{base_url}{start}idsite={id_site}&rec=1&apiv={self.VERSION}"
-            + f"&r={str(random.randint(0, 2147483647))[2:8]}"
-            + (f"&cip={self.ip}" if self.ip and self.token_auth else "")
-            + (f"&uid={urlencode_plus(self.user_id)}" if self.user_id else "")
-            + (
-                "&cdt=" + urlencode_plus(self.forcedDatetime)
-                if self.forcedDatetime
-                else ""
-            )
-            + ("&new_visit=1" if self.forcedNewVisit else "")
-            + f"&_idts={self.createTs}{self.plugins}"
-            + (
-                f"&h={self.local_hour}&m={self.local_minute}&s={self.local_second}"
+        snapshot = RequestSnapshot(
+            self.get_base_url(),
+            id_site,
+            self.VERSION,
+            self.idSource.cache_buster(),
+            self.ip if self.ip and self.token_auth else "",
+            self.user_id,
+            self.forcedDatetime,
+            self.forcedNewVisit,
+            self.createTs,
+            self.plugins,
+            (
+                (self.local_hour, self.local_minute, self.local_second)
                 if self.local_hour and self.local_minute and self.local_second
+                else None
+            ),
+            (self.width, self.height) if self.width and self.height else None,
+            self.hasCookies,
+            self.customData,
+            # Visit scope variables are updated in place, the others are replaced
+            dict(self.visitorCustomVar) if self.visitorCustomVar else None,
+            self.pageCustomVar,
+            self.eventCustomVar,
+            self.forcedVisitorId or None,
+            None if self.forcedVisitorId else self.get_visitor_id(),
+            self.pageUrl,
+            self.urlReferrer,
+            (
+                self.pageCharset
+                if self.pageCharset and self.pageCharset != self.DEFAULT_CHARSET_PARAMETER_VALUES
                 else ""
-            )
-            + (f"&res={self.width}x{self.height}" if self.width and self.height else "")
-            + (f"&cookie={self.hasCookies}" if self.hasCookies else "")
-            + (f"&data={self.customData}" if self.customData else "")
-            + (
-                "&_cvar=" + urlencode_plus(json.dumps(self.visitorCustomVar))
-                if self.visitorCustomVar
-                else ""
-            )
-            + (
-                "&cvar=" + urlencode_plus(json.dumps(self.pageCustomVar))
-                if self.pageCustomVar
-                else ""
-            )
-            + (
-                "&e_cvar=" + urlencode_plus(json.dumps(self.eventCustomVar))
-                if self.eventCustomVar
-                else ""
-            )
-            + (
-                f"&cid={self.forcedVisitorId}"
-                if self.forcedVisitorId
-                else f"&_id={self.get_visitor_id()}"
-            )
-            + "&url="
-            + urlencode_plus(self.pageUrl or "")
-            + "&urlref="
-            + urlencode_plus(self.urlReferrer or "")
-            + (
-                f"&cs={self.pageCharset}"
-                if (
-                    self.pageCharset
-                    and self.pageCharset != self.DEFAULT_CHARSET_PARAMETER_VALUES
+            ),
+            self.idPageview,
+            self.attributionInfo,
+            self.country,
+            self.region,
+            self.city,
+            self.lat,
+            self.long,
+            self.customParameters,
+            self.customDimensions,
+            self.sendImageResponse,
+            (self.clientHintsKey, self.clientHints) if self.clientHints else None,
+            self.DEBUG_APPEND_URL,
+            (
+                (
+                    self.networkTime,
+                    self.serverTime,
+                    self.transferTime,
+                    self.domProcessingTime,
+                    self.domCompletionTime,
+                    self.onLoadTime,
                 )
-                else ""
-            )
-            + (f"&pv_id={urlencode_plus(self.idPageview)}" if self.idPageview else "")
-            + (
-                "&_rcn=" + urlencode_plus(self.attributionInfo[0])
-                if self.attributionInfo and self.attributionInfo[0]
-                else ""
-            )
-            + (
-                "&_rck=" + urlencode_plus(self.attributionInfo[1])
-                if self.attributionInfo and self.attributionInfo[1]
-                else ""
-            )
-            + (
-                "&_refts=" + str(self.attributionInfo[2])
-                if self.attributionInfo and self.attributionInfo[2]
-                else ""
-            )
-            + (
-                "&_ref=" + urlencode_plus(self.attributionInfo[3])
-                if self.attributionInfo and self.attributionInfo[3]
-                else ""
-            )
-            + (f"&country={urlencode_plus(self.country)}" if self.country else "")
-            + (f"&region={urlencode_plus(self.region)}" if self.region else "")
-            + (f"&city={urlencode_plus(self.city)}" if self.city else "")
-            + (f"&lat={urlencode_plus(str(self.lat))}" if self.lat else "")
-            + (f"&long={urlencode_plus(str(self.long))}" if self.long else "")
-            + custom_fields
-            + custom_dimensions
-            + ("&send_image=0" if not self.sendImageResponse else "")
-            + (f"&uadata={urlencode_plus(json.dumps(self.clientHints))}" if self.clientHints else "")
-            + self.DEBUG_APPEND_URL
+                if self.idPageview
+                else None
+            ),
+            self.ecommerceView,
         )
 
         if self.idPageview:
-            url += (
-                (f"&pf_net={self.networkTime}" if self.networkTime else "")
-                + (f"&pf_srv={self.serverTime}" if self.serverTime else "")
-                + (f"&pf_tfr={self.transferTime}" if self.transferTime else "")
-                + (
-                    f"&pf_dm1={self.domProcessingTime}"
-                    if self.domProcessingTime
-                    else ""
-                )
-                + (
-                    f"&pf_dm2={self.domCompletionTime}"
-                    if self.domCompletionTime
-                    else ""
-                )
-                + (f"&pf_onl={self.onLoadTime}" if self.onLoadTime else "")
-            )
             self.clear_performance_timings()
 
-        for key in self.ecommerceView:
-            url += f"&{key}={urlencode_plus(self.ecommerceView[key])}"
-
         # Reset page level custom variables after this page view
         self.ecommerceView = {}
         self.pageCustomVar = {}
@@ -1655,7 +1974,7 @@ class MatomoTracker:
         # force new visit only once, user must call again set_force_new_visit()
         self.forcedNewVisit = False
 
-        return url
+        return snapshot
 
     def get_cookie_matching_name(self, name):
         """
@@ -0,0 +1,634 @@
+import collections
+import copy
+import http.client
+import json
+import logging
+import os
+import socket
+import ssl
+import threading
+import weakref
+from urllib.parse import quote, urlencode, urlsplit
+
+import requests
+
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Transports send prepared tracking requests to Matomo.
+
+Matomo.send_request() prepares URL, POST data, headers and cookies and hands
+them to tracker's transport, which only does the HTTP I/O:
+
+    RequestsTransport   -- sends with requests (default)
+    HTTPClientTransport -- sends with http.client over persistent connections,
+                           which has less per request overhead than requests
+    UnixSocketTransport -- sends with http.client over a Unix domain socket
+    MemoryTransport     -- records requests without sending them, for tests and
+                           benchmarks of everything but the network
+
+Transports are shared by trackers and must be thread safe. Transports holding
+connections, pools or threads reset them in forked children, so processes
+forked by preloading servers never share them.
+"""
+
+
+# Components whose connections, queues or threads must not be used by forked children
+_fork_sensitive = weakref.WeakSet()
+
+
+def _reset_after_fork():
+    global _futures_lock
+    _futures_lock = threading.Lock()
+    for component in list(_fork_sensitive):
+        component.reset_after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def register_after_fork(component):
+    """
+    Calls component.reset_after_fork() in forked children of the current process.
+
+    * @param component Object with reset_after_fork() method
+    """
+    _fork_sensitive.add(component)
+
+
+class Response:
+    """
+    Minimal HTTP response returned by transports that don't use requests.
+
+    Mimics the parts of requests.Response used by tracker users.
+    """
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", "replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def __repr__(self):
+        return f"<Response [{self.status_code}]>"
+
+
+# Guards callbacks and waiting of all HitFutures, which are rarely used together
+_futures_lock = threading.Lock()
+
+
+def _run_callback(callback, future):
+    try:
+        callback(future)
+    except Exception:
+        logger.exception("Callback of Matomo hit future failed.")
+
+
+class HitFuture(Response):
+    """
+    Accepted response of a queued or stored hit, resolved when the bulk request
+    containing it is acknowledged by Matomo.
+
+    delivered is None until then, True when Matomo tracked the hit and False when
+    sending failed, Matomo reported the hit as invalid or it was dropped. Hits
+    handed off to another process stay unresolved, see resolve_bulk. State for
+    callbacks and waiting is only allocated when they are used.
+
+    * @param int status_code (optional) 202 for accepted hits, 503 for dropped ones,
+        which are resolved as not delivered
+    """
+
+    def __init__(self, status_code=202):
+        super().__init__(status_code, {}, b"")
+        self.delivered = None if status_code == 202 else False
+        self._callbacks = None
+        self._event = None
+
+    @classmethod
+    def combine(cls, futures):
+        """
+        Returns a future delivered when all futures are delivered.
+
+        * @param list futures
+        * @return HitFuture With status code 503 if any of futures was dropped
+        """
+        if any(future.status_code != 202 for future in futures):
+            return cls(503)
+        combined = cls()
+        pending = [len(futures)]
+
+        def resolve(future):
+            if not future.delivered:
+                combined.set_result(False)
+                return
+            with _futures_lock:
+                pending[0] -= 1
+                last = pending[0] == 0
+            if last:
+                combined.set_result(True)
+
+        if not futures:
+            combined.set_result(True)
+        for future in futures:
+            future.add_done_callback(resolve)
+        return combined
+
+    def done(self):
+        """
+        * @return bool Whether the future is resolved
+        """
+        return self.delivered is not None
+
+    def set_result(self, delivered):
+        """
+        Resolves the future and calls its callbacks. Later calls are ignored.
+
+        * @param bool delivered
+        """
+        with _futures_lock:
+            if self.delivered is not None:
+                return
+            self.delivered = bool(delivered)
+            callbacks, self._callbacks = self._callbacks, None
+            if self._event is not None:
+                self._event.set()
+        for callback in callbacks or ():
+            _run_callback(callback, self)
+
+    def add_done_callback(self, callback):
+        """
+        Calls callback with the future when it is resolved, right away if it already
+        is. Callbacks usually run in the thread sending the bulk request and
+        exceptions they raise are logged.
+
+        * @param callable callback
+        """
+        with _futures_lock:
+            if self.delivered is None:
+                if self._callbacks is None:
+                    self._callbacks = []
+                self._callbacks.append(callback)
+                return
+        _run_callback(callback, self)
+
+    def result(self, timeout=None):
+        """
+        Waits until the future is resolved.
+
+        * @param float timeout (optional) Maximum number of seconds to wait
+        * @throws TimeoutError
+        * @return bool Whether the hit was delivered
+        """
+        with _futures_lock:
+            if self.delivered is None and self._event is None:
+                self._event = threading.Event()
+            event = self._event
+        if event is not None and not event.wait(timeout):
+            raise TimeoutError("Matomo hit was not acknowledged in time")
+        return self.delivered
+
+
+def _outcome(task):
+    # Response of a finished asyncio task or greenlet, None if sending failed
+    try:
+        if hasattr(task, "result"):
+            return task.result()
+        return task.get() if hasattr(task, "get") else task.wait()
+    except BaseException:
+        return None
+
+
+def resolve_bulk(futures, response):
+    """
+    Resolves futures of hits sent in a bulk request from its response.
+
+    Hits listed in the response's invalid_indices are not delivered. Matomo only
+    lists them for authenticated requests, so without them all hits of a request
+    with invalid hits are considered not delivered. Responses that are still
+    pending, like asyncio tasks, greenlets or HitFutures of hits queued again,
+    resolve the futures when they finish. 202 responses of transports that only
+    hand hits off to another process, like AgentTransport and RingTransport, are
+    not an acknowledgement by Matomo and leave the futures unresolved.
+
+    * @param list futures HitFutures in order of the bulk request's hits
+    * @param response Response of the bulk request, None if sending failed
+    """
+    if not futures:
+        return
+    if isinstance(response, HitFuture):
+        response.add_done_callback(
+            lambda done: [future.set_result(done.delivered) for future in futures]
+        )
+        return
+    if hasattr(response, "add_done_callback"):
+        response.add_done_callback(lambda task: resolve_bulk(futures, _outcome(task)))
+        return
+    if hasattr(response, "link"):
+        response.link(lambda greenlet: resolve_bulk(futures, _outcome(greenlet)))
+        return
+
+    if response is not None and response.status_code == 202:
+        # Accepted by a forwarder, which doesn't report whether Matomo tracked them
+        return
+    delivered = response is not None and response.ok
+    invalid = ()
+    if delivered:
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+        if isinstance(body, dict):
+            if body.get("invalid_indices") is not None:
+                invalid = set(body["invalid_indices"])
+            elif body.get("invalid"):
+                delivered = False
+    for index, future in enumerate(futures):
+        future.set_result(delivered and index not in invalid)
+
+
+def hit_query(url, data=None, headers=None):
+    """
+    Returns a compact record of a tracking request: its query string with POST
+    data (except token_auth), user agent and browser language appended.
+
+    Such records are valid entries of bulk requests.
+
+    * @param str url
+    * @param dict data (optional) POST data
+    * @param dict headers (optional) Request headers
+    * @return str Query string starting with '?'
+    """
+    hit = "?" + urlsplit(url).query
+    if data:
+        data = {name: value for name, value in data.items() if name != "token_auth"}
+        if data:
+            hit += "&" + urlencode(data, doseq=True)
+    headers = headers or {}
+    if headers.get("user-agent"):
+        hit += "&ua=" + quote(headers["user-agent"])
+    if headers.get("accept-language"):
+        hit += "&lang=" + quote(headers["accept-language"])
+    return hit
+
+
+class Transport:
+    """
+    Base class of transports.
+
+    Keyword arguments of send() and send_bulk():
+
+    * @param dict headers Request headers, empty values are not sent
+    * @param dict cookies Cookies sent with the request
+    * @param dict proxies requests style proxies
+    * @param int timeout Timeout in seconds
+    * @param str cert Path to client certificate file
+
+    Transports that send hits later set QUEUED, so trackers add the time hits were
+    tracked as cdt. Transports that can send from an event loop also implement
+    send_async() and send_bulk_async() coroutines with the same arguments, which
+    async trackers await instead of calling send() and send_bulk().
+    """
+
+    QUEUED = False
+
+    def send(self, method, url, data=None, **options):
+        """
+        Sends one tracking request.
+
+        * @param str method 'GET' or 'POST'
+        * @param str url
+        * @param dict data (optional) POST data, sent URL encoded
+        * @return Response
+        """
+        raise NotImplementedError
+
+    def send_bulk(self, url, data, **options):
+        """
+        Sends a bulk tracking request.
+
+        * @param str url
+        * @param dict data Bulk request with 'requests' and optional 'token_auth', sent as JSON
+        * @return Response
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Releases connections held by the transport.
+        """
+
+    def reset_after_fork(self):
+        """
+        Drops state inherited from the parent process. Called in forked children of
+        transports registered with register_after_fork().
+        """
+
+
+class RequestsTransport(Transport):
+    """
+    Sends tracking requests with requests.
+
+    * @param requests.Session session (optional) Session reused for all requests
+    """
+
+    def __init__(self, session=None):
+        self.session = session
+        register_after_fork(self)
+
+    @property
+    def http(self):
+        return requests if self.session is None else self.session
+
+    def send(
+        self,
+        method,
+        url,
+        data=None,
+        headers=None,
+        cookies=None,
+        proxies=None,
+        timeout=None,
+        cert=None,
+    ):
+        if method == "POST":
+            return self.http.post(
+                url,
+                data=data,
+                headers=headers,
+                proxies=proxies,
+                timeout=timeout,
+                cookies=cookies,
+                cert=cert,
+            )
+        return self.http.get(
+            url,
+            headers=headers,
+            proxies=proxies,
+            timeout=timeout,
+            cookies=cookies,
+            cert=cert,
+        )
+
+    def send_bulk(
+        self, url, data, headers=None, cookies=None, proxies=None, timeout=None, cert=None
+    ):
+        return self.http.post(
+            url,
+            json=data,
+            headers=headers,
+            proxies=proxies,
+            timeout=timeout,
+            cookies=cookies,
+            cert=cert,
+        )
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+
+    def reset_after_fork(self):
+        # The inherited session is dropped without closing it, because its pools'
+        # locks may have been held by threads that don't exist in the child
+        if self.session is not None:
+            self.session = copy_session(self.session)
+
+
+def copy_session(session):
+    """
+    Returns a copy of a requests session with the same configuration and new
+    connection pools.
+
+    * @param requests.Session session
+    * @return requests.Session
+    """
+    fresh = copy.copy(session)
+    # Copies of adapters initialize new pool managers
+    fresh.adapters = collections.OrderedDict(
+        (prefix, copy.copy(adapter)) for prefix, adapter in session.adapters.items()
+    )
+    fresh.cookies = session.cookies.copy()
+    return fresh
+
+
+class _ThreadConnections(dict):
+    """
+    Connections of one thread, closed when the thread exits and its thread-local
+    data is deleted.
+    """
+
+    def __del__(self):
+        for connection in self.values():
+            connection.close()
+
+
+class HTTPClientTransport(Transport):
+    """
+    Sends tracking requests with http.client.
+
+    Every thread keeps one persistent connection per Matomo host, closed when the
+    thread exits. A request failing because the server closed a kept-alive
+    connection is retried once on a new connection. Proxies are not supported.
+    """
+
+    # Errors of requests on connections the server closed while they were idle
+    STALE_CONNECTION_ERRORS = (
+        http.client.RemoteDisconnected,
+        BrokenPipeError,
+        ConnectionResetError,
+    )
+
+    def __init__(self):
+        self.reset_after_fork()
+        register_after_fork(self)
+
+    def reset_after_fork(self):
+        # Inherited connections are dropped without shutting them down
+        self._local = threading.local()
+        self._connections = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    def get_connection(self, scheme, netloc, timeout, cert):
+        """
+        Returns calling thread's connection to a host, opening it when needed.
+
+        * @return http.client.HTTPConnection
+        """
+        connections = getattr(self._local, "connections", None)
+        if connections is None:
+            connections = self._local.connections = _ThreadConnections()
+        key = (scheme, netloc, cert)
+        connection = connections.get(key)
+        if connection is None:
+            connection = self.create_connection(scheme, netloc, timeout, cert)
+            connections[key] = connection
+            with self._lock:
+                self._connections.add(connection)
+        connection.timeout = timeout
+        return connection
+
+    def create_connection(self, scheme, netloc, timeout, cert):
+        """
+        * @return http.client.HTTPConnection
+        """
+        if scheme == "https":
+            context = ssl.create_default_context()
+            if cert:
+                context.load_cert_chain(cert)
+            return http.client.HTTPSConnection(netloc, timeout=timeout, context=context)
+        return http.client.HTTPConnection(netloc, timeout=timeout)
+
+    def request(
+        self,
+        method,
+        url,
+        body,
+        content_type,
+        headers=None,
+        cookies=None,
+        proxies=None,
+        timeout=None,
+        cert=None,
+    ):
+        """
+        Sends a request over a persistent connection and reads the whole response.
+
+        * @return Response
+        """
+        if proxies:
+            raise Exception("Proxies are not supported by HTTPClientTransport")
+        parts = urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        request_headers = {name: value for name, value in (headers or {}).items() if value}
+        if cookies:
+            request_headers["Cookie"] = "; ".join(
+                f"{name}={value}" for name, value in cookies.items()
+            )
+        if body is not None:
+            request_headers["Content-Type"] = content_type
+
+        connection = self.get_connection(parts.scheme, parts.netloc, timeout, cert)
+        # Only connections that were already open can have gone stale
+        reused = connection.sock is not None
+        try:
+            try:
+                response, content = self.exchange(connection, method, path, body, request_headers)
+            except self.STALE_CONNECTION_ERRORS:
+                if not reused:
+                    raise
+                # A closed connection reconnects on the next request
+                connection.close()
+                response, content = self.exchange(connection, method, path, body, request_headers)
+        except Exception:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        return Response(response.status, dict(response.getheaders()), content)
+
+    def exchange(self, connection, method, path, body, headers):
+        """
+        Sends a request over connection and reads the whole response.
+
+        * @return tuple (http.client.HTTPResponse, bytes)
+        """
+        connection.request(method, path, body=body, headers=headers)
+        response = connection.getresponse()
+        return response, response.read()
+
+    def send(self, method, url, data=None, **options):
+        body = None
+        if method == "POST":
+            body = urlencode(data or {}, doseq=True)
+        return self.request(method, url, body, "application/x-www-form-urlencoded", **options)
+
+    def send_bulk(self, url, data, **options):
+        return self.request("POST", url, json.dumps(data), "application/json", **options)
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = list(self._connections), weakref.WeakSet()
+        for connection in connections:
+            connection.close()
+        self._local = threading.local()
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTP connection over a Unix domain socket.
+    """
+
+    def __init__(self, host, socket_path, timeout=None):
+        super().__init__(host, timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        try:
+            self.sock.connect(self.socket_path)
+        except OSError:
+            self.sock.close()
+            self.sock = None
+            raise
+
+
+class UnixSocketTransport(HTTPClientTransport):
+    """
+    Sends tracking requests over a Unix domain socket to a co-located Matomo or
+    a proxy in front of it, e.g. nginx listening on unix:/run/matomo.sock.
+
+    Tracker's API URL is still used for the path and Host header. Connections
+    are persistent like with HTTPClientTransport; TLS is not used.
+
+    * @param str socket_path Path of the Unix domain socket
+    """
+
+    def __init__(self, socket_path):
+        super().__init__()
+        self.socket_path = socket_path
+
+    def create_connection(self, scheme, netloc, timeout, cert):
+        return UnixHTTPConnection(netloc, self.socket_path, timeout=timeout)
+
+
+class MemoryTransport(Transport):
+    """
+    Records tracking requests instead of sending them.
+
+    Single requests are stored in requests as (method, url, data) tuples and bulk
+    requests in bulk_requests as (url, data) tuples. Responses mimic Matomo's.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.bulk_requests = []
+
+    def send(self, method, url, data=None, **options):
+        self.requests.append((method, url, data))
+        return Response(204, {}, b"")
+
+    def send_bulk(self, url, data, **options):
+        self.bulk_requests.append((url, data))
+        content = json.dumps(
+            {"status": "success", "tracked": len(data["requests"]), "invalid": 0}
+        ).encode("utf-8")
+        return Response(200, {"content-type": "application/json"}, content)
+
+
+default_transport = RequestsTransport()
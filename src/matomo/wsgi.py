@@ -0,0 +1,182 @@
+import collections.abc
+import functools
+import logging
+import re
+
+import matomo
+from matomo.lazy import LazyTracker, get_tracker
+from matomo.request import format_set_cookie, parse_cookies
+
+
+logger = logging.getLogger(__name__)
+
+
+"""
+WSGI middleware for Flask, Pyramid and other WSGI applications.
+
+Tracking requests are recorded while the application runs and sent after the
+server has sent the response and closes the response iterable.
+"""
+
+
+class EnvironRequest(collections.abc.Mapping):
+    """
+    Read-only view of a WSGI environ usable as tracker's request.
+
+    Nothing is copied, HTTPS and cookies are derived from environ on demand.
+    """
+
+    def __init__(self, environ):
+        self.environ = environ
+        self._cookie = None
+
+    def __getitem__(self, key):
+        if key == "HTTPS":
+            return self.environ.get("wsgi.url_scheme") == "https"
+        return self.environ[key]
+
+    def __contains__(self, key):
+        return key == "HTTPS" or key in self.environ
+
+    def __iter__(self):
+        yield "HTTPS"
+        for key in self.environ:
+            if key != "HTTPS":
+                yield key
+
+    def __len__(self):
+        return len(self.environ) + (0 if "HTTPS" in self.environ else 1)
+
+    @property
+    def cookie(self):
+        if self._cookie is None:
+            header = self.environ.get("HTTP_COOKIE")
+            self._cookie = parse_cookies(header) if header else {}
+        return self._cookie
+
+
+class Matomo(matomo.Matomo):
+    """
+    Tracker for WSGI applications.
+
+    Its response is a dict with 'status' and 'headers' passed to start_response
+    and cookies are added to its headers.
+    """
+
+    def set_response(self, response):
+        self.response = response
+        self.set_first_party_cookies()
+
+    def set_cookie_response(
+        self,
+        cookie_name,
+        cookie_value,
+        max_age=None,
+        path="/",
+        domain=None,
+        secure=False,
+        httponly=False,
+        samesite=None,
+    ):
+        if self.response is None:
+            logger.warning("No response instance set to set cookies on.")
+            return
+        cookie = format_set_cookie(
+            cookie_name,
+            cookie_value,
+            max_age=max_age,
+            path=path,
+            domain=domain,
+            secure=secure,
+            httponly=httponly,
+            samesite=samesite,
+        )
+        self.response["headers"].append(("Set-Cookie", cookie))
+
+
+class ClosingIterator:
+    """
+    Wraps application's response iterable and sends recorded tracking requests
+    when the server closes it.
+    """
+
+    def __init__(self, iterable, tracker):
+        self.iterable = iterable
+        self.tracker = tracker
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, "close"):
+                self.iterable.close()
+        finally:
+            tracker = get_tracker(self.tracker)
+            if tracker is not None and tracker.storedTrackingActions:
+                try:
+                    tracker.do_bulk_track()
+                except Exception:
+                    logger.exception("Sending deferred Matomo tracking requests failed.")
+
+
+class MatomoMiddleware:
+    """
+    Matomo WSGI middleware
+
+    It stores a lazily created tracker in environ["matomo.tracker"]. The tracker
+    is built only when the application uses it and records tracking requests in
+    bulk mode. First party cookies are added to the response headers and
+    recorded requests are sent in bulk when the server closes the response
+    iterable, after the response was sent to the client.
+
+    Page views of paths matching any of track_paths regular expressions are
+    tracked automatically for responses with status codes below 400.
+
+    * @param app WSGI application
+    * @param int id_site
+    * @param str api_url
+    * @param list track_paths (optional) Regular expressions of automatically tracked paths
+    * @param type tracker_class (optional) Tracker class
+    """
+
+    ENVIRON_KEY = "matomo.tracker"
+
+    def __init__(self, app, id_site, api_url, track_paths=(), tracker_class=Matomo):
+        self.app = app
+        self.id_site = id_site
+        self.api_url = api_url
+        self.track_paths = [re.compile(pattern) for pattern in track_paths]
+        self.tracker_class = tracker_class
+
+    def __call__(self, environ, start_response):
+        lazy_tracker = LazyTracker(functools.partial(self.create_tracker, environ))
+        environ[self.ENVIRON_KEY] = lazy_tracker
+
+        def tracking_start_response(status, headers, exc_info=None):
+            headers = self.finalize_tracker(environ, lazy_tracker, status, headers)
+            return start_response(status, headers, exc_info)
+
+        return ClosingIterator(self.app(environ, tracking_start_response), lazy_tracker)
+
+    def create_tracker(self, environ):
+        tracker = self.tracker_class(EnvironRequest(environ), self.id_site, self.api_url)
+        tracker.enable_bulk_tracking()
+        return tracker
+
+    def is_tracked_path(self, path):
+        return any(pattern.search(path) for pattern in self.track_paths)
+
+    def finalize_tracker(self, environ, lazy_tracker, status, headers):
+        if int(status.split(" ", 1)[0]) < 400 and self.is_tracked_path(
+            environ.get("PATH_INFO", "")
+        ):
+            lazy_tracker.do_track_page_view("")
+
+        tracker = get_tracker(lazy_tracker)
+        if tracker is None:
+            return headers
+
+        response = {"status": status, "headers": list(headers)}
+        tracker.set_response(response)
+        return response["headers"]
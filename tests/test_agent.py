@@ -0,0 +1,158 @@
+import re
+import socket
+import threading
+import time
+
+import pytest
+
+import matomo
+from matomo.agent import Agent, AgentTransport
+from matomo.request import Request
+from matomo.transport import MemoryTransport, Response, Transport
+
+
+pytestmark = pytest.mark.skipif(
+    not hasattr(socket, "AF_UNIX"), reason="Unix domain sockets not supported"
+)
+
+
+class FailingTransport(Transport):
+    def __init__(self):
+        self.attempts = 0
+        self.attempted = threading.Event()
+
+    def send_bulk(self, url, data, **options):
+        self.attempts += 1
+        self.attempted.set()
+        return Response(500, {}, b"")
+
+
+def run_agent(agent):
+    agent.bind()
+    thread = threading.Thread(target=agent.serve_forever)
+    thread.start()
+    return thread
+
+
+def test_agent_forwards_hits_in_bulk(tmp_path):
+    path = str(tmp_path / "agent.sock")
+    memory = MemoryTransport()
+    agent = Agent(
+        path,
+        "https://matomo.domain.example",
+        token_auth="secret",
+        batch_size=3,
+        flush_interval=0.05,
+        transport=memory,
+    )
+    thread = run_agent(agent)
+
+    transport = AgentTransport(path)
+    request = Request({"HTTP_USER_AGENT": "Fake Mozilla"})
+    tracker = matomo.Matomo(request, 1, "https://matomo.domain.example").set_transport(transport)
+    for number in range(4):
+        assert tracker.do_track_event("music", "play", str(number)).status_code == 202
+
+    agent.stop()
+    thread.join()
+    transport.close()
+
+    assert agent.sent == 4
+    assert [len(data["requests"]) for _, data in memory.bulk_requests] == [3, 1]
+    url, data = memory.bulk_requests[0]
+    assert url == "https://matomo.domain.example/matomo.php"
+    assert data["token_auth"] == "secret"
+    assert data["requests"][0].startswith("?idsite=1&rec=1")
+    assert re.search(r"&e_n=0&cdt=\d+&ua=Fake%20Mozilla$", data["requests"][0])
+
+
+def test_agent_spools_unsent_hits(tmp_path):
+    path = str(tmp_path / "agent.sock")
+    spool = tmp_path / "spool"
+    agent = Agent(
+        path,
+        "https://matomo.domain.example",
+        flush_interval=0.05,
+        spool_path=str(spool),
+        transport=FailingTransport(),
+    )
+    thread = run_agent(agent)
+    transport = AgentTransport(path)
+    transport.send_hit("?idsite=1&rec=1&e_c=music")
+    transport.send_hit("?idsite=1&rec=1&e_c=video")
+    agent.stop()
+    thread.join()
+
+    assert agent.spilled == 2
+    assert spool.read_text().splitlines() == [
+        "?idsite=1&rec=1&e_c=music",
+        "?idsite=1&rec=1&e_c=video",
+    ]
+
+    memory = MemoryTransport()
+    agent = Agent(
+        path,
+        "https://matomo.domain.example",
+        flush_interval=0.05,
+        spool_path=str(spool),
+        transport=memory,
+    )
+    thread = run_agent(agent)
+    agent.stop()
+    thread.join()
+
+    assert agent.sent == 2
+    assert not spool.exists()
+
+
+def test_agent_backs_off_full_batches(tmp_path):
+    path = str(tmp_path / "agent.sock")
+    failing = FailingTransport()
+    agent = Agent(
+        path,
+        "https://matomo.domain.example",
+        batch_size=1,
+        flush_interval=1,
+        max_pending=2,
+        transport=failing,
+    )
+    thread = run_agent(agent)
+    transport = AgentTransport(path)
+    try:
+        transport.send_hit("?idsite=1&rec=1&e_c=music")
+        assert failing.attempted.wait(5)
+        for _ in range(5):
+            transport.send_hit("?idsite=1&rec=1&e_c=video")
+        time.sleep(0.3)
+        # Full batches wait for the 2 s backoff instead of being retried per hit
+        assert failing.attempts == 1
+        # ... and hits over max_pending don't pile up in memory meanwhile
+        assert len(agent.pending) == 2
+        assert agent.dropped == 4
+    finally:
+        agent.stop()
+        thread.join()
+    assert agent.dropped == 6
+
+
+def test_agent_spool_without_token_warns(tmp_path, caplog):
+    Agent(str(tmp_path / "agent.sock"), "https://matomo.domain.example")
+    Agent(
+        str(tmp_path / "agent.sock"),
+        "https://matomo.domain.example",
+        token_auth="secret",
+        spool_path=str(tmp_path / "spool"),
+    )
+    assert "Agent spool" not in caplog.text
+    Agent(
+        str(tmp_path / "agent.sock"),
+        "https://matomo.domain.example",
+        spool_path=str(tmp_path / "spool"),
+    )
+    assert "Agent spool may send hits more than 86400 seconds" in caplog.text
+
+
+def test_agent_transport_without_agent(tmp_path):
+    transport = AgentTransport(str(tmp_path / "missing.sock"))
+    assert not transport.send_hit("?idsite=1")
+    assert transport.dropped == 1
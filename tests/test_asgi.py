@@ -0,0 +1,172 @@
+import asyncio
+import json
+
+from matomo.aio import _background_tasks, http_request, run_in_background
+from matomo.asgi import Matomo, MatomoMiddleware, ScopeRequest
+from matomo.dispatch import Dispatcher
+from matomo.lazy import get_tracker
+from matomo.transport import MemoryTransport
+
+
+def make_scope(path="/page", headers=()):
+    return {
+        "type": "http",
+        "scheme": "https",
+        "path": path,
+        "root_path": "",
+        "query_string": b"a=1",
+        "client": ("192.168.0.1", 5555),
+        "headers": [(b"host", b"test.domain.example"), *headers],
+    }
+
+
+async def start_matomo_server(received):
+    async def handle(reader, writer):
+        head = await reader.readuntil(b"\r\n\r\n")
+        length = 0
+        for line in head.split(b"\r\n"):
+            if line.lower().startswith(b"content-length:"):
+                length = int(line.split(b":")[1])
+        body = await reader.readexactly(length) if length else b""
+        received.append((head, body))
+        payload = json.dumps({"status": "success"}).encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+            + f"Content-Length: {len(payload)}\r\n\r\n".encode()
+            + payload
+        )
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+def test_scope_request():
+    request = ScopeRequest(
+        make_scope(
+            headers=[
+                (b"cookie", b"_pk_id.1.abcd=1234567890abcdef.1680952180"),
+                (b"user-agent", b"Fake Mozilla"),
+                (b"x-ignored", b"1"),
+            ]
+        )
+    )
+    assert request["HTTP_HOST"] == "test.domain.example"
+    assert request["HTTP_USER_AGENT"] == "Fake Mozilla"
+    assert request["REMOTE_ADDR"] == "192.168.0.1"
+    assert request["QUERY_STRING"] == "a=1"
+    assert request["HTTPS"] is True
+    assert "HTTP_X_IGNORED" not in request
+    assert request.cookie == {"_pk_id.1.abcd": "1234567890abcdef.1680952180"}
+
+
+def test_http_request(mocker):
+    wait_closed = mocker.spy(asyncio.StreamWriter, "wait_closed")
+
+    async def run():
+        received = []
+        server, port = await start_matomo_server(received)
+        async with server:
+            response = await http_request(
+                "POST", f"http://127.0.0.1:{port}/matomo.php", data={"a": "1"}, timeout=5
+            )
+        return response, received
+
+    response, received = asyncio.run(run())
+    assert response.status_code == 200
+    assert response.json() == {"status": "success"}
+    assert received[0][0].startswith(b"POST /matomo.php HTTP/1.1")
+    assert received[0][1] == b"a=1"
+    assert wait_closed.call_count == 1
+
+
+def test_middleware():
+    async def app(scope, receive, send):
+        scope["matomo"].do_track_event("music", "play")
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+    async def run():
+        received = []
+        messages = []
+        server, port = await start_matomo_server(received)
+
+        async def send(message):
+            messages.append(message)
+
+        async with server:
+            middleware = MatomoMiddleware(
+                app, 1, f"http://127.0.0.1:{port}", track_paths=[r"^/page"]
+            )
+            await middleware(make_scope(), None, send)
+            await asyncio.gather(*_background_tasks)
+        return messages, received
+
+    messages, received = asyncio.run(run())
+    headers = dict(messages[0]["headers"])
+    assert b"set-cookie" in headers
+    assert messages[1]["body"] == b"ok"
+    assert len(received) == 1
+    assert received[0][0].startswith(b"POST /matomo.php HTTP/1.1")
+
+
+def test_middleware_uses_tracker_transport():
+    memory = MemoryTransport()
+
+    class MemoryMatomo(Matomo):
+        transport = memory
+
+    async def app(scope, receive, send):
+        scope["matomo"].do_track_event("music", "play")
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+
+    async def send(message):
+        pass
+
+    middleware = MatomoMiddleware(app, 1, "http://127.0.0.1:1", tracker_class=MemoryMatomo)
+    asyncio.run(middleware(make_scope(), None, send))
+    url, data = memory.bulk_requests[0]
+    assert url == "http://127.0.0.1:1/matomo.php"
+    assert "&e_a=play" in data["requests"][0]
+
+
+def test_tracker_queues_hits_on_dispatcher():
+    memory = MemoryTransport()
+    dispatcher = Dispatcher(memory)
+
+    async def run():
+        tracker = Matomo(ScopeRequest(make_scope()), 1, "http://127.0.0.1:1")
+        tracker.set_transport(dispatcher)
+        return tracker.do_track_event("music", "play")
+
+    # Queued without a task, with the time it was tracked
+    assert asyncio.run(run()).status_code == 202
+    assert dispatcher.close(5)
+    hit = memory.bulk_requests[0][1]["requests"][0]
+    assert "&e_a=play" in hit and "&cdt=" in hit
+
+
+def test_middleware_skips_unused_tracker():
+    scopes = []
+
+    async def app(scope, receive, send):
+        scopes.append(scope)
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+    async def send(message):
+        assert message.get("headers", []) == []
+
+    middleware = MatomoMiddleware(app, 1, "http://127.0.0.1:1")
+    asyncio.run(middleware(make_scope(), None, send))
+    assert get_tracker(scopes[0]["matomo"]) is None
+
+
+def test_cancelled_send_is_logged(caplog):
+    async def run():
+        run_in_background(asyncio.sleep(10))
+
+    # Closing the loop cancels the scheduled send
+    asyncio.run(run())
+    assert "Sending Matomo tracking request was cancelled." in caplog.text
@@ -0,0 +1,324 @@
+import json
+import os
+import re
+import signal
+import threading
+import time
+
+import pytest
+
+import matomo
+from matomo.dispatch import Dispatcher, PriorityDispatcher, classify_hit
+from matomo.request import Request
+from matomo.transport import MemoryTransport, Response, Transport
+
+
+class FileTransport(Transport):
+    """Appends hits of bulk requests to a file shared by forked processes."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def send_bulk(self, url, data, **options):
+        time.sleep(0.001)
+        lines = "".join(hit.split("&e_n=")[1].split("&")[0] + "\n" for hit in data["requests"])
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, lines.encode())
+        finally:
+            os.close(fd)
+        return Response(200, {}, b"")
+
+
+def make_tracker(transport):
+    request = Request({"HTTP_USER_AGENT": "Fake Mozilla"})
+    return matomo.Matomo(request, 1, "https://matomo.domain.example").set_transport(transport)
+
+
+def test_dispatcher_sends_in_bulk():
+    memory = MemoryTransport()
+    dispatcher = Dispatcher(memory, batch_size=3, flush_interval=0.05, token_auth="secret")
+    tracker = make_tracker(dispatcher)
+    for number in range(4):
+        assert tracker.do_track_event("music", "play", str(number)).status_code == 202
+
+    assert dispatcher.flush(timeout=5)
+    dispatcher.close()
+
+    assert [len(data["requests"]) for _, data in memory.bulk_requests] == [3, 1]
+    url, data = memory.bulk_requests[0]
+    assert url == "https://matomo.domain.example/matomo.php"
+    assert data["token_auth"] == "secret"
+    assert data["requests"][0].startswith("?idsite=1&rec=1")
+    assert re.search(r"&e_n=0&cdt=\d+&ua=Fake%20Mozilla$", data["requests"][0])
+    assert dispatcher.sent == 4
+
+
+def test_dispatcher_deferred_serialization():
+    memory = MemoryTransport()
+    dispatcher = Dispatcher(memory, batch_size=2, flush_interval=0.05)
+    tracker = make_tracker(dispatcher)
+    tracker.enable_deferred_serialization()
+    futures = [tracker.do_track_event("music", "play", str(number)) for number in range(2)]
+
+    assert [future.result(timeout=5) for future in futures] == [True, True]
+    dispatcher.close()
+    url, data = memory.bulk_requests[0]
+    assert url == "https://matomo.domain.example/matomo.php"
+    assert data["requests"][0].startswith("?idsite=1&rec=1")
+    assert re.search(r"&e_n=1&cdt=\d+&ua=Fake%20Mozilla$", data["requests"][1])
+
+
+class InvalidHitTransport(Transport):
+    """Reports the last hit of each bulk request as invalid."""
+
+    def send_bulk(self, url, data, **options):
+        body = {"status": "success", "tracked": len(data["requests"]) - 1, "invalid": 1}
+        body["invalid_indices"] = [len(data["requests"]) - 1]
+        return Response(200, {}, json.dumps(body).encode())
+
+
+def test_dispatcher_futures():
+    dispatcher = Dispatcher(InvalidHitTransport(), batch_size=2, flush_interval=5)
+    tracker = make_tracker(dispatcher)
+    play = tracker.do_track_event("music", "play")
+    invalid = tracker.do_track_event("music", "pause")
+    assert play.result(timeout=5) is True
+    assert invalid.result(timeout=5) is False
+
+    # Hits of trackers' bulk requests are delivered only if all of them are
+    tracker.enable_bulk_tracking()
+    futures = [tracker.do_track_event("music", "play"), tracker.do_track_event("music", "stop")]
+    tracker.do_bulk_track()
+    assert [future.result(timeout=5) for future in futures] == [False, False]
+    dispatcher.close()
+
+
+class BlockingTransport(Transport):
+    def __init__(self):
+        self.sending = threading.Event()
+        self.release = threading.Event()
+
+    def send_bulk(self, url, data, **options):
+        self.sending.set()
+        self.release.wait(5)
+        return Response(200, {}, b"")
+
+
+def test_dispatcher_drops_when_full():
+    blocking = BlockingTransport()
+    dispatcher = Dispatcher(blocking, batch_size=1, max_queue_size=1)
+    tracker = make_tracker(dispatcher)
+
+    assert tracker.do_track_event("music", "play").status_code == 202
+    assert blocking.sending.wait(5)
+    assert tracker.do_track_event("music", "pause").status_code == 202
+    assert tracker.do_track_event("music", "stop").status_code == 503
+    blocking.release.set()
+    dispatcher.close()
+
+    assert dispatcher.sent == 2
+    assert dispatcher.dropped == 1
+
+
+def test_dispatcher_close_timeout():
+    blocking = BlockingTransport()
+    blocking.close = lambda: setattr(blocking, "closed", True)
+    dispatcher = Dispatcher(blocking, batch_size=1, max_queue_size=1)
+    tracker = make_tracker(dispatcher)
+    tracker.do_track_event("music", "play")
+    assert blocking.sending.wait(5)
+    tracker.do_track_event("music", "pause")
+
+    # The queue stays full and the worker keeps sending
+    started = time.monotonic()
+    assert not dispatcher.close(timeout=0.1)
+    assert time.monotonic() - started < 1
+    assert dispatcher.counts() == (0, 0, 0, 1)
+    assert not hasattr(blocking, "closed")
+
+    blocking.release.set()
+    assert dispatcher.close(timeout=5)
+    assert blocking.closed and dispatcher.sent == 2
+
+
+def test_dispatcher_sheds_oldest():
+    blocking = BlockingTransport()
+    dispatcher = Dispatcher(blocking, batch_size=1, max_queue_size=2, shed="oldest")
+    tracker = make_tracker(dispatcher)
+
+    first = tracker.do_track_event("music", "play")
+    assert blocking.sending.wait(5)
+    oldest = tracker.do_track_event("music", "pause")
+    queued = tracker.do_track_event("music", "next")
+    newest = tracker.do_track_event("music", "stop")
+    assert oldest.delivered is False and newest.status_code == 202
+    blocking.release.set()
+
+    assert [hit.result(timeout=5) for hit in (first, queued, newest)] == [True, True, True]
+    dispatcher.close()
+    assert dispatcher.sent == 3 and dispatcher.dropped == 1
+
+
+def test_dispatcher_never_sheds():
+    blocking = BlockingTransport()
+    dispatcher = Dispatcher(blocking, batch_size=1, max_queue_size=1, shed="never")
+    tracker = make_tracker(dispatcher)
+    tracker.do_track_goal(1, 10.0)
+    assert blocking.sending.wait(5)
+    tracker.do_track_goal(2, 10.0)
+
+    # Waits for room in the queue instead of dropping the hit
+    waiting = threading.Thread(target=tracker.do_track_goal, args=(3, 10.0))
+    waiting.start()
+    waiting.join(0.05)
+    assert waiting.is_alive()
+    blocking.release.set()
+    waiting.join(5)
+
+    assert dispatcher.flush(timeout=5)
+    dispatcher.close()
+    assert dispatcher.sent == 3 and dispatcher.dropped == 0
+
+
+def test_dispatcher_put_timeout():
+    blocking = BlockingTransport()
+    dispatcher = Dispatcher(
+        blocking, batch_size=1, max_queue_size=1, shed="never", put_timeout=0.05
+    )
+    tracker = make_tracker(dispatcher)
+    tracker.do_track_goal(1, 10.0)
+    assert blocking.sending.wait(5)
+    tracker.do_track_goal(2, 10.0)
+
+    assert tracker.do_track_goal(3, 10.0).status_code == 503
+    blocking.release.set()
+    dispatcher.close()
+    assert dispatcher.sent == 2 and dispatcher.dropped == 1
+
+
+class FlakyTransport(Transport):
+    def __init__(self, failures):
+        self.failures = failures
+        self.attempts = 0
+
+    def send_bulk(self, url, data, **options):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise OSError("Matomo is down")
+        return Response(200, {}, b"")
+
+
+def test_dispatcher_retries_failed_batches():
+    flaky = FlakyTransport(failures=2)
+    dispatcher = Dispatcher(flaky, flush_interval=0.01, retries=2)
+    hit = make_tracker(dispatcher).do_track_goal(1, 10.0)
+
+    assert hit.result(timeout=5) is True
+    dispatcher.close()
+    assert flaky.attempts == 3 and dispatcher.sent == 1
+
+
+def test_dispatcher_spills_failed_batches(tmp_path):
+    spill_path = tmp_path / "spill"
+    flaky = FlakyTransport(failures=10)
+    dispatcher = Dispatcher(flaky, flush_interval=0.01, retries=1, spill_path=str(spill_path))
+    tracker = make_tracker(dispatcher)
+    hits = [tracker.do_track_goal(number, 10.0) for number in (1, 2)]
+
+    assert [hit.result(timeout=5) for hit in hits] == [False, False]
+    dispatcher.close()
+    assert flaky.attempts == 2
+    assert dispatcher.counts() == (0, 0, 2, 0)
+    spilled = spill_path.read_text().splitlines()
+    assert len(spilled) == 2 and spilled[0].startswith("?idsite=1&rec=1")
+    assert "&idgoal=1&" in spilled[0] and "&idgoal=2&" in spilled[1]
+
+
+def test_classify_hit():
+    tracker = make_tracker(MemoryTransport())
+    assert classify_hit(tracker.get_url_track_goal(1, 5.0)) == "revenue"
+    tracker.add_ecommerce_item("SKU")
+    assert classify_hit(tracker.get_url_track_ecommerce_order("order", 5.0)) == "revenue"
+    assert classify_hit(tracker.get_url_track_event("music", "play")) == "event"
+    assert classify_hit(tracker.get_request(1) + "&ping=1") == "ping"
+    assert classify_hit(tracker.get_url_track_page_view("Page")) == "default"
+
+
+def test_priority_dispatcher():
+    memory = MemoryTransport()
+    blocking = BlockingTransport()
+    lanes = {
+        "revenue": Dispatcher(memory, flush_interval=0.01, shed="never"),
+        "default": Dispatcher(memory, flush_interval=0.01),
+        "event": Dispatcher(blocking, batch_size=1, max_queue_size=1),
+    }
+    dispatcher = PriorityDispatcher(lanes)
+    tracker = make_tracker(dispatcher)
+
+    # A flood of events fills only their own lane
+    tracker.do_track_event("music", "play")
+    assert blocking.sending.wait(5)
+    events = [tracker.do_track_event("music", "pause") for _ in range(3)]
+    assert [event.status_code for event in events] == [202, 503, 503]
+    goal = tracker.do_track_goal(1, 10.0)
+    ping = tracker.do_ping()
+
+    assert goal.result(timeout=5) and ping.result(timeout=5)
+    blocking.release.set()
+    assert dispatcher.flush(timeout=5)
+    dispatcher.close()
+    assert dispatcher.sent == 4 and dispatcher.dropped == 2
+    hits = [data["requests"][0] for _, data in memory.bulk_requests]
+    assert sorted(classify_hit(hit) for hit in hits) == ["ping", "revenue"]
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="fork not supported")
+def test_dispatcher_after_fork(tmp_path):
+    path = str(tmp_path / "hits")
+    dispatcher = Dispatcher(FileTransport(path), batch_size=10, flush_interval=0.01)
+    tracker = make_tracker(dispatcher)
+    produced = []
+    stop = threading.Event()
+
+    def produce():
+        number = 0
+        while not stop.is_set() or number < 200:
+            tracker.do_track_event("music", "play", f"parent-{number}")
+            produced.append(f"parent-{number}")
+            number += 1
+
+    producer = threading.Thread(target=produce)
+    producer.start()
+    while len(produced) < 100:
+        time.sleep(0.001)
+
+    pid = os.fork()
+    if pid == 0:
+        # Child: the inherited dispatcher starts empty with its own worker thread
+        status = 1
+        try:
+            # Fail instead of hanging on a lock inherited from the producer
+            signal.alarm(20)
+            child_tracker = make_tracker(dispatcher)
+            for number in range(100):
+                child_tracker.do_track_event("music", "play", f"child-{number}")
+            if dispatcher.flush(timeout=10) and dispatcher.sent == 100:
+                status = 0
+        finally:
+            os._exit(status)
+
+    _, status = os.waitpid(pid, 0)
+    stop.set()
+    producer.join()
+    assert dispatcher.flush(timeout=10)
+    dispatcher.close()
+
+    assert os.waitstatus_to_exitcode(status) == 0
+    with open(path) as hits_file:
+        hits = hits_file.read().split()
+    assert len(hits) == len(set(hits))
+    assert sorted(hit for hit in hits if hit.startswith("parent-")) == sorted(produced)
+    assert sorted(hit for hit in hits if hit.startswith("child-")) == sorted(
+        f"child-{number}" for number in range(100)
+    )
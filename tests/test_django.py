@@ -0,0 +1,350 @@
+import io
+
+import pytest
+
+django = pytest.importorskip("django")
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(
+        MATOMO_SITE_ID=1,
+        MATOMO_TRACKING_API_URL="https://matomo.domain.example",
+        MATOMO_TRACK_PATHS=[r"^/tracked/"],
+        ALLOWED_HOSTS=["testserver"],
+        INSTALLED_APPS=["matomo"],
+        DATABASES={"default": {"ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"}},
+    )
+    django.setup()
+
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+from django.views import View
+
+import matomo
+from matomo.dispatch import Dispatcher
+from matomo.django import MatomoMiddleware, MatomoMixin, Request, get_settings
+from matomo.lazy import get_tracker
+from matomo.transport import MemoryTransport
+
+
+@pytest.fixture
+def rf():
+    return RequestFactory()
+
+
+@pytest.fixture(scope="module")
+def db():
+    call_command("migrate", "matomo", verbosity=0)
+
+
+@pytest.fixture
+def post(mocker):
+    return mocker.patch("matomo.transport.requests.post")
+
+
+def test_settings_are_cached(caplog):
+    settings = get_settings()
+    assert settings.site_id == 1
+    assert get_settings() is settings
+
+    with override_settings(MATOMO_SITE_ID=0):
+        assert get_settings().site_id == 0
+        with override_settings(MATOMO_TRACKING_API_URL=""):
+            pass
+    assert get_settings().site_id == 1
+    assert caplog.text.count("MATOMO_SITE_ID or MATOMO_TRACKING_API_URL not set.") == 1
+
+
+def test_outbox_without_token_warns(caplog):
+    with override_settings(MATOMO_OUTBOX=True):
+        pass
+    with override_settings(MATOMO_OUTBOX=True, MATOMO_TOKEN_AUTH="secret"):
+        pass
+    assert caplog.text.count("MATOMO_OUTBOX may send hits more than 86400 seconds") == 1
+
+
+def test_request(rf):
+    django_request = rf.get(
+        "/path/", {"a": "1"}, HTTP_USER_AGENT="Fake Mozilla", secure=True
+    )
+    django_request.COOKIES["_pk_ses.1.abcd"] = "*"
+    request = Request(django_request)
+
+    assert request["HTTPS"] is True
+    assert request["REQUEST_URI"] == "/path/"
+    assert request["PATH_INFO"] == "/path/"
+    assert request["SCRIPT_NAME"] == ""
+    assert request["HTTP_USER_AGENT"] == "Fake Mozilla"
+    assert request.get("QUERY_STRING") == "a=1"
+    assert request.get("HTTP_REFERER", "") == ""
+    assert "REMOTE_ADDR" in request
+    assert request.cookie is django_request.COOKIES
+    assert set(request) == set(django_request.META) | set(Request.COMPUTED)
+    assert len(request) == len(set(request))
+
+
+def test_middleware_skips_unused_tracker(rf, post):
+    middleware = MatomoMiddleware(lambda request: HttpResponse("ok"))
+    request = rf.get("/untracked/")
+    response = middleware(request)
+    response.close()
+
+    assert get_tracker(request.matomo) is None
+    assert not response.cookies
+    assert post.call_count == 0
+
+
+def test_middleware_sends_after_close(rf, post):
+    def view(request):
+        request.matomo.do_track_event("music", "play")
+        return HttpResponse("ok")
+
+    middleware = MatomoMiddleware(view)
+    request = rf.get("/tracked/page")
+    response = middleware(request)
+
+    tracker = get_tracker(request.matomo)
+    assert len(tracker.storedTrackingActions) == 2
+    assert post.call_count == 0
+    assert response.cookies
+
+    response.close()
+    assert post.call_count == 1
+    assert tracker.storedTrackingActions == []
+
+
+def test_middleware_tracks_only_successful_responses(rf, post):
+    middleware = MatomoMiddleware(lambda request: HttpResponse(status=404))
+    request = rf.get("/tracked/missing")
+    middleware(request).close()
+
+    assert get_tracker(request.matomo) is None
+
+
+class TrackingView(MatomoMixin, View):
+    def get(self, request):
+        if "track" in request.GET:
+            self.matomo.set_user_id("jj3")
+        return HttpResponse("ok")
+
+
+@override_settings(MATOMO_SITE_ID=0)
+def test_middleware_skips_tracked_paths_without_configuration(rf, post):
+    middleware = MatomoMiddleware(lambda request: HttpResponse("ok"))
+    request = rf.get("/tracked/page")
+    response = middleware(request)
+    response.close()
+
+    assert response.status_code == 200
+    assert get_tracker(request.matomo) is None
+    assert post.call_count == 0
+
+
+def test_mixin_creates_tracker_lazily(rf):
+    view = TrackingView.as_view()
+    response = view(rf.get("/"))
+    assert not response.cookies
+
+    response = view(rf.get("/", {"track": "1"}))
+    assert response.cookies
+
+
+class AsyncTrackingView(MatomoMixin, View):
+    async def get(self, request):
+        task = self.matomo.do_track_page_view("Async")
+        response = await task
+        return HttpResponse(str(response.status_code))
+
+
+def test_mixin_async_view(rf, mocker):
+    import asyncio
+
+    from matomo.aio import Response
+
+    send = mocker.patch(
+        "matomo.django.AsyncMatomo.send_request_async",
+        return_value=Response(204, {}, b""),
+    )
+    view = AsyncTrackingView.as_view()
+    response = asyncio.run(view(rf.get("/")))
+
+    assert response.content == b"204"
+    assert response.cookies
+    assert send.call_count == 1
+
+
+class AsyncUnawaitedTrackingView(MatomoMixin, View):
+    async def get(self, request):
+        self.matomo.do_track_page_view("Async")
+        return HttpResponse("ok")
+
+
+def test_mixin_async_view_waits_for_sends(rf, mocker, caplog):
+    import asyncio
+
+    from asgiref.sync import async_to_sync
+
+    from matomo.aio import Response
+
+    sent = []
+
+    async def send_request_async(tracker, url, method="GET", data=None):
+        await asyncio.sleep(0.01)
+        sent.append(url)
+        return Response(204, {}, b"")
+
+    mocker.patch("matomo.django.AsyncMatomo.send_request_async", send_request_async)
+    view = AsyncUnawaitedTrackingView.as_view()
+    # Like Django under WSGI, which closes the view's event loop when it returns
+    response = async_to_sync(view)(rf.get("/"))
+
+    assert response.content == b"ok"
+    assert len(sent) == 1
+    assert "cancelled" not in caplog.text
+
+
+def test_pixel_url_template_tags(rf):
+    from django.template import Context, Engine
+
+    engine = Engine(libraries={"matomo_tags": "matomo.templatetags.matomo_tags"})
+    template = engine.from_string(
+        '{% load matomo_tags %}{% matomo_pixel_url "Home page" %}|{% matomo_goal_pixel_url 3 9.5 %}'
+    )
+    page_view, goal = template.render(Context({"request": rf.get("/shop/")})).split("|")
+
+    assert page_view.startswith(
+        "https://matomo.domain.example/matomo.php?idsite=1&amp;rec=1&amp;apiv=1&amp;r="
+    )
+    assert "&amp;url=http%3A%2F%2Ftestserver%2Fshop%2F&amp;action_name=Home+page" in page_view
+    assert goal.endswith("&amp;idgoal=3&amp;revenue=9.5")
+
+
+@override_settings(MATOMO_OUTBOX=True)
+def test_outbox(db, rf, post, mocker):
+    from django.db import transaction
+
+    from matomo.models import OutboxHit
+
+    def view(request):
+        stored = request.matomo.do_track_event("shop", "order")
+        assert stored.status_code == 202 and not stored.done()
+        with transaction.atomic():
+            request.matomo.do_track_event("shop", "cancelled order")
+            transaction.set_rollback(True)
+        return HttpResponse("ok")
+
+    middleware = MatomoMiddleware(view)
+    middleware(rf.get("/tracked/page", HTTP_USER_AGENT="Fake Mozilla")).close()
+
+    assert post.call_count == 0
+    urls = list(OutboxHit.objects.values_list("url", flat=True))
+    assert len(urls) == 2
+    assert "e_a=order" in urls[0]
+    assert urls[0].endswith("&ua=Fake%20Mozilla")
+    assert not any("cancelled" in url for url in urls)
+
+    # Hits are sent by the command itself, not queued on a dispatcher
+    dispatcher = Dispatcher(MemoryTransport())
+    mocker.patch.object(matomo.Matomo, "transport", dispatcher)
+    call_command("matomo_send_outbox", batch_size=1, stdout=io.StringIO())
+    dispatcher.close()
+
+    assert post.call_count == 2
+    assert post.call_args.kwargs["json"] == {"requests": urls[1:]}
+    assert not OutboxHit.objects.exists()
+
+
+@pytest.fixture(scope="module")
+def order_models(db):
+    from django.db import connection, models
+
+    class Order(models.Model):
+        number = models.CharField(max_length=20)
+        total = models.DecimalField(max_digits=10, decimal_places=2)
+
+        class Meta:
+            app_label = "matomo"
+
+    class OrderLine(models.Model):
+        order = models.ForeignKey(Order, related_name="lines", on_delete=models.CASCADE)
+        sku = models.CharField(max_length=20)
+        price = models.DecimalField(max_digits=10, decimal_places=2)
+
+        class Meta:
+            app_label = "matomo"
+
+    with connection.schema_editor() as editor:
+        editor.create_model(Order)
+        editor.create_model(OrderLine)
+    return Order, OrderLine
+
+
+@pytest.fixture
+def registered_order(order_models):
+    from matomo.django_ecommerce import register_order_model, unregister_order_model
+
+    Order, _ = order_models
+    register_order_model(
+        Order,
+        {"order_id": "number", "grand_total": "total"},
+        items="lines",
+        item_fields={"sku": "sku", "price": "price"},
+    )
+    yield order_models
+    unregister_order_model(Order)
+
+
+def test_ecommerce_orders_tracked_on_commit(registered_order, post):
+    from django.db import transaction
+
+    Order, OrderLine = registered_order
+    with transaction.atomic():
+        for number in ("A1", "A2"):
+            order = Order.objects.create(number=number, total="12.50")
+            OrderLine.objects.create(order=order, sku="pk1", price="12.50")
+        assert post.call_count == 0
+
+    with transaction.atomic():
+        Order.objects.create(number="A3", total="1.00")
+        transaction.set_rollback(True)
+
+    with transaction.atomic():
+        with transaction.atomic():
+            Order.objects.create(number="A4", total="1.00")
+            transaction.set_rollback(True)
+        Order.objects.create(number="A5", total="2.00")
+
+    assert post.call_count == 2
+    first, second = [call.kwargs["json"]["requests"] for call in post.call_args_list]
+    assert len(first) == 2
+    assert "&ec_id=A1" in first[0] and "&revenue=12.5" in first[0]
+    assert "&ec_items=%5B%5B%22pk1%22%2C%20%22%22%2C%20%22%22%2C%20%2212.50%22%2C%201%5D%5D" in first[0]
+    assert len(second) == 1 and "&ec_id=A5" in second[0]
+
+
+def test_ecommerce_orders_tracked_with_request_tracker(registered_order, rf, post):
+    from django.db import transaction
+
+    Order, _ = registered_order
+
+    def view(request):
+        with transaction.atomic():
+            Order.objects.create(number="B1", total="3.00")
+            Order.objects.create(number="B2", total="4.00")
+        request.matomo.do_track_event("shop", "thanks")
+        return HttpResponse("ok")
+
+    middleware = MatomoMiddleware(view)
+    request = rf.get("/shop/", HTTP_USER_AGENT="Fake Mozilla")
+    middleware(request).close()
+
+    assert post.call_count == 2
+    orders, hits = [call.kwargs["json"]["requests"] for call in post.call_args_list]
+    visitor = "&_id=" + request.matomo.get_visitor_id()
+    assert len(orders) == 2
+    assert all(visitor in url and url.endswith("&ua=Fake%20Mozilla") for url in orders)
+    # Order values don't leak into the request's own hits
+    assert len(hits) == 1 and "e_a=thanks" in hits[0] and "ec_id" not in hits[0]
+    assert hits[0].endswith("&ua=Fake%20Mozilla")
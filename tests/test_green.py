@@ -0,0 +1,47 @@
+import pytest
+
+gevent = pytest.importorskip("gevent")
+
+import matomo
+from matomo.green import GreenletTransport
+from matomo.request import Request
+from matomo.transport import Response, Transport
+
+
+class SlowTransport(Transport):
+    def __init__(self):
+        self.active = 0
+        self.max_active = 0
+        self.sent = []
+
+    def send(self, method, url, data=None, **options):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        gevent.sleep(0.01)
+        self.active -= 1
+        if "fail" in url:
+            raise OSError("Connection refused")
+        self.sent.append(url)
+        return Response(204, {}, b"")
+
+    def send_bulk(self, url, data, **options):
+        return self.send("POST", url, data, **options)
+
+
+def test_greenlet_transport(caplog):
+    slow = SlowTransport()
+    transport = GreenletTransport(slow, size=2)
+    tracker = matomo.Matomo(Request({}), 1, "https://matomo.domain.example")
+    tracker.set_transport(transport)
+
+    greenlets = [tracker.do_track_event("music", "play", str(number)) for number in range(5)]
+    assert len(slow.sent) < 5
+
+    failed = transport.send("GET", "https://matomo.domain.example/matomo.php?fail=1")
+    transport.join()
+
+    assert [greenlet.value.status_code for greenlet in greenlets] == [204] * 5
+    assert failed.value is None
+    assert "Sending Matomo tracking request failed." in caplog.text
+    assert slow.max_active == 2
+    assert len(slow.sent) == 5
@@ -0,0 +1,80 @@
+import os
+import signal
+import threading
+
+import pytest
+
+from matomo import MatomoTracker
+from matomo.ids import IdSource
+from matomo.request import Request
+
+
+def test_hex():
+    source = IdSource(pool_size=8)
+    values = [source.hex(6) for i in range(10)]
+
+    assert all(len(value) == 6 for value in values)
+    assert all(int(value, 16) >= 0 for value in values)
+    assert len(set(values)) == len(values)
+    assert len(source.hex(40)) == 40
+
+
+def test_seeded_source_is_reproducible():
+    first = IdSource(seed=42)
+    second = IdSource(seed=42)
+
+    assert [first.visitor_id() for i in range(5)] == [
+        second.visitor_id() for i in range(5)
+    ]
+    assert first.pageview_id() == second.pageview_id()
+    assert IdSource(seed=43).visitor_id() != IdSource(seed=42).visitor_id()
+
+
+def test_reset():
+    source = IdSource()
+    source.hex(6)
+    source.reset()
+    assert source._pool == ""
+    assert source._pos == 0
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="fork not supported")
+@pytest.mark.parametrize("seed", [None, 1])
+def test_fork_while_locked(seed):
+    source = IdSource(seed=seed)
+    locked = threading.Event()
+    release = threading.Event()
+
+    def hold_lock():
+        with source._lock:
+            locked.set()
+            release.wait(5)
+
+    holder = threading.Thread(target=hold_lock)
+    holder.start()
+    assert locked.wait(5)
+    try:
+        pid = os.fork()
+        if pid == 0:
+            # Child: the lock's holder doesn't exist here, a hang is killed by the alarm
+            signal.alarm(5)
+            os._exit(0 if len(source.visitor_id()) == 16 else 1)
+    finally:
+        release.set()
+        holder.join()
+
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+
+
+def test_tracker_uses_id_source():
+    request = Request({"HTTP_HOST": "test.domain.example"})
+    tracker = MatomoTracker(request, 1, "https://matomo.domain.example")
+    tracker.set_id_source(IdSource(seed=1))
+    tracker.set_new_visitor_id()
+    tracker.generate_new_pageview_id()
+
+    expected = IdSource(seed=1)
+    assert tracker.idPageview == expected.pageview_id()
+    assert tracker.randomVisitorId == expected.visitor_id()
+    assert f"&r={expected.cache_buster()}&" in tracker.get_request(tracker.id_site)
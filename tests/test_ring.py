@@ -0,0 +1,170 @@
+import multiprocessing
+
+import pytest
+
+import matomo
+from matomo.request import Request
+from matomo.transport import MemoryTransport
+
+
+ring_module = pytest.importorskip("matomo.ring")
+HitRing = ring_module.HitRing
+
+
+@pytest.fixture
+def ring():
+    ring = HitRing(size=16 + 4 * 64, slot_size=64)
+    yield ring
+    ring.close()
+    ring.unlink()
+
+
+def test_ring_put_get(ring):
+    assert ring.slots == 4
+    for number in range(5):
+        ring.put(b"hit %d" % number)
+    assert ring.overflow == 1
+    assert not ring.put(b"x" * 64)
+    assert ring.overflow == 2
+
+    assert ring.get(2) == [b"hit 0", b"hit 1"]
+    assert ring.put(b"hit 5")
+    assert ring.get(10) == [b"hit 2", b"hit 3", b"hit 5"]
+    assert ring.get(10) == []
+
+
+def test_ring_put_lock_timeout(ring):
+    ring.lock_timeout = 0.01
+    with ring.lock:
+        assert not ring.put(b"hit")
+    assert ring.overflow == 1
+    assert ring.put(b"hit")
+    assert ring.get(10) == [b"hit"]
+
+
+def test_ring_skips_stale_slots(ring):
+    buf = ring.memory.buf
+    # A writer that died after claiming the first slot
+    with ring.lock:
+        ring_module.SLOT_HEADER.pack_into(buf, ring_module.HEADER.size, ring_module.WRITING, 0, 0)
+        ring_module.HEADER.pack_into(buf, 0, 1, 0)
+    ring.put(b"hit 1")
+    ring.put(b"hit 2")
+
+    assert ring.get(10) == []
+    ring.stale_after = 0
+    assert ring.get(10) == [b"hit 1", b"hit 2"]
+    assert ring.overflow == 1
+    # The ring wraps around over the reclaimed slot
+    for number in range(4):
+        assert ring.put(b"hit %d" % (number + 3))
+    assert ring.get(10) == [b"hit 3", b"hit 4", b"hit 5", b"hit 6"]
+
+
+def test_ring_reclaims_slots_only_under_lock(ring):
+    class ReclaimingLock:
+        def __init__(self, lock):
+            self.lock = lock
+            self.acquired = 0
+
+        def acquire(self, timeout):
+            self.acquired += 1
+            if self.acquired == 2:
+                ring.lock = self.lock
+                ring.stale_after = 0
+                # The reader doesn't take the slot back while a writer holds the lock
+                assert self.lock.acquire()
+                assert ring.get(10) == []
+                assert ring.memory.buf[ring_module.HEADER.size] == ring_module.WRITING
+                self.lock.release()
+                # ... but gives up on it while its hit is being copied
+                assert ring.get(10) == []
+                assert ring.memory.buf[ring_module.HEADER.size] == ring_module.EMPTY
+                ring.lock = self
+            return self.lock.acquire(timeout=timeout)
+
+        def release(self):
+            self.lock.release()
+
+    real_lock = ring.lock
+    ring.lock = ReclaimingLock(real_lock)
+    assert not ring.put(b"hit 1")
+    ring.lock = real_lock
+    assert ring.overflow == 1
+    assert ring.put(b"hit 2")
+    assert ring.get(10) == [b"hit 2"]
+
+
+def test_ring_transport_and_dispatcher():
+    ring = HitRing(size=64 * 1024)
+    memory = MemoryTransport()
+    dispatcher = ring_module.RingDispatcher(
+        ring,
+        "https://matomo.domain.example",
+        token_auth="secret",
+        batch_size=2,
+        transport=memory,
+    )
+    tracker = matomo.Matomo(Request({}), 1, "https://matomo.domain.example")
+    tracker.set_transport(ring_module.RingTransport(ring))
+    for number in range(3):
+        assert tracker.do_track_event("music", "play", str(number)).status_code == 202
+
+    assert dispatcher.flush() == 3
+    assert [len(data["requests"]) for _, data in memory.bulk_requests] == [2, 1]
+    url, data = memory.bulk_requests[0]
+    assert url == "https://matomo.domain.example/matomo.php"
+    assert data["token_auth"] == "secret"
+    assert data["requests"][0].startswith("?idsite=1&rec=1")
+    assert dispatcher.sent == 3
+    ring.close()
+    ring.unlink()
+
+
+def test_ring_transport_bulk_futures_stay_pending():
+    ring = HitRing(size=64 * 1024)
+    tracker = matomo.Matomo(Request({}), 1, "https://matomo.domain.example")
+    tracker.set_transport(ring_module.RingTransport(ring))
+    tracker.enable_bulk_tracking()
+    hit = tracker.do_track_page_view("Home")
+
+    assert tracker.do_bulk_track().status_code == 202
+    # Handed off to the ring, not acknowledged by Matomo
+    assert not hit.done()
+    assert hit.delivered is None
+    ring.close()
+    ring.unlink()
+
+
+def produce(ring, worker, count):
+    for number in range(count):
+        while not ring.put(b"%d-%d" % (worker, number)):
+            pass
+
+
+@pytest.mark.skipif(
+    "fork" not in multiprocessing.get_all_start_methods(), reason="fork not supported"
+)
+def test_ring_multiple_producers():
+    ring = HitRing(size=16 + 64 * 32, slot_size=32)
+    context = multiprocessing.get_context("fork")
+    try:
+        workers = [
+            context.Process(target=produce, args=(ring, worker, 500)) for worker in range(4)
+        ]
+        for worker in workers:
+            worker.start()
+        hits = []
+        while len(hits) < 2000 and any(worker.is_alive() for worker in workers):
+            hits.extend(ring.get(100))
+        for worker in workers:
+            worker.join()
+        hits.extend(ring.get(2000))
+    finally:
+        ring.close()
+        ring.unlink()
+
+    assert len(hits) == len(set(hits)) == 2000
+    for worker in range(4):
+        numbers = [int(hit.split(b"-")[1]) for hit in hits if hit.startswith(b"%d-" % worker)]
+        assert numbers == sorted(numbers)
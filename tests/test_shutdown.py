@@ -0,0 +1,131 @@
+import atexit
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+import matomo
+from matomo.dispatch import Dispatcher
+from matomo.request import Request
+from matomo.shutdown import ShutdownCoordinator, ShutdownReport
+from matomo.transport import MemoryTransport, Response, Transport
+
+
+class StuckTransport(Transport):
+    def __init__(self):
+        self.sending = threading.Event()
+        self.release = threading.Event()
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    def send_bulk(self, url, data, **options):
+        self.sending.set()
+        self.release.wait(5)
+        return Response(500, {}, b"")
+
+
+class FailingTransport(Transport):
+    def send_bulk(self, url, data, **options):
+        return Response(500, {}, b"")
+
+
+def make_tracker(transport):
+    tracker = matomo.Matomo(Request({}), 1, "https://matomo.domain.example")
+    tracker.set_transport(transport).enable_bulk_tracking()
+    return tracker
+
+
+def test_shutdown_flushes_trackers():
+    memory = MemoryTransport()
+    tracker = make_tracker(memory)
+    tracker.do_track_event("music", "play")
+    tracker.do_track_event("music", "pause")
+    coordinator = ShutdownCoordinator()
+    coordinator.register(tracker)
+
+    assert coordinator.shutdown() == ShutdownReport(2, 0, 0)
+    assert len(memory.bulk_requests[0][1]["requests"]) == 2
+    assert coordinator.shutdown() is coordinator.report
+
+
+def test_shutdown_spills_after_deadline(tmp_path):
+    spill_path = tmp_path / "spill"
+    failing = make_tracker(FailingTransport())
+    failing.do_track_event("music", "stop")
+
+    stuck = StuckTransport()
+    dispatcher = Dispatcher(stuck, batch_size=1)
+    for number in range(3):
+        dispatcher.send("GET", f"https://matomo.domain.example/matomo.php?idsite=1&e_n={number}")
+    assert stuck.sending.wait(5)
+
+    coordinator = ShutdownCoordinator(deadline=0.1, spill_path=str(spill_path))
+    coordinator.register(failing)
+    coordinator.register(dispatcher)
+    report = coordinator.shutdown()
+    # The transport isn't closed under the worker thread that is still sending
+    assert not stuck.closed
+    stuck.release.set()
+
+    # The hit being sent when the deadline passed is counted as dropped
+    assert report == ShutdownReport(0, 3, 1)
+    hits = spill_path.read_text().splitlines()
+    assert hits[0].startswith("?idsite=1&rec=1") and "&e_a=stop" in hits[0]
+    assert hits[1:] == ["?idsite=1&e_n=1", "?idsite=1&e_n=2"]
+    assert dispatcher.send("GET", "https://matomo.domain.example/matomo.php?idsite=1").status_code == 503
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGUSR1"), reason="SIGUSR1 not supported")
+def test_shutdown_on_signal():
+    calls = []
+    previous = signal.signal(signal.SIGUSR1, lambda signum, frame: calls.append(signum))
+    coordinator = ShutdownCoordinator()
+    try:
+        coordinator.install(signals=(signal.SIGUSR1,))
+        os.kill(os.getpid(), signal.SIGUSR1)
+        # The handler only starts the shutdown thread, which raises the signal again
+        assert coordinator._signal_thread is not None
+        coordinator._signal_thread.join(5)
+        deadline = time.monotonic() + 5
+        while not calls and time.monotonic() < deadline:
+            time.sleep(0.001)
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+        atexit.unregister(coordinator.shutdown)
+
+    assert coordinator.report == ShutdownReport(0, 0, 0)
+    assert calls == [signal.SIGUSR1]
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGUSR1"), reason="SIGUSR1 not supported")
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_shutdown_on_signal_when_shutdown_fails(mocker):
+    calls = []
+    previous = signal.signal(signal.SIGUSR1, lambda signum, frame: calls.append(signum))
+    memory = MemoryTransport()
+    tracker = make_tracker(memory)
+    tracker.do_track_event("music", "play")
+    dispatcher = Dispatcher(memory)
+    mocker.patch.object(dispatcher, "close", side_effect=RuntimeError("broken"))
+    coordinator = ShutdownCoordinator()
+    coordinator.register(tracker)
+    coordinator.register(dispatcher)
+    try:
+        coordinator.install(signals=(signal.SIGUSR1,))
+        os.kill(os.getpid(), signal.SIGUSR1)
+        coordinator._signal_thread.join(5)
+        deadline = time.monotonic() + 5
+        while not calls and time.monotonic() < deadline:
+            time.sleep(0.001)
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+        atexit.unregister(coordinator.shutdown)
+        Dispatcher.close(dispatcher)
+
+    # The report has the hits sent before the failure and the signal isn't swallowed
+    assert coordinator.report == ShutdownReport(1, 0, 0)
+    assert calls == [signal.SIGUSR1]
@@ -1,10 +1,14 @@
+from datetime import datetime, timezone
 import json
 import random
+from urllib.parse import unquote
 
 import pytest
 
 from matomo import MatomoTracker
+from matomo.ids import IdSource
 from matomo.request import Request
+from matomo.tracker import DeferredUrl
 
 
 request_data = {
@@ -270,6 +274,30 @@ def test_set_client_hints(tracker):
     }
 
 
+def test_parse_full_version_list():
+    from matomo.tracker import parse_full_version_list
+
+    assert parse_full_version_list("") == []
+    assert parse_full_version_list('"Chromium";v="98.0", broken') == [
+        {"brand": "Chromium", "version": "98.0"}
+    ]
+    header = '"Chromium";v="98.0.4750.0", "Google Chrome"; v="98.0.4750.0"'
+    assert parse_full_version_list(header) is parse_full_version_list(header)
+
+
+def test_get_encoded_client_hints(tracker):
+    full_version_list = '"Chromium";v="98.0.4750.0", "Google Chrome";v="98.0.4750.0"'
+    tracker.set_client_hints("modelA", "platformB", "1.12", full_version_list, "uaC")
+    encoded = tracker.get_encoded_client_hints()
+    assert json.loads(unquote(encoded)) == tracker.clientHints
+    assert "&uadata=" + encoded in tracker.get_request(tracker.id_site)
+
+    brands = [{"brand": "Chromium", "version": "98.0.4750.0"}]
+    tracker.set_client_hints("modelA", "platformB", "1.12", brands, "uaC")
+    assert tracker.clientHintsKey is None
+    assert json.loads(unquote(tracker.get_encoded_client_hints())) == tracker.clientHints
+
+
 def test_set_country(tracker):
     assert tracker.country == ""
     tracker.set_country("Slovenia")
@@ -720,6 +748,25 @@ def test_set_user_id(tracker):
     assert exc.value.args[0] == "User ID cannot be empty."
 
 
+def test_get_user_id_hashed(tracker):
+    assert tracker.get_user_id_hashed("jj3") == "914274491f33a629"
+    assert tracker.get_user_id_hashed(b"jj3") == "914274491f33a629"
+
+
+def test_set_user_id_with_resolver(tracker):
+    from matomo.ids import VisitorIdResolver
+
+    tracker.set_visitor_id_resolver(VisitorIdResolver(cache_size=2))
+    tracker.set_user_id("jj3")
+    assert tracker.userVisitorId == tracker.get_user_id_hashed("jj3")
+    assert tracker.get_visitor_id() == tracker.userVisitorId
+    assert tracker._randomVisitorId == ""
+
+    tracker.set_user_id(False)
+    assert tracker.userVisitorId == ""
+    assert tracker.get_visitor_id() == tracker.randomVisitorId
+
+
 def test_set_visitor_id(tracker):
     with pytest.raises(Exception) as exc:
         tracker.set_visitor_id("")
@@ -901,6 +948,31 @@ def test_get_timestamp(tracker):
     tracker.set_force_visit_date_time("2023-01-01 18:45:23")
     assert tracker.get_timestamp() == 1672595123.0
 
+    tracker.set_force_visit_date_time(1672595123)
+    assert tracker.get_timestamp() == 1672595123.0
+
+    tracker.set_force_visit_date_time(datetime(2023, 1, 1, 17, 45, 23, tzinfo=timezone.utc))
+    assert tracker.get_timestamp() == 1672595123.0
+
+
+def test_format_cdt():
+    from matomo.tracker import format_cdt, format_cdt_column
+
+    moment = datetime(2023, 1, 1, 17, 45, 23, tzinfo=timezone.utc)
+    assert format_cdt("2023-01-01 18:45:23") == "2023-01-01%2018%3A45%3A23"
+    assert format_cdt(1672595123.7) == "1672595123"
+    assert format_cdt(moment) == "1672595123"
+    assert format_cdt_column([moment, 1672595124, moment]) == [
+        "1672595123",
+        "1672595124",
+        "1672595123",
+    ]
+
+
+def test_get_request_forced_datetime(tracker):
+    tracker.set_force_visit_date_time(1672595123)
+    assert "&cdt=1672595123&" in tracker.get_request(tracker.id_site)
+
 
 def test_get_base_url(tracker):
     assert tracker.URL == "https://matomo.domain.example"
@@ -1084,3 +1156,26 @@ def test_parse_incoming_cookies(tracker):
     ]
     tracker.parse_incoming_cookies(headers)
     assert tracker.incomingTrackerCookies.get("id") == ["a3fWa"]
+
+
+def test_deferred_serialization():
+    def make_tracker():
+        tracker = MatomoTracker(Request(request_data), 1, "https://matomo.domain.example")
+        tracker.set_id_source(IdSource(seed=7))
+        tracker.createTs = 1700000000
+        tracker.set_custom_variable(1, "plan", "free", "visit")
+        tracker.set_custom_dimension(2, "blue")
+        tracker.set_client_hints("Pixel", "Android", "14", "", "")
+        return tracker
+
+    expected = make_tracker().get_url_track_event("music", "play", "song")
+    tracker = make_tracker()
+    tracker.enable_deferred_serialization()
+    deferred = tracker.get_url_track_event("music", "play", "song")
+    # Changes after capturing the hit are not sent with it
+    tracker.set_custom_variable(1, "plan", "paid", "visit")
+    tracker.set_custom_dimension(2, "red")
+
+    assert isinstance(deferred, DeferredUrl)
+    assert str(deferred) == expected
+    assert "dimension2=blue" in expected and "&uadata=" in expected
@@ -0,0 +1,275 @@
+import gc
+import json
+import socket
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import matomo
+from matomo.request import Request
+from matomo.tracker import DeferredUrl
+from matomo.transport import (
+    HitFuture,
+    HTTPClientTransport,
+    MemoryTransport,
+    RequestsTransport,
+    Response,
+    UnixSocketTransport,
+    resolve_bulk,
+)
+
+
+class MatomoHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.received.append((self.command, self.path, self.headers, b""))
+        self.respond()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.received.append((self.command, self.path, self.headers, body))
+        self.respond()
+
+    def respond(self):
+        payload = json.dumps({"status": "success"}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        # Simulates keep-alive timeouts by closing connections without telling clients
+        self.close_connection = getattr(self.server, "drop_connections", False)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MatomoHandler)
+    server.received = []
+    server.connections = 0
+    get_request = server.get_request
+
+    def counting_get_request():
+        server.connections += 1
+        return get_request()
+
+    server.get_request = counting_get_request
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_tracker(api_url, transport):
+    request = Request({"HTTP_USER_AGENT": "Fake Mozilla", "HTTP_HOST": "test.domain.example"})
+    return matomo.Matomo(request, 1, api_url).set_transport(transport)
+
+
+def test_memory_transport():
+    transport = MemoryTransport()
+    tracker = make_tracker("https://matomo.domain.example", transport)
+
+    assert tracker.do_track_page_view("Page").status_code == 204
+    method, url, data = transport.requests[0]
+    assert method == "GET" and "action_name=Page" in url and data is None
+
+    tracker.enable_bulk_tracking()
+    tracker.do_track_event("music", "play")
+    tracker.do_track_event("music", "pause")
+    assert tracker.do_bulk_track().json()["tracked"] == 2
+    url, data = transport.bulk_requests[0]
+    assert url == "https://matomo.domain.example/matomo.php"
+    assert len(data["requests"]) == 2
+
+
+def test_bulk_tracking_futures():
+    transport = MemoryTransport()
+    tracker = make_tracker("https://matomo.domain.example", transport)
+    tracker.enable_bulk_tracking()
+    play = tracker.do_track_event("music", "play")
+    pause = tracker.do_track_event("music", "pause")
+    resolved = []
+    play.add_done_callback(resolved.append)
+
+    assert play.status_code == 202 and not play.done()
+    tracker.do_bulk_track()
+
+    assert resolved == [play]
+    assert play.result(timeout=0) is True and pause.delivered is True
+    assert tracker.storedFutures == []
+
+
+def test_capture_time(mocker):
+    mocker.patch("matomo.time.time", return_value=1700000000.5)
+    transport = MemoryTransport()
+    tracker = make_tracker("https://matomo.domain.example", transport)
+    tracker.do_track_event("music", "play")
+    tracker.enable_bulk_tracking()
+    tracker.do_track_event("music", "pause")
+    tracker.set_force_visit_date_time(1600000000)
+    tracker.do_track_event("music", "stop")
+    tracker.do_bulk_track()
+
+    # Hits sent right away are recorded at the time Matomo receives them
+    assert "cdt=" not in transport.requests[0][1]
+    paused, stopped = transport.bulk_requests[0][1]["requests"]
+    assert "&e_a=pause&cdt=1700000000&" in paused
+    assert stopped.count("cdt=") == 1 and "&cdt=1600000000&" in stopped
+
+
+def test_bulk_tracking_keeps_deferred_urls(mocker):
+    format_request = mocker.spy(matomo.tracker, "format_request")
+    transport = MemoryTransport()
+    tracker = make_tracker("https://matomo.domain.example", transport)
+    tracker.enable_deferred_serialization()
+    tracker.enable_bulk_tracking()
+    tracker.set_user_agent("Fake Mozilla")
+    tracker.do_track_event("music", "play")
+
+    assert isinstance(tracker.storedTrackingActions[0], DeferredUrl)
+    assert format_request.call_count == 0
+    tracker.do_bulk_track()
+
+    assert format_request.call_count == 1
+    (hit,) = transport.bulk_requests[0][1]["requests"]
+    assert "&e_a=play&" in hit and hit.endswith("&ua=Fake%20Mozilla")
+
+
+def test_resolve_bulk_invalid_indices():
+    futures = [HitFuture() for _ in range(3)]
+    body = json.dumps({"status": "success", "tracked": 2, "invalid": 1, "invalid_indices": [1]})
+    resolve_bulk(futures, Response(200, {}, body.encode()))
+    assert [future.delivered for future in futures] == [True, False, True]
+
+    # Without invalid_indices hits with invalid ones can't be told apart
+    futures = [HitFuture() for _ in range(2)]
+    resolve_bulk(futures, Response(200, {}, b'{"tracked": 1, "invalid": 1}'))
+    assert [future.delivered for future in futures] == [False, False]
+
+    futures = [HitFuture() for _ in range(2)]
+    resolve_bulk(futures, Response(500, {}, b""))
+    assert [future.delivered for future in futures] == [False, False]
+
+    pending = HitFuture()
+    with pytest.raises(TimeoutError):
+        pending.result(timeout=0.01)
+    threading.Timer(0.01, pending.set_result, [True]).start()
+    assert pending.result(timeout=5) is True
+    assert HitFuture(503).result() is False
+
+
+def test_requests_transport_after_fork(mocker):
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    session.headers["X-Matomo"] = "1"
+    session.mount("https://", HTTPAdapter(max_retries=3))
+    close = mocker.spy(session, "close")
+    transport = RequestsTransport(session)
+
+    transport.reset_after_fork()
+
+    assert close.call_count == 0
+    assert transport.session is not session
+    assert transport.session.headers["X-Matomo"] == "1"
+    adapter = transport.session.adapters["https://"]
+    assert adapter.max_retries.total == 3
+    assert adapter.poolmanager is not session.adapters["https://"].poolmanager
+
+
+def test_http_client_transport(server):
+    transport = HTTPClientTransport()
+    api_url = f"http://127.0.0.1:{server.server_address[1]}"
+    tracker = make_tracker(api_url, transport)
+
+    response = tracker.do_track_page_view("Page")
+    assert response.ok and response.json() == {"status": "success"}
+
+    tracker.set_token_auth("secret")
+    tracker.do_track_page_view("Page")
+
+    tracker.enable_bulk_tracking()
+    tracker.do_track_event("music", "play")
+    tracker.do_bulk_track()
+    transport.close()
+
+    assert server.connections == 1
+    (_, _, headers, _), (_, token_path, _, _), (bulk, path, bulk_headers, body) = server.received
+    assert headers["User-Agent"] == "Fake Mozilla"
+    assert token_path.endswith("&token_auth=secret")
+    assert bulk == "POST"
+    assert bulk_headers["Content-Type"] == "application/json"
+    assert path == "/matomo.php"
+    data = json.loads(body)
+    assert data["token_auth"] == "secret" and len(data["requests"]) == 1
+
+
+def test_http_client_transport_retries_stale_connection(server):
+    server.drop_connections = True
+    transport = HTTPClientTransport()
+    tracker = make_tracker(f"http://127.0.0.1:{server.server_address[1]}", transport)
+
+    assert tracker.do_track_page_view("Page").ok
+    tracker.enable_bulk_tracking()
+    tracker.do_track_event("music", "play")
+    assert tracker.do_bulk_track().ok
+    transport.close()
+
+    assert server.connections == 2
+    assert [method for method, _, _, _ in server.received] == ["GET", "POST"]
+
+
+def test_http_client_transport_closes_connections_of_finished_threads(server):
+    transport = HTTPClientTransport()
+    tracker = make_tracker(f"http://127.0.0.1:{server.server_address[1]}", transport)
+    connections = []
+
+    def track():
+        assert tracker.do_track_page_view("Page").ok
+        connections.extend(transport._local.connections.values())
+
+    thread = threading.Thread(target=track)
+    thread.start()
+    thread.join()
+
+    assert connections[0].sock is None
+    connections.clear()
+    gc.collect()
+    assert len(transport._connections) == 0
+
+
+class UnixMatomoServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="Unix domain sockets not supported")
+def test_unix_socket_transport(tmp_path):
+    path = str(tmp_path / "matomo.sock")
+    server = UnixMatomoServer(path, MatomoHandler)
+    server.received = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        transport = UnixSocketTransport(path)
+        tracker = make_tracker("http://matomo.domain.example", transport)
+        assert tracker.do_track_page_view("Page").ok
+        tracker.enable_bulk_tracking()
+        tracker.do_track_event("music", "play")
+        tracker.do_track_event("music", "pause")
+        assert tracker.do_bulk_track().json() == {"status": "success"}
+        transport.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    (method, path, headers, _), (bulk, bulk_path, _, body) = server.received
+    assert method == "GET" and path.startswith("/matomo.php?idsite=1")
+    assert headers["Host"] == "matomo.domain.example"
+    assert bulk == "POST" and bulk_path == "/matomo.php"
+    assert len(json.loads(body)["requests"]) == 2
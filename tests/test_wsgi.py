@@ -0,0 +1,93 @@
+from matomo.lazy import get_tracker
+from matomo.request import parse_cookies
+from matomo.wsgi import EnvironRequest, MatomoMiddleware
+
+
+def make_environ(path="/page"):
+    return {
+        "REQUEST_METHOD": "GET",
+        "PATH_INFO": path,
+        "QUERY_STRING": "a=1",
+        "HTTP_HOST": "test.domain.example",
+        "HTTP_COOKIE": "_pk_ses.1.abcd=*",
+        "REMOTE_ADDR": "192.168.0.1",
+        "wsgi.url_scheme": "https",
+    }
+
+
+class Body(list):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_environ_request():
+    environ = make_environ()
+    request = EnvironRequest(environ)
+
+    assert request["HTTPS"] is True
+    assert request.get("REMOTE_ADDR") == "192.168.0.1"
+    assert request.get("HTTP_REFERER", "") == ""
+    assert "HTTPS" in request
+    assert len(request) == len(environ) + 1
+    assert request.cookie == {"_pk_ses.1.abcd": "*"}
+
+    environ["HTTP_USER_AGENT"] = "Fake Mozilla"
+    assert request["HTTP_USER_AGENT"] == "Fake Mozilla"
+
+
+def test_parse_cookies_skips_malformed_values():
+    assert parse_cookies('theme=dark mode; _pk_id.1.abcd=1234.5678; bad"; q="a b"') == {
+        "theme": "dark mode",
+        "_pk_id.1.abcd": "1234.5678",
+        "": 'bad"',
+        "q": "a b",
+    }
+
+
+def test_middleware(mocker):
+    post = mocker.patch("matomo.transport.requests.post")
+    body = Body([b"ok"])
+    started = []
+
+    def app(environ, start_response):
+        environ["matomo.tracker"].do_track_event("music", "play")
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return body
+
+    def start_response(status, headers, exc_info=None):
+        started.append(headers)
+
+    environ = make_environ()
+    result = MatomoMiddleware(app, 1, "https://matomo.domain.example", [r"^/page"])(
+        environ, start_response
+    )
+    assert list(result) == [b"ok"]
+    assert any(name == "Set-Cookie" for name, value in started[0])
+    assert len(get_tracker(environ["matomo.tracker"]).storedTrackingActions) == 2
+    assert post.call_count == 0
+
+    result.close()
+    assert body.closed
+    assert post.call_count == 1
+
+
+def test_middleware_skips_unused_tracker(mocker):
+    post = mocker.patch("matomo.transport.requests.post")
+    started = []
+
+    def app(environ, start_response):
+        start_response("200 OK", [])
+        return [b"ok"]
+
+    environ = make_environ()
+    result = MatomoMiddleware(app, 1, "https://matomo.domain.example")(
+        environ, lambda status, headers, exc_info=None: started.append(headers)
+    )
+    list(result)
+    result.close()
+
+    assert started == [[]]
+    assert get_tracker(environ["matomo.tracker"]) is None
+    assert post.call_count == 0